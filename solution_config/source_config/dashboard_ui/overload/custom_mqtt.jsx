@@ -1,5 +1,11 @@
 export async function custom_new_message_action(dispatch, queryClient, message) {
-  if (message && message.topic.match("location_state/update")) {
+  if (message && message.topic.match("location_state/batch")) {
+    queryClient.refetchQueries({ queryKey: ["state"] })
+    queryClient.refetchQueries({ queryKey: ["state_at", { id: message?.payload?.location_link }] })
+    queryClient.refetchQueries({ queryKey: ['events_at', { id: message?.payload?.location_link }] })
+    const item_ids = new Set((message?.payload?.changes ?? []).map(change => change.item_id))
+    item_ids.forEach(item_id => queryClient.refetchQueries({ queryKey: ['history_for', { id: item_id }] }))
+  } else if (message && (message.topic.match("location_state/update") || message.topic.match("location_state/corrected"))) {
     queryClient.refetchQueries({ queryKey: ["state"] })
     queryClient.refetchQueries({ queryKey: ["state_at", { id: message?.payload?.location_link }] })
     queryClient.refetchQueries({ queryKey: ['history_for', { id: message.payload.item_id }] })
@@ -1,7 +1,14 @@
 export const initial_state = { connected: false }
 
 export async function new_message_action(dispatch, queryClient, message) {
-    if (message && message.topic.match("location_state/update")) {
+    if (message && message.topic.match("location_state/batch")) {
+        console.log("batch received on ", message.topic)
+        queryClient.refetchQueries({ queryKey: ["state"] })
+        queryClient.refetchQueries({ queryKey: ["state_at", { id: message?.payload?.location_link }] })
+        queryClient.refetchQueries({ queryKey: ['events_at', { id: message?.payload?.location_link }] })
+        const item_ids = new Set((message?.payload?.changes ?? []).map(change => change.item_id))
+        item_ids.forEach(item_id => queryClient.refetchQueries({ queryKey: ['history_for', { id: item_id }] }))
+    } else if (message && (message.topic.match("location_state/update") || message.topic.match("location_state/corrected"))) {
         console.log("update received on ", message.topic)
         queryClient.refetchQueries({ queryKey: ["state"] })
         queryClient.refetchQueries({ queryKey: ["state_at", { id: message?.payload?.location_link }] })
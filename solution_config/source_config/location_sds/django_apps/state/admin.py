@@ -1,19 +1,60 @@
 from django.contrib import admin
 from . import models
+from . import versions
+from . import event_handler as state_event_handler
 # from adminsortable.admin import SortableAdmin
+import contextlib
 import datetime
 import time
 
+class VersionedAdmin(admin.ModelAdmin):
+    # edits change what the views show without the event handler's version bumps
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        versions.bump_all()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        versions.bump_all()
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        versions.bump_all()
+
 @admin.register(models.State)
-class StateAdmin(admin.ModelAdmin):
+class StateAdmin(VersionedAdmin):
     list_display = ['record_id','item_id','location_link','start','end','quantity']
     fields = ('record_id','item_id','location_link','start','end','quantity')
     readonly_fields = ('record_id',)
     list_filter = ['location_link']
     ordering = ['item_id']
 
+    # an edit can change the history that snapshots were taken of
+    def save_model(self, request, obj, form, change):
+        with recounting([obj.item_id, form.initial.get("item_id")]):
+            super().save_model(request, obj, form, change)
+        models.StateSnapshot.objects.all().delete()
+
+    def delete_model(self, request, obj):
+        with recounting([obj.item_id]):
+            super().delete_model(request, obj)
+        models.StateSnapshot.objects.all().delete()
+
+    def delete_queryset(self, request, queryset):
+        with recounting(queryset.values_list("item_id", flat=True)):
+            super().delete_queryset(request, queryset)
+        models.StateSnapshot.objects.all().delete()
+
+
+def recounting(item_ids):
+    # the rollups of the items' states, if kept, are taken off and added back after
+    rollups = state_event_handler.rollups
+    if rollups is None:
+        return contextlib.nullcontext()
+    return rollups.recounting([item_id for item_id in item_ids if item_id])
+
 @admin.register(models.TransferEvent)
-class TransferEventAdmin(admin.ModelAdmin):
+class TransferEventAdmin(VersionedAdmin):
     list_display = ['event_id','item_id','from_location_link','to_location_link','timestamp','quantity']
     fields = ('event_id','item_id','from_location_link','to_location_link','timestamp','quantity')
     readonly_fields = ('event_id',)
@@ -27,7 +68,7 @@ class InputsInline(admin.TabularInline):
 
 
 @admin.register(models.ProductionEvent)
-class ProductionEventAdmin(admin.ModelAdmin):
+class ProductionEventAdmin(VersionedAdmin):
     list_display = [
         "event_id",
         "item_id",
@@ -53,6 +94,19 @@ class SettingAdmin(admin.ModelAdmin):
     fields = ('key','value')
     ordering = ['key']
 
+    # settings filter what /state/ shows - a global version bump
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        versions.bump()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        versions.bump()
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        versions.bump()
+
 from .admin_form import StatusForm
 
 @admin.register(models.Status)
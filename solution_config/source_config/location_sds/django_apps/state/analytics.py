@@ -0,0 +1,248 @@
+"""
+Dwell-time and lead-time analytics over State intervals, for /report/dwell and
+/report/lead_time.
+
+The intervals of a window are read once into NumPy arrays - an interned code for the
+item and the location of each, and int64 microseconds since the epoch for its start and
+end - and the statistics are computed in a few vectorized passes over them: percentiles
+of every location at once from one sort, and their histograms and averages from the
+sorted values. Only individually tracked items are counted - a collection's states are
+replaced whenever its quantity changes, so their lengths aren't dwell times. A window
+reaching back before the archive horizon reads ArchivedState as well.
+
+NumPy is optional - without it the report endpoints answer 501.
+"""
+
+from array import array
+from django.db.models import Q
+import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from . import archive
+from .models import State
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MICROSECOND = datetime.timedelta(microseconds=1)
+OPEN = 2**63 - 1  # the end of a state that is still open
+CHUNK_SIZE = 10000
+DEFAULT_WINDOW = datetime.timedelta(days=7)
+
+DEFAULT_PERCENTILES = (50, 90, 99)
+# histogram bin edges in seconds - the last bin, from 3 days, is open ended
+DEFAULT_BINS = (0, 60, 300, 900, 1800, 3600, 4 * 3600, 8 * 3600, 86400, 3 * 86400)
+
+
+def epoch_us(timestamp):
+    return (timestamp - EPOCH) // MICROSECOND
+
+
+class Intervals:
+    """
+    State intervals as arrays - item[i] and location[i] index items and locations,
+    start[i] and end[i] are microseconds since the epoch, end[i] OPEN if still open
+    """
+
+    def __init__(self, items, locations, item, location, start, end):
+        self.items = items
+        self.locations = locations
+        self.item = item
+        self.location = location
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return len(self.start)
+
+    @classmethod
+    def load(cls, *querysets):
+        """
+        Reads the intervals of State querysets - or ArchivedState ones, None for none -
+        a chunk of rows at a time
+        """
+        items, locations = {}, {}
+        item, location = array("i"), array("i")
+        start, end = array("q"), array("q")
+        for queryset in querysets:
+            if queryset is None:
+                continue
+            rows = queryset.values_list("item_id", "location_link", "start", "end")
+            for item_id, location_link, row_start, row_end in rows.iterator(
+                chunk_size=CHUNK_SIZE
+            ):
+                item.append(items.setdefault(item_id, len(items)))
+                location.append(locations.setdefault(location_link, len(locations)))
+                start.append((row_start - EPOCH) // MICROSECOND)
+                end.append(
+                    OPEN if row_end is None else (row_end - EPOCH) // MICROSECOND
+                )
+        return cls(
+            list(items),
+            list(locations),
+            np.frombuffer(item, dtype=np.int32),
+            np.frombuffer(location, dtype=np.int32),
+            np.frombuffer(start, dtype=np.int64),
+            np.frombuffer(end, dtype=np.int64),
+        )
+
+
+def grouped(groups, values, count):
+    """
+    The values sorted by group, then by value, and the number in each of count groups -
+    values are integers, microseconds
+    """
+    sizes = np.bincount(groups, minlength=count)
+    if not len(values):
+        return values, sizes
+    low, span = int(values.min()), int(values.max()) - int(values.min()) + 1
+    if count * span >= 2**63:
+        return values[np.lexsort((values, groups))], sizes
+    # one sort of group * span + value - far quicker than an indirect sort on two keys
+    keys = groups.astype(np.int64) * span + (values - low)
+    keys.sort()
+    keys -= np.repeat(np.arange(count, dtype=np.int64) * span - low, sizes)
+    return keys, sizes
+
+
+def group_percentiles(values, sizes, percentiles):
+    """
+    The percentiles of each group of values sorted by grouped(), interpolated linearly
+    as numpy.percentile does - an array of shape (groups, len(percentiles)), NaN for
+    groups without values
+    """
+    firsts = np.cumsum(sizes) - sizes
+    result = np.full((len(sizes), len(percentiles)), np.nan)
+    present = sizes > 0
+    for column, percentile in enumerate(percentiles):
+        # within each group, so a group's result doesn't depend on where it is
+        position = (sizes[present] - 1) * (percentile / 100)
+        offset = np.floor(position)
+        fraction = position - offset
+        low = firsts[present] + offset.astype(np.int64)
+        high = firsts[present] + np.ceil(position).astype(np.int64)
+        result[present, column] = values[low] + (values[high] - values[low]) * fraction
+    return result
+
+
+def group_histograms(values, sizes, edges):
+    """
+    Counts of each group of values sorted by grouped() in the bins starting at edges,
+    the last one open ended - an array of shape (groups, len(edges))
+    """
+    edges = np.asarray(edges)
+    ends = np.cumsum(sizes)
+    counts = np.zeros((len(sizes), len(edges)), dtype=np.int64)
+    for group in np.flatnonzero(sizes):
+        # a group is sorted, so where the edges fall in it bounds its bins
+        first = ends[group] - sizes[group]
+        bounds = np.searchsorted(values[first : ends[group]], edges)
+        counts[group] = np.diff(bounds, append=sizes[group])
+    return counts
+
+
+def statistics(names, groups, values, percentiles, edges):
+    """
+    The count, mean, percentiles and histogram - edges in seconds - of the values of
+    each group with any, by the group's name. The values are microseconds, the results
+    seconds.
+    """
+    ordered, sizes = grouped(groups, values, len(names))
+    present = sizes > 0
+    sums = np.zeros(len(names))
+    sums[present] = np.add.reduceat(ordered, (np.cumsum(sizes) - sizes)[present])
+    quantiles = group_percentiles(ordered, sizes, percentiles) / 1e6
+    histograms = group_histograms(ordered, sizes, [edge * 1_000_000 for edge in edges])
+    return {
+        names[code]: {
+            "count": int(sizes[code]),
+            "mean": float(sums[code] / sizes[code] / 1e6),
+            "percentiles": {
+                f"{percentile:g}": float(value)
+                for percentile, value in zip(percentiles, quantiles[code])
+            },
+            "histogram": {
+                "edges": list(edges),
+                "counts": histograms[code].tolist(),
+            },
+        }
+        for code in range(len(names))
+        if sizes[code]
+    }
+
+
+def dwell_times(
+    start, end, location_links=None, percentiles=DEFAULT_PERCENTILES, edges=DEFAULT_BINS
+):
+    """
+    Statistics per location of how long items stayed there, in seconds, over the
+    states that ended between start and end
+    """
+    q = Q(end__gte=start, end__lte=end, quantity__isnull=True)
+    if location_links:
+        q &= Q(location_link__in=location_links)
+    intervals = Intervals.load(
+        State.objects.filter(q), archive.archived(State, q, start)
+    )
+    if not len(intervals):
+        return []
+
+    by_location = statistics(
+        intervals.locations,
+        intervals.location,
+        intervals.end - intervals.start,
+        percentiles,
+        edges,
+    )
+    return [
+        {"location_link": location_link, **by_location[location_link]}
+        for location_link in sorted(by_location)
+    ]
+
+
+def lead_times(
+    start, end, completed_location, percentiles=DEFAULT_PERCENTILES, edges=DEFAULT_BINS
+):
+    """
+    Statistics of the seconds from each item's first state to its first arrival at
+    completed_location, over the items whose first arrival there was between start
+    and end - an item back there again in the window counts from its first arrival
+    """
+    q = Q(
+        location_link=completed_location,
+        start__gte=start,
+        start__lte=end,
+        quantity__isnull=True,
+    )
+    # the whole history of the items that arrived, for their first states
+    arrived_q = Q(item_id__in=State.objects.filter(q).values("item_id"))
+    archived = archive.archived(State, q, start)
+    if archived is not None:
+        arrived_q |= Q(item_id__in=archived.values("item_id"))
+    history_q = arrived_q & Q(quantity__isnull=True)
+    intervals = Intervals.load(
+        State.objects.filter(history_q), archive.archived(State, history_q, None)
+    )
+    if completed_location not in intervals.locations:
+        return {"completed_location": completed_location, "count": 0}
+
+    count = len(intervals.items)
+    first = np.full(count, OPEN, dtype=np.int64)
+    np.minimum.at(first, intervals.item, intervals.start)
+
+    # over the whole history, so that an earlier arrival before the window is found
+    arrived = intervals.location == intervals.locations.index(completed_location)
+    arrival = np.full(count, OPEN, dtype=np.int64)
+    np.minimum.at(arrival, intervals.item[arrived], intervals.start[arrived])
+
+    done = (arrival >= epoch_us(start)) & (arrival <= epoch_us(end))
+    by_location = statistics(
+        [completed_location],
+        np.zeros(done.sum(), dtype=np.int32),
+        arrival[done] - first[done],
+        percentiles,
+        edges,
+    )
+    return {"completed_location": completed_location, **by_location[completed_location]}
@@ -1,5 +1,5 @@
 from django.apps import AppConfig
-from django.db.models.signals import post_init, post_migrate
+from django.db.models.signals import post_init, post_migrate, post_save, post_delete
 
 
 class StateConfig(AppConfig):
@@ -9,6 +9,48 @@ class StateConfig(AppConfig):
         post_migrate.connect(create_default_settings, sender=self)
         post_migrate.connect(create_default_statuses, sender=self)
 
+        from .models import Setting, State
+
+        post_save.connect(invalidate_open_state_index, sender=State)
+        post_delete.connect(invalidate_open_state_index, sender=State)
+        post_save.connect(save_current_state, sender=State)
+        post_delete.connect(delete_current_state, sender=State)
+        post_save.connect(settings_changed, sender=Setting)
+        post_delete.connect(settings_changed, sender=Setting)
+
+
+def invalidate_open_state_index(sender, instance, **kwargs):
+    from .open_state_index import open_state_index
+
+    # the event handler writes its own changes through on commit
+    open_state_index.invalidate(instance.item_id)
+
+
+def settings_changed(sender, instance, **kwargs):
+    from . import event_handler
+
+    # from the settings view, the admin or anywhere else
+    if event_handler.settings_cache is not None:
+        event_handler.settings_cache.changed()
+
+
+def save_current_state(sender, instance, created, **kwargs):
+    from .models import CurrentState
+    from .store import current_state_for
+
+    if instance.end is not None:
+        CurrentState.objects.filter(record_id=instance.pk).delete()
+    elif created:
+        current_state_for(instance).save(force_insert=True)
+    else:
+        current_state_for(instance).save()
+
+
+def delete_current_state(sender, instance, **kwargs):
+    from .models import CurrentState
+
+    CurrentState.objects.filter(record_id=instance.pk).delete()
+
 
 def create_default_settings(sender, **kwargs):
     from .models import Setting
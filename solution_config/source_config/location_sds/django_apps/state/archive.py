@@ -0,0 +1,313 @@
+"""
+Archival of old history - closed State rows and events - into archive tables.
+
+The archive_history command moves the State rows that closed, and the events that
+happened, before a horizon some age ago to ArchivedState, ArchivedTransferEvent and
+ArchivedProductionEvent (with ArchivedProductionEventInput), keeping their primary keys,
+so the indexes the handler and the views use every day only cover recent rows. Rows are
+moved a batch per transaction, and each table's ArchiveCheckpoint records the horizon of
+its run and the last primary key moved - an interrupted run resumes from there with the
+same horizon.
+
+Reads whose window starts before a table's horizon - or has no start - merge its
+archived rows with the hot ones in the same order. The late event check asks the archive
+too about an event from before the horizon, and such an event first brings back the
+archived rows of its items from its timestamp on, so reprojection sees their whole
+timeline; the next run moves them again.
+"""
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+import datetime
+
+from .models import (
+    ArchiveCheckpoint,
+    ArchivedProductionEvent,
+    ArchivedProductionEventInput,
+    ArchivedState,
+    ArchivedTransferEvent,
+    ProductionEvent,
+    ProductionEventInput,
+    State,
+    TransferEvent,
+)
+from .store import lock_items
+
+ARCHIVE_OF = {
+    State: ArchivedState,
+    TransferEvent: ArchivedTransferEvent,
+    ProductionEvent: ArchivedProductionEvent,
+    ProductionEventInput: ArchivedProductionEventInput,
+}
+
+# the checkpoint of each model's rows - inputs move with their production events
+CHECKPOINT_KEYS = {
+    State: "state",
+    TransferEvent: "transfer",
+    ProductionEvent: "production",
+    ProductionEventInput: "production",
+}
+
+
+def horizons():
+    """checkpoint key -> the time before which rows may be in the archive"""
+    return dict(ArchiveCheckpoint.objects.values_list("key", "before"))
+
+
+def extend_horizon(key, before):
+    """
+    Moves the horizon of key's rows on to before, if it is earlier, for rows moved to
+    the archive other than by HistoryArchive.run()
+    """
+    with transaction.atomic():
+        checkpoint = (
+            ArchiveCheckpoint.objects.select_for_update().filter(key=key).first()
+        )
+        if checkpoint is None:
+            ArchiveCheckpoint.objects.create(key=key, before=before, finished=True)
+        elif checkpoint.before < before:
+            checkpoint.before = before
+            checkpoint.save(update_fields=["before"])
+
+
+def archived(model, q, start, horizon=None):
+    """
+    The rows of model's archive matching q if a window starting at start (None for the
+    whole history) reaches before its horizon, otherwise None
+    """
+    if horizon is None:
+        horizon = horizons().get(CHECKPOINT_KEYS[model])
+    if horizon is None or (start is not None and start >= horizon):
+        return None
+    return ARCHIVE_OF[model].objects.filter(q)
+
+
+def move(*moves):
+    """
+    Moves the rows of each (queryset, target) to target, a model with the same columns.
+    They are all copied, in order, before any are deleted, in reverse order, so foreign
+    keys hold throughout. Raw statements - a queryset delete would load every row to
+    send signals. Returns the number of rows of each moved.
+    """
+    quote = connection.ops.quote_name
+    statements = []
+    for queryset, target in moves:
+        model = queryset.model
+        columns = ", ".join(
+            quote(field.column) for field in model._meta.concrete_fields
+        )
+        table = quote(model._meta.db_table)
+        pk = quote(model._meta.pk.column)
+        sql, params = queryset.values("pk").query.sql_with_params()
+        where = f"{pk} IN ({sql})"
+        statements.append(
+            (
+                f"INSERT INTO {quote(target._meta.db_table)} ({columns}) "
+                f"SELECT {columns} FROM {table} WHERE {where}",
+                f"DELETE FROM {table} WHERE {where}",
+                params,
+            )
+        )
+
+    counts = []
+    with connection.cursor() as cursor:
+        for insert, delete, params in statements:
+            cursor.execute(insert, params)
+            counts.append(cursor.rowcount)
+        for insert, delete, params in reversed(statements):
+            cursor.execute(delete, params)
+    return counts
+
+
+def restore(item_ids, since):
+    """
+    Brings the archived rows of items that the reprojection of their timelines from
+    since would read or change back to the hot tables. The items must be locked.
+    """
+    found = horizons()
+    item_ids = list(item_ids)
+    moves = []
+    if "state" in found and since < found["state"]:
+        states = ArchivedState.objects.filter(item_id__in=item_ids, end__gte=since)
+        moves.append((states, State))
+    if "transfer" in found and since < found["transfer"]:
+        transfers = ArchivedTransferEvent.objects.filter(
+            item_id__in=item_ids, timestamp__gte=since
+        )
+        moves.append((transfers, TransferEvent))
+    if "production" in found and since < found["production"]:
+        # the events that produced the items or consumed them, with all their inputs
+        event_ids = list(
+            ArchivedProductionEvent.objects.filter(
+                Q(item_id__in=item_ids)
+                | Q(
+                    event_id__in=ArchivedProductionEventInput.objects.filter(
+                        item_id__in=item_ids
+                    ).values("production_event_id")
+                ),
+                timestamp__gte=since,
+            ).values_list("event_id", flat=True)
+        )
+        if event_ids:
+            moves.append(
+                (
+                    ArchivedProductionEvent.objects.filter(event_id__in=event_ids),
+                    ProductionEvent,
+                )
+            )
+            moves.append(
+                (
+                    ArchivedProductionEventInput.objects.filter(
+                        production_event_id__in=event_ids
+                    ),
+                    ProductionEventInput,
+                )
+            )
+    if moves:
+        restored = move(*moves)
+        print(f"restored {sum(restored)} archived rows of {item_ids} from {since}")
+
+
+class HistoryArchive:
+    """Moves rows older than age seconds to the archive, batch_size at a time"""
+
+    def __init__(self, age, batch_size=1000):
+        self.age = age
+        self.batch_size = batch_size
+
+    def horizon(self, now=None):
+        return (now or timezone.now()) - datetime.timedelta(seconds=self.age)
+
+    def event_after(self, item_id, timestamp):
+        """Whether an archived event of the item happened after timestamp"""
+        found = self.__horizons_after(timestamp)
+        return any(
+            ARCHIVE_OF[model]
+            .objects.filter(item_id=item_id, timestamp__gt=timestamp)
+            .exists()
+            for model in (TransferEvent, ProductionEvent, ProductionEventInput)
+            if CHECKPOINT_KEYS[model] in found
+        )
+
+    def state_ended_after(self, item_id, location_link, timestamp):
+        """Whether an archived state of the item at location_link ended after timestamp"""
+        return (
+            "state" in self.__horizons_after(timestamp)
+            and ArchivedState.objects.filter(
+                item_id=item_id, location_link=location_link, end__gt=timestamp
+            ).exists()
+        )
+
+    def __horizons_after(self, timestamp):
+        # the horizon of a run now is the latest any run has had, so the rows of a
+        # recent timestamp - most of them - can't have been archived
+        if timestamp >= self.horizon():
+            return {}
+        return {key: before for key, before in horizons().items() if timestamp < before}
+
+    def checkpoint(self, key, now=None, restart=False):
+        """
+        The checkpoint of key's current run - the unfinished one, unless restart,
+        otherwise a new one up to the horizon
+        """
+        checkpoint = ArchiveCheckpoint.objects.filter(key=key).first()
+        if checkpoint is not None and not checkpoint.finished and not restart:
+            return checkpoint
+        before = self.horizon(now)
+        if checkpoint is not None:
+            # never move the horizon back - reads would miss what is archived
+            before = max(before, checkpoint.before)
+        checkpoint = ArchiveCheckpoint(key=key, before=before)
+        checkpoint.save()
+        return checkpoint
+
+    def run(self, now=None, restart=False):
+        """Archives every table up to the horizon, yielding (key, moved) per batch"""
+        for key, batch in (
+            ("state", self.state_batch),
+            ("transfer", self.transfer_batch),
+            ("production", self.production_batch),
+        ):
+            checkpoint = self.checkpoint(key, now, restart)
+            while True:
+                with transaction.atomic():
+                    checkpoint.refresh_from_db()
+                    moved = batch(checkpoint)
+                    if moved is None:
+                        checkpoint.finished = True
+                    checkpoint.save()
+                if moved is None:
+                    break
+                yield key, moved
+
+    def next_batch(self, checkpoint, queryset, time_field, *item_fields):
+        """
+        The primary keys and items of the next batch of rows of queryset older than the
+        checkpoint's horizon, after its last_id - None if there are none left
+        """
+        rows = list(
+            queryset.filter(
+                **{f"{time_field}__lt": checkpoint.before, "pk__gt": checkpoint.last_id}
+            )
+            .order_by("pk")
+            .values_list("pk", *item_fields)[: self.batch_size]
+        )
+        if not rows:
+            return None
+        checkpoint.last_id = rows[-1][0]
+        return [row[0] for row in rows], {item for row in rows for item in row[1:]}
+
+    def state_batch(self, checkpoint):
+        batch = self.next_batch(checkpoint, State.objects.all(), "end", "item_id")
+        if batch is None:
+            return None
+        record_ids, item_ids = batch
+        # as the handler's writers, so a late event can't restore the items meanwhile
+        lock_items(item_ids)
+        (moved,) = move(
+            (
+                State.objects.filter(
+                    record_id__in=record_ids, end__lt=checkpoint.before
+                ),
+                ArchivedState,
+            )
+        )
+        checkpoint.moved += moved
+        return moved
+
+    def transfer_batch(self, checkpoint):
+        batch = self.next_batch(
+            checkpoint, TransferEvent.objects.all(), "timestamp", "item_id"
+        )
+        if batch is None:
+            return None
+        event_ids, item_ids = batch
+        lock_items(item_ids)
+        (moved,) = move(
+            (
+                TransferEvent.objects.filter(event_id__in=event_ids),
+                ArchivedTransferEvent,
+            )
+        )
+        checkpoint.moved += moved
+        return moved
+
+    def production_batch(self, checkpoint):
+        batch = self.next_batch(
+            checkpoint, ProductionEvent.objects.all(), "timestamp", "item_id"
+        )
+        if batch is None:
+            return None
+        event_ids, item_ids = batch
+        inputs = ProductionEventInput.objects.filter(production_event_id__in=event_ids)
+        lock_items(item_ids | set(inputs.values_list("item_id", flat=True)))
+        moved, _ = move(
+            (
+                ProductionEvent.objects.filter(event_id__in=event_ids),
+                ArchivedProductionEvent,
+            ),
+            (inputs, ArchivedProductionEventInput),
+        )
+        checkpoint.moved += moved
+        return moved
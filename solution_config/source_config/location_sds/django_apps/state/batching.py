@@ -0,0 +1,58 @@
+from django.db import close_old_connections
+import threading
+import time
+import traceback
+
+
+class MessageBatcher:
+    """
+    Collects messages into windows of at most max_size messages or max_wait seconds
+    (measured from the first message in the window) and passes each window, in arrival
+    order, to apply_fn on a single background thread.
+    """
+
+    def __init__(self, apply_fn, max_size=200, max_wait=0.05):
+        self.apply_fn = apply_fn
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._pending = []
+        self._deadline = None
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def submit(self, message):
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self.__run, name="state-batcher", daemon=True
+                )
+                self._thread.start()
+            if not self._pending:
+                self._deadline = time.monotonic() + self.max_wait
+            self._pending.append(message)
+            self._condition.notify()
+
+    def __next_window(self):
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+            while len(self._pending) < self.max_size:
+                remaining = self._deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            window = self._pending[: self.max_size]
+            del self._pending[: self.max_size]
+            self._deadline = time.monotonic()  # anything left over is already due
+            return window
+
+    def __run(self):
+        while True:
+            window = self.__next_window()
+            close_old_connections()
+            try:
+                self.apply_fn(window)
+            except Exception:
+                print("ERROR")
+                print(traceback.format_exc())
@@ -0,0 +1,283 @@
+"""
+Helpers shared by the bench_* management commands. Benchmarks run against a throwaway
+database created from the migrations, never against live data.
+"""
+
+from contextlib import contextmanager, redirect_stdout
+from django.db import connection, connections
+import datetime
+import io
+import os
+import random
+import tempfile
+
+from event_handler import Event
+from . import event_handler as state_event_handler
+from .models import (
+    ArchiveCheckpoint,
+    ArchivedProductionEvent,
+    ArchivedProductionEventInput,
+    ArchivedState,
+    ArchivedTransferEvent,
+    State,
+    StateSnapshot,
+    TransferEvent,
+    ProductionEvent,
+    ProductionEventInput,
+    ProcessedMessage,
+)
+from .open_state_index import open_state_index
+
+T0 = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+@contextmanager
+def scratch_database(sqlite=False):
+    """
+    A throwaway database next to the default one - or a SQLite file whatever the
+    default database is, if sqlite is set.
+    """
+    if sqlite and connection.vendor != "sqlite":
+        with sqlite_default_database():
+            with scratch_database():
+                yield
+        return
+
+    old_name = connection.settings_dict["NAME"]
+    if connection.vendor == "sqlite":
+        # a file rather than Django's default shared in-memory database, which locks whole
+        # tables and so behaves nothing like a deployment under concurrent writers
+        test_settings = connection.settings_dict.setdefault("TEST", {})
+        test_settings["NAME"] = os.path.join(tempfile.mkdtemp(), "bench.sqlite3")
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+@contextmanager
+def sqlite_default_database():
+    """Points the default alias - in every thread - at a SQLite database"""
+    connections.close_all()
+    saved = connections.settings["default"]
+    connections.settings["default"] = connections.configure_settings(
+        {
+            "default": {
+                "ENGINE": "django.db.backends.sqlite3",
+                "NAME": os.path.join(tempfile.mkdtemp(), "db.sqlite3"),
+            }
+        }
+    )["default"]
+    connections["default"] = connections.create_connection("default")
+    try:
+        yield
+    finally:
+        connections.close_all()
+        connections.settings["default"] = saved
+        connections["default"] = connections.create_connection("default")
+
+
+def database_size():
+    """Bytes used by the current database"""
+    if connection.vendor == "sqlite":
+        name = connection.settings_dict["NAME"]
+        return sum(
+            os.path.getsize(path)
+            for path in (name, f"{name}-wal")
+            if os.path.exists(path)
+        )
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute("SELECT pg_database_size(current_database())")
+            return cursor.fetchone()[0]
+    return None
+
+
+class QueryCounter:
+    """Counts the SQL queries run on this thread's connection while installed"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[round(fraction * (len(ordered) - 1))] if ordered else None
+
+
+def clear_tables():
+    for model in (
+        ProductionEventInput,
+        ProductionEvent,
+        TransferEvent,
+        State,
+        StateSnapshot,
+        ProcessedMessage,
+        ArchivedProductionEventInput,
+        ArchivedProductionEvent,
+        ArchivedTransferEvent,
+        ArchivedState,
+        ArchiveCheckpoint,
+    ):
+        model.objects.all().delete()
+    open_state_index.invalidate()
+    if state_event_handler.deduplicator is not None:
+        state_event_handler.deduplicator.clear()
+
+
+@contextmanager
+def quiet_handler():
+    """Silences the handler's prints and collects what it would publish"""
+    published = []
+    send_events = state_event_handler.send_events
+    state_event_handler.send_events = published.extend
+    try:
+        with redirect_stdout(io.StringIO()):
+            yield published
+    finally:
+        state_event_handler.send_events = send_events
+
+
+def timestamp(step):
+    return (T0 + datetime.timedelta(milliseconds=step)).isoformat()
+
+
+def individual_transfers(count, items, locations, seed=0):
+    """count moves of `items` individual products between `locations` locations"""
+    rng = random.Random(seed)
+    return [
+        Event(
+            f"transfer_operation/loc@{loc}",
+            {
+                "timestamp": timestamp(step),
+                "item": f"product@{rng.randrange(items)}",
+                "to_loc": f"loc@{loc}",
+            },
+        )
+        for step, loc in ((step, rng.randrange(locations)) for step in range(count))
+    ]
+
+
+def collection_transfers(count, items, locations, seed=0):
+    """count transfers of quantities of `items` product types between locations"""
+    rng = random.Random(seed)
+    messages = []
+    for step in range(count):
+        to_loc, from_loc = rng.sample(range(locations), 2)
+        messages.append(
+            Event(
+                f"transfer_operation/loc@{to_loc}/loc@{from_loc}",
+                {
+                    "timestamp": timestamp(step),
+                    "item": f"prodtype@{rng.randrange(items)}",
+                    "quantity": rng.randint(1, 10),
+                    "to_loc": f"loc@{to_loc}",
+                    "from_loc": f"loc@{from_loc}",
+                },
+            )
+        )
+    return messages
+
+
+def production_events(count, inputs, locations, seed=0):
+    """count production events that each consume `inputs` items - half of them collections"""
+    rng = random.Random(seed)
+    messages = []
+    for step in range(count):
+        loc = rng.randrange(locations)
+        messages.append(
+            Event(
+                f"production_operation/loc@{loc}",
+                {
+                    "timestamp": timestamp(step),
+                    "item": f"product@p{step}",
+                    "loc": f"loc@{loc}",
+                    "inputs": [
+                        (
+                            {"item": f"prodtype@{n}", "quantity": 1}
+                            if n % 2
+                            else {"item": f"product@i{step}-{n}"}
+                        )
+                        for n in range(inputs)
+                    ],
+                },
+            )
+        )
+    return messages
+
+
+def transfer_events(count, items, locations, seed=0):
+    """count TransferEvent rows a second apart, a quarter of them without a from location"""
+    rng = random.Random(seed)
+    return [
+        TransferEvent(
+            item_id=f"product@{rng.randrange(items)}",
+            from_location_link=f"loc@{rng.randrange(locations)}" if step % 4 else None,
+            to_location_link=f"loc@{rng.randrange(locations)}",
+            timestamp=T0 + datetime.timedelta(seconds=step),
+        )
+        for step in range(count)
+    ]
+
+
+def production_rows(count, inputs, items, locations, seed=0):
+    """
+    (ProductionEvent, [ProductionEventInput]) pairs a second apart, each consuming
+    `inputs` items at its location - the inputs' production_event is left to be set
+    once the events are saved
+    """
+    rng = random.Random(seed)
+    rows = []
+    for step in range(count):
+        loc = f"loc@{rng.randrange(locations)}"
+        at = T0 + datetime.timedelta(seconds=step)
+        event = ProductionEvent(
+            item_id=f"product@p{step}",
+            from_location_link=f"loc@{rng.randrange(locations)}" if step % 4 else None,
+            location_link=loc,
+            timestamp=at,
+        )
+        event_inputs = [
+            ProductionEventInput(
+                item_id=f"product@{rng.randrange(items)}",
+                location_link=loc,
+                timestamp=at,
+            )
+            for _ in range(inputs)
+        ]
+        rows.append((event, event_inputs))
+    return rows
+
+
+def state_history(items, moves, locations, seed=0):
+    """
+    State rows of `items` individual products each moving `moves` times between
+    `locations` locations, a minute to an hour apart - the last state left open
+    """
+    rng = random.Random(seed)
+    states = []
+    for n in range(items):
+        start = T0 + datetime.timedelta(seconds=rng.uniform(0, 3600))
+        for move in range(moves):
+            end = start + datetime.timedelta(seconds=rng.uniform(60, 3600))
+            states.append(
+                State(
+                    item_id=f"product@{n}",
+                    location_link=f"loc@{rng.randrange(locations)}",
+                    start=start,
+                    end=end if move < moves - 1 else None,
+                )
+            )
+            start = end
+    return states
+
+
+def handler_for(msg: Event):
+    if msg.topic.startswith("production_operation"):
+        return state_event_handler.handle_prod_op_message
+    return state_event_handler.handle_transfer_op_message
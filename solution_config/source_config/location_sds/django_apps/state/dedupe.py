@@ -0,0 +1,157 @@
+from collections import OrderedDict
+from django.db import transaction
+import datetime
+import hashlib
+import threading
+import time
+
+from .models import ProcessedMessage, TransferEvent
+from .store import BULK_BATCH_SIZE
+
+
+def primary_event(operation):
+    """The TransferEvent or ProductionEvent of an operation"""
+    return operation if isinstance(operation, TransferEvent) else operation[0]
+
+
+def fingerprint(operation):
+    """
+    Identifies an operation by (topic, item, locations, quantity, timestamp) - production
+    operations also include their inputs. Cached on the event, so it is unaffected by
+    the fields processing fills in.
+    """
+    event = primary_event(operation)
+    if getattr(event, "_fingerprint", None) is None:
+        if isinstance(operation, TransferEvent):
+            parts = [
+                "transfer_operation",
+                event.item_id,
+                event.from_location_link,
+                event.to_location_link,
+                event.quantity,
+            ]
+        else:
+            parts = [
+                "production_operation",
+                event.item_id,
+                event.location_link,
+                event.quantity,
+                *sorted(
+                    f"{input.item_id}:{input.location_link}:{input.quantity}"
+                    for input in operation[1]
+                ),
+            ]
+        parts.append(event.timestamp.astimezone(datetime.timezone.utc).isoformat())
+        event._fingerprint = hashlib.sha1("|".join(map(str, parts)).encode()).hexdigest()
+    return event._fingerprint
+
+
+class MessageDeduplicator:
+    """
+    Drops redelivered operations seen within the last `window` seconds.
+
+    An in-memory LRU of up to max_entries recently committed fingerprints answers most
+    redeliveries without touching the database. Behind it, every accepted operation
+    claims its fingerprint in the ProcessedMessage table in the same transaction that
+    applies it, which catches redeliveries after a restart or to another consumer.
+    """
+
+    PRUNE_INTERVAL = 60  # seconds between deleting expired ProcessedMessage rows
+
+    def __init__(self, window=86400, max_entries=50000):
+        self.window = window
+        self.max_entries = max_entries
+        self._seen = OrderedDict()  # fingerprint -> time.monotonic() when committed
+        self._lock = threading.Lock()
+        self._last_prune = None
+        self.lru_hits = 0
+        self.db_hits = 0
+        self.accepted = 0
+
+    def recently_seen(self, fp):
+        with self._lock:
+            seen_at = self._seen.get(fp)
+            if seen_at is None:
+                return False
+            if time.monotonic() - seen_at > self.window:
+                del self._seen[fp]
+                return False
+            self._seen.move_to_end(fp)
+            self.lru_hits += 1
+            return True
+
+    def remember(self, fps):
+        now = time.monotonic()
+        with self._lock:
+            for fp in fps:
+                self._seen[fp] = now
+                self._seen.move_to_end(fp)
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._seen.clear()
+
+    def filter_new(self, operations):
+        """
+        Returns the operations that have not been processed before, dropping repeats
+        within the list, and claims their fingerprints. Must run inside the transaction
+        that applies them - a concurrent claim of the same fingerprint fails that
+        transaction with an IntegrityError and the retry then drops the operation.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.__prune(now)
+
+        by_fingerprint = {}
+        for operation in operations:
+            by_fingerprint.setdefault(fingerprint(operation), operation)
+
+        fps = list(by_fingerprint)
+        existing = set()
+        for offset in range(0, len(fps), BULK_BATCH_SIZE):
+            existing.update(
+                ProcessedMessage.objects.filter(
+                    fingerprint__in=fps[offset : offset + BULK_BATCH_SIZE]
+                ).values_list("fingerprint", flat=True)
+            )
+
+        new = [op for fp, op in by_fingerprint.items() if fp not in existing]
+        ProcessedMessage.objects.bulk_create(
+            [
+                ProcessedMessage(fingerprint=fp, received=now)
+                for fp in fps
+                if fp not in existing
+            ],
+            batch_size=BULK_BATCH_SIZE,
+        )
+
+        def committed():
+            self.remember(fps)
+            with self._lock:
+                self.db_hits += len(operations) - len(new)
+                self.accepted += len(new)
+
+        transaction.on_commit(committed)
+        return new
+
+    def __prune(self, now):
+        if self._last_prune and time.monotonic() - self._last_prune < self.PRUNE_INTERVAL:
+            return
+        self._last_prune = time.monotonic()
+        cutoff = now - datetime.timedelta(seconds=self.window)
+        ProcessedMessage.objects.filter(received__lt=cutoff).delete()
+
+    def stats(self):
+        with self._lock:
+            dropped = self.lru_hits + self.db_hits
+            total = dropped + self.accepted
+            return {
+                "window": self.window,
+                "lru_entries": len(self._seen),
+                "lru_hits": self.lru_hits,
+                "db_hits": self.db_hits,
+                "accepted": self.accepted,
+                "duplicate_rate": dropped / total if total else None,
+                "lru_hit_rate": self.lru_hits / dropped if dropped else None,
+            }
@@ -1,8 +1,25 @@
 from state.models import State, TransferEvent, ProductionEvent, ProductionEventInput
-from django.db import transaction
+from django.conf import settings as django_settings
+from django.db import transaction, IntegrityError, OperationalError
+from django.db.models import Q
 from . import mqtt_serializers as serializers
+from .archive import HistoryArchive, restore
+from .partitions import TablePartitions
+from .settings_cache import SettingsCache
+from .batching import MessageBatcher
+from .dedupe import MessageDeduplicator, fingerprint, primary_event
+from .lanes import LanePool
+from .mqtt_validators import drf_validated_data, fast_validated_data
+from .open_state_index import open_state_index
+from .publishing import EventPublisher
+from .response_cache import ResponseCache
+from .rollups import LocationRollups
+from .snapshots import StateSnapshots
+from .store import StateStore, lock_items, refresh_current_state
+from . import versions
+import time
 import traceback
-from event_handler import Event, EventHandler
+from event_handler import Event, EventHandler, send_events
 
 
 @EventHandler.register("transfer_operation")
@@ -10,26 +27,7 @@ def handle_transfer_op_message(msg: Event):
     print(f"handling: {msg}")
     # listen for incoming events
     try:
-        # validate
-        serializer = serializers.TransferOperation(data=msg.content)
-        serializer.is_valid(raise_exception=True)
-
-        # log event
-        event = TransferEvent(**serializer.validated_data)
-
-        if event.from_location_link == event.to_location_link:
-            return
-
-        # check item individual or collection?
-
-        if event.quantity is not None and event.from_location_link is not None:
-            output = transfer_collection(event)
-        else:
-            output = transfer_individual(event)
-
-        event.save()
-
-        return output
+        return ingest(parse_transfer_op, msg)
 
     except Exception as e:
         print("ERROR")
@@ -41,99 +39,495 @@ def handle_prod_op_message(msg: Event):
     print(f"handling: {msg}")
     # listen for incoming events
     try:
-        # validate
-        serializer = serializers.ProductionOperation(data=msg.content)
-        serializer.is_valid(raise_exception=True)
-
-        prod_event_data = {**serializer.validated_data}
-        prod_event_input_data = prod_event_data.pop("inputs", [])
-        prod_event = ProductionEvent(**prod_event_data)
-        print(prod_event_input_data)
-        prod_event_inputs = [
-            ProductionEventInput(
-                production_event=prod_event,
-                **{
-                    "location_link": prod_event.location_link,
-                    "timestamp": prod_event.timestamp,
-                    **entry,
-                },
+        return ingest(parse_prod_op, msg)
+
+    except Exception as e:
+        print("ERROR")
+        print(e)
+
+
+@EventHandler.register("state_settings")
+def handle_settings_message(msg: Event):
+    # a process - maybe this one - changed the settings
+    if settings_cache is not None:
+        settings_cache.invalidate()
+
+
+def ingest(parse_fn, msg: Event):
+    """
+    Routes a message according to the ingestion mode. Messages handled in the
+    background have their output published from there, so nothing is returned.
+    """
+    if batcher is not None:
+        batcher.submit((parse_fn, msg))
+        return
+
+    operation = parse_fn(msg)
+    if operation is None or is_redelivery(operation, msg):
+        return
+
+    if lanes is not None:
+        lanes.submit(touched_items([operation]), process_and_publish, operation)
+        return
+
+    return process_with_retry([operation])
+
+
+def is_redelivery(operation, msg: Event):
+    if deduplicator is None or not deduplicator.recently_seen(fingerprint(operation)):
+        return False
+    print(f"dropped redelivery: {msg}")
+    return True
+
+
+def parse_transfer_op(msg: Event):
+    # validate
+    validated_data = validate(serializers.TransferOperation, msg.content)
+
+    # log event
+    event = TransferEvent(**validated_data)
+
+    if event.from_location_link == event.to_location_link:
+        return None
+
+    return event
+
+
+def parse_prod_op(msg: Event):
+    # validate
+    validated_data = validate(serializers.ProductionOperation, msg.content)
+
+    prod_event_data = {**validated_data}
+    prod_event_input_data = prod_event_data.pop("inputs", [])
+    prod_event = ProductionEvent(**prod_event_data)
+    prod_event_inputs = [
+        ProductionEventInput(
+            production_event=prod_event,
+            **{
+                "location_link": prod_event.location_link,
+                "timestamp": prod_event.timestamp,
+                **entry,
+            },
+        )
+        for entry in prod_event_input_data
+    ]
+
+    return prod_event, prod_event_inputs
+
+
+## INGESTION
+# An operation is either a TransferEvent or a (ProductionEvent, [ProductionEventInput]) tuple
+
+
+def process_operations(operations, deferred=False):
+    """
+    Applies operations in order inside one transaction and logs their events.
+    Deferred processing loads the open states of every touched item up front and writes
+    all state changes with bulk queries at the end.
+    Returns the location_state events to publish, unless the publisher is handling them.
+    """
+    store = StateStore(
+        deferred=deferred, index=state_index, rollups=rollups, archive=history_archive
+    )
+    output_messages = []
+    with transaction.atomic():
+        item_ids = touched_items(operations)
+        lock_items(item_ids)
+        if deduplicator is not None:
+            operations = deduplicator.filter_new(operations)
+        if deferred:
+            store.preload(item_ids)
+
+        unsaved = []
+        for operation in operations:
+            if is_late(store, operation):
+                # store it with the rest of the timeline before replaying that
+                store.flush()
+                save_operations(unsaved + [operation])
+                unsaved = []
+                output_messages.extend(
+                    reproject_items(
+                        store,
+                        touched_items([operation]),
+                        primary_event(operation).timestamp,
+                    )
+                )
+                continue
+
+            if isinstance(operation, TransferEvent):
+                output_messages.extend(apply_transfer_op(store, operation))
+            else:
+                output_messages.extend(apply_prod_op(store, *operation))
+            store.applied(
+                touched_items([operation]), primary_event(operation).timestamp
+            )
+            unsaved.append(operation)
+
+        store.flush()
+        save_operations(unsaved)
+
+        if snapshots is not None and operations:
+            # a snapshot taken meanwhile waits for this to commit (see snapshots.py)
+            snapshots.invalidate(
+                min(primary_event(operation).timestamp for operation in operations)
+            )
+        if operations:
+            # made once this commits (see versions.py)
+            versions.bump(
+                touched_items(operations),
+                touched_locations(operations) | store.touched_locations,
             )
-            for entry in prod_event_input_data
-        ]
 
-        print(prod_event)
-        print(prod_event_inputs)
+        if publisher is not None:
+            publisher.publish(output_messages)
+            output_messages = []
 
-        # check item individual or collection?
-        if prod_event.quantity is not None:
-            output = production_collection(prod_event, prod_event_inputs)
+    return output_messages
+
+
+def process_with_retry(operations, deferred=False, retries=3):
+    """
+    Retries operations that lost a race with another writer - a locked SQLite database
+    or a second open state rejected by the State constraints. The retry re-reads the
+    winner's changes, and the operations' item order is unaffected.
+    """
+    reported = [
+        (event, event.from_location_link)
+        for event in map(primary_event, operations)
+    ]
+    for attempt in range(retries + 1):
+        try:
+            return process_operations(operations, deferred)
+        except (OperationalError, IntegrityError):
+            if attempt == retries:
+                raise
+            reset_operations(operations, reported)
+            time.sleep(0.05 * 2**attempt)
+
+
+def process_and_publish(operation):
+    output_messages = process_with_retry([operation])
+    if output_messages:
+        send_events(output_messages)
+
+
+def reset_operations(operations, reported):
+    # undo what the rolled back attempt filled in - primary keys and from locations
+    for event, from_location_link in reported:
+        event.pk = None
+        event.from_location_link = from_location_link
+    for operation in operations:
+        if not isinstance(operation, TransferEvent):
+            for input in operation[1]:
+                input.pk = None
+
+
+def touched_items(operations):
+    item_ids = set()
+    for operation in operations:
+        if isinstance(operation, TransferEvent):
+            item_ids.add(operation.item_id)
+        else:
+            prod_event, inputs = operation
+            item_ids.add(prod_event.item_id)
+            item_ids.update(input.item_id for input in inputs)
+    return item_ids
+
+
+def touched_locations(operations):
+    location_links = set()
+    for operation in operations:
+        if isinstance(operation, TransferEvent):
+            location_links.add(operation.to_location_link)
+            location_links.add(operation.from_location_link)
+        else:
+            prod_event, inputs = operation
+            location_links.add(prod_event.location_link)
+            location_links.add(prod_event.from_location_link)
+            location_links.update(input.location_link for input in inputs)
+    location_links.discard(None)
+    return location_links
+
+
+def save_operations(operations):
+    transfer_events = []
+    prod_events = []
+    prod_event_inputs = []
+    for operation in operations:
+        if isinstance(operation, TransferEvent):
+            transfer_events.append(operation)
         else:
-            output = production_individual(prod_event, prod_event_inputs)
+            prod_event, inputs = operation
+            prod_events.append(prod_event)
+            prod_event_inputs.extend(inputs)
+
+    TransferEvent.objects.bulk_create(transfer_events)
+    # production events get their primary keys here, before their inputs are written
+    ProductionEvent.objects.bulk_create(prod_events)
+    ProductionEventInput.objects.bulk_create(prod_event_inputs)
+
+
+def apply_batch(window):
+    """Applies a window of (parse_fn, msg) pairs from the batcher in one transaction"""
+    operations = []
+    for parse_fn, msg in window:
+        try:
+            operation = parse_fn(msg)
+            if operation is not None and not is_redelivery(operation, msg):
+                operations.append(operation)
+        except Exception as e:
+            print("ERROR")
+            print(f"{msg}: {e}")
+
+    if not operations:
+        return
 
-        prod_event.save()
-        for input in prod_event_inputs:
-            input.save()
+    try:
+        output_messages = process_with_retry(operations, deferred=True)
+    except Exception:
+        print("ERROR - window failed, applying its messages one by one")
+        print(traceback.format_exc())
+        output_messages = []
+        for parse_fn, msg in window:
+            try:
+                # re-parse - the failed attempt may have modified the parsed events
+                operation = parse_fn(msg)
+                if operation is not None and not is_redelivery(operation, msg):
+                    output_messages.extend(process_with_retry([operation]))
+            except Exception:
+                print("ERROR")
+                print(traceback.format_exc())
+
+    if output_messages:
+        send_events(output_messages)
+
+
+def __batcher_from_settings():
+    config = getattr(django_settings, "INGEST_BATCH", None)
+    if not config:
+        return None
+    return MessageBatcher(apply_batch, **config)
 
-        return output
 
-    except Exception as e:
-        print("ERROR")
-        print(e)
+def __lanes_from_settings():
+    config = getattr(django_settings, "INGEST_LANES", None)
+    if not config:
+        return None
+    return LanePool(**config)
+
+
+def __deduplicator_from_settings():
+    config = getattr(django_settings, "INGEST_DEDUPE", None)
+    if not config:
+        return None
+    return MessageDeduplicator(**config)
+
+
+def __publisher_from_settings():
+    config = getattr(django_settings, "PUBLISH_COALESCE", None)
+    if not config:
+        return None
+    return EventPublisher(lambda events: send_events(events), **config)
+
+
+def __validate_from_settings():
+    if getattr(django_settings, "FAST_MESSAGE_VALIDATION", False):
+        return fast_validated_data
+    return drf_validated_data
+
+
+def __snapshots_from_settings():
+    config = getattr(django_settings, "STATE_SNAPSHOTS", None)
+    if not config:
+        return None
+    return StateSnapshots(**config)
+
+
+def __response_cache_from_settings():
+    config = getattr(django_settings, "RESPONSE_CACHE", None)
+    if not config:
+        return None
+    if not versions.enabled():
+        print("WARNING: RESPONSE_CACHE needs STATE_VERSIONS - responses aren't cached")
+        return None
+    cache = ResponseCache(**config)
+    # evicts what a committed change - here or by the admin, a rebuild or a setting -
+    # made stale
+    versions.bumped.connect(cache.on_bumped, weak=False)
+    return cache
+
+
+def __rollups_from_settings():
+    config = getattr(django_settings, "LOCATION_ROLLUPS", None)
+    if not config:
+        return None
+    return LocationRollups(**config)
+
+
+def __history_archive_from_settings():
+    config = getattr(django_settings, "STATE_ARCHIVE", None)
+    if not config:
+        return None
+    return HistoryArchive(**config)
+
+
+def __table_partitions_from_settings():
+    config = getattr(django_settings, "STATE_PARTITIONS", None)
+    if not config:
+        return None
+    return TablePartitions(**config)
+
+
+def __settings_cache_from_settings():
+    config = getattr(django_settings, "SETTINGS_CACHE", None)
+    if not config:
+        return None
+    return SettingsCache(**config)
+
+
+validate = __validate_from_settings()
+batcher = __batcher_from_settings()
+lanes = __lanes_from_settings()
+deduplicator = __deduplicator_from_settings()
+publisher = __publisher_from_settings()
+snapshots = __snapshots_from_settings()
+response_cache = __response_cache_from_settings()
+rollups = __rollups_from_settings()
+history_archive = __history_archive_from_settings()
+table_partitions = __table_partitions_from_settings()
+settings_cache = __settings_cache_from_settings()
+
+
+def __state_index_from_settings():
+    if not getattr(django_settings, "OPEN_STATE_INDEX", False):
+        return None
+    if getattr(django_settings, "SHARED_SUBSCRIPTION_GROUP", None):
+        print("WARNING: OPEN_STATE_INDEX ignored - other consumers also write State")
+        return None
+    return open_state_index
+
+
+state_index = __state_index_from_settings()
+
 
+## OPERATIONS
 
-def transfer_collection(event: TransferEvent):
+
+def apply_transfer_op(store: StateStore, event: TransferEvent):
+    # check item individual or collection?
+    if event.quantity is not None and event.from_location_link is not None:
+        return transfer_collection(store, event)
+    else:
+        return transfer_individual(store, event)
+
+
+def apply_prod_op(
+    store: StateStore, event: ProductionEvent, inputs: list[ProductionEventInput]
+):
+    # check item individual or collection?
+    if event.quantity is not None:
+        return production_collection(store, event, inputs)
+    else:
+        return production_individual(store, event, inputs)
+
+
+def transfer_collection(store: StateStore, event: TransferEvent):
     output_messages = []
-    with transaction.atomic():
-        to_update_msg = __increase_collection(
-            event.item_id, event.to_location_link, event.quantity, event.timestamp
-        )
-        print(to_update_msg)
-        output_messages.append(to_update_msg)
+    to_update_msg = __increase_collection(
+        store, event.item_id, event.to_location_link, event.quantity, event.timestamp
+    )
+    print(to_update_msg)
+    output_messages.append(to_update_msg)
 
-        from_update_msg = __reduce_collection(
-            event.item_id, event.from_location_link, event.quantity, event.timestamp
-        )
-        print(from_update_msg)
-        output_messages.append(from_update_msg)
+    from_update_msg = __reduce_collection(
+        store, event.item_id, event.from_location_link, event.quantity, event.timestamp
+    )
+    print(from_update_msg)
+    output_messages.append(from_update_msg)
 
     return output_messages
 
 
-def transfer_individual(event: TransferEvent):
-    with transaction.atomic():
-        prevState, _, output_messages = __transfer_individual(
-            event.item_id,
-            event.to_location_link,
-            event.timestamp,
-        )
+def transfer_individual(store: StateStore, event: TransferEvent):
+    prevState, _, output_messages = __transfer_individual(
+        store,
+        event.item_id,
+        event.to_location_link,
+        event.timestamp,
+    )
 
-        if prevState is not None:
-            event.from_location_link = prevState.location_link
+    if prevState is not None:
+        event.from_location_link = prevState.location_link
 
     return output_messages
 
 
-def production_collection(event: ProductionEvent, inputs: list[ProductionEventInput]):
+def production_collection(
+    store: StateStore, event: ProductionEvent, inputs: list[ProductionEventInput]
+):
     all_output_messages = []
-    with transaction.atomic():
-        # increment output quantity
-        update_msg = __increase_collection(
-            event.item_id, event.location_link, event.quantity, event.timestamp
-        )
-        print(update_msg)
-        # add to msg queue
-        all_output_messages.append(update_msg)
+    # increment output quantity
+    update_msg = __increase_collection(
+        store, event.item_id, event.location_link, event.quantity, event.timestamp
+    )
+    print(update_msg)
+    # add to msg queue
+    all_output_messages.append(update_msg)
+
+    for input in inputs:
+        if input.quantity is not None:  # if collection
+            output_message = __reduce_collection(
+                store, input.item_id, input.location_link, input.quantity, event.timestamp
+            )
+            all_output_messages.append(output_message)
+        else:
+            _, _, output_messages = __transfer_individual(
+                store,
+                input.item_id,
+                None,  # no way to continue tracking an individual item that got consumed to make a collection - I would be surprised if this happens in practice
+                event.timestamp,
+            )
+            all_output_messages.extend(output_messages)
 
-        for input in inputs:
-            if input.quantity is not None:  # if collection
-                output_message = __reduce_collection(
-                    input.item_id, input.location_link, input.quantity, event.timestamp
-                )
-                all_output_messages.append(output_message)
-            else:
+    return all_output_messages
+
+
+def production_individual(
+    store: StateStore, event: ProductionEvent, inputs: list[ProductionEventInput]
+):
+    all_output_messages = []
+
+    prevState, produced_item, update_msgs = __transfer_individual(
+        store, event.item_id, event.location_link, event.timestamp
+    )
+    if prevState is not None:
+        event.from_location_link = prevState.location_link
+    print(update_msgs)
+    # add to msg queue
+    all_output_messages.extend(update_msgs)
+
+    for input in inputs:
+        if input.quantity is not None:  # if collection
+            output_message = __reduce_collection(
+                store, input.item_id, input.location_link, input.quantity, event.timestamp
+            )
+            all_output_messages.append(output_message)
+            output_message = __increase_collection(
+                store,
+                input.item_id,
+                produced_item.item_id,
+                input.quantity,
+                event.timestamp,
+            )
+            all_output_messages.append(output_message)
+        else:
+            if (
+                input.item_id != produced_item.item_id
+            ):  # ensure an item can't be it's own child
                 _, _, output_messages = __transfer_individual(
+                    store,
                     input.item_id,
-                    None,  # no way to continue tracking an individual item that got consumed to make a collection - I would be surprised if this happens in practice
+                    produced_item.item_id,
                     event.timestamp,
                 )
                 all_output_messages.extend(output_messages)
@@ -141,60 +535,171 @@ def production_collection(event: ProductionEvent, inputs: list[ProductionEventIn
     return all_output_messages
 
 
-def production_individual(event: ProductionEvent, inputs: list[ProductionEventInput]):
-    all_output_messages = []
-    with transaction.atomic():
+## RE-PROJECTION
+# A buffered scanner can deliver an operation after later ones for the same items.
+# Applying it on top of their open states would corrupt their history, so instead the
+# items' timelines are rebuilt from the operation's timestamp onwards.
 
-        prevState, produced_item, update_msgs = __transfer_individual(
-            event.item_id, event.location_link, event.timestamp
-        )
-        if prevState is not None:
-            event.from_location_link = prevState.location_link
-        print(update_msgs)
-        # add to msg queue
-        all_output_messages.extend(update_msgs)
 
+def is_late(store: StateStore, operation):
+    """Whether a state the operation would change already changed after its timestamp"""
+    checks = []  # (item_id, location_link or None for the item as a whole)
+    if isinstance(operation, TransferEvent):
+        event = operation
+        if event.quantity is not None and event.from_location_link is not None:
+            checks.append((event.item_id, event.to_location_link))
+            checks.append((event.item_id, event.from_location_link))
+        else:
+            checks.append((event.item_id, None))
+    else:
+        event, inputs = operation
+        if event.quantity is not None:
+            checks.append((event.item_id, event.location_link))
+        else:
+            checks.append((event.item_id, None))
         for input in inputs:
-            if input.quantity is not None:  # if collection
-                output_message = __reduce_collection(
-                    input.item_id, input.location_link, input.quantity, event.timestamp
-                )
-                all_output_messages.append(output_message)
-                output_message = __increase_collection(
-                    input.item_id,
-                    produced_item.item_id,
-                    input.quantity,
-                    event.timestamp,
-                )
-                all_output_messages.append(output_message)
+            if input.quantity is None:
+                checks.append((input.item_id, None))
             else:
-                if (
-                    input.item_id != produced_item.item_id
-                ):  # ensure an item can't be it's own child
-                    _, _, output_messages = __transfer_individual(
-                        input.item_id,
-                        produced_item.item_id,
-                        event.timestamp,
-                    )
-                    all_output_messages.extend(output_messages)
+                checks.append((input.item_id, input.location_link))
+                if event.quantity is None:
+                    checks.append((input.item_id, event.item_id))
 
-    return all_output_messages
+    return any(
+        store.changed_after(item_id, event.timestamp, location_link)
+        for item_id, location_link in checks
+    )
+
+
+def item_timeline(item_id, since):
+    """The stored events that changed the item's states at or after since, in order"""
+    kinds = {TransferEvent: 0, ProductionEvent: 1, ProductionEventInput: 2}
+    entries = [
+        *TransferEvent.objects.filter(item_id=item_id, timestamp__gte=since),
+        *ProductionEvent.objects.filter(item_id=item_id, timestamp__gte=since),
+        *ProductionEventInput.objects.filter(
+            item_id=item_id, timestamp__gte=since
+        ).select_related("production_event"),
+    ]
+    return sorted(
+        entries, key=lambda entry: (entry.timestamp, kinds[type(entry)], entry.pk)
+    )
+
+
+def reproject_items(store: StateStore, item_ids, since):
+    """
+    Rebuilds the states of items from since onwards by replaying their stored events -
+    the work is bounded by the number of events each item has had since then. Every
+    operation must already be saved and the store flushed.
+    Returns a location_state/corrected message for each location whose history changed.
+    """
+    output_messages = []
+    # the timelines from since on, if they reach back into the archive
+    restore(item_ids, since)
+    for item_id in sorted(item_ids):
+        changed = State.objects.filter(item_id=item_id).filter(
+            Q(start__gte=since) | Q(end__gte=since)
+        )
+        locations = set(changed.values_list("location_link", flat=True))
+        if store.rollups is not None:
+            # the replay adds the quantities it moves again
+            store.rollups.retract(changed, since)
+
+        # back to the states that were open at since
+        State.objects.filter(item_id=item_id, start__gte=since).delete()
+        State.objects.filter(item_id=item_id, end__gte=since).update(end=None)
+        refresh_current_state([item_id])
+        store.reload([item_id])
+
+        moved = []
+        for entry in item_timeline(item_id, since):
+            if __replay(store, item_id, entry):
+                moved.append(entry)
+        store.flush()
+        for model in (TransferEvent, ProductionEvent):
+            model.objects.bulk_update(
+                [entry for entry in moved if isinstance(entry, model)],
+                ["from_location_link"],
+            )
+
+        locations.update(changed.values_list("location_link", flat=True))
+        store.touched_locations.update(locations)
+        for location_link in sorted(locations):
+            correction_msg = Event(
+                f"location_state/corrected/{location_link}",
+                {
+                    "item_id": item_id,
+                    "location_link": location_link,
+                    "timestamp": since.isoformat(),
+                    "event": "corrected",
+                },
+            )
+            print(correction_msg)
+            output_messages.append(correction_msg)
+
+    return output_messages
+
+
+def __replay(store: StateStore, item_id, entry):
+    """
+    Applies the part of a stored event that concerns item_id, as apply_transfer_op and
+    apply_prod_op would have. Returns True if the event's from location changed.
+    """
+    if isinstance(entry, ProductionEventInput):
+        prod_event = entry.production_event
+        if entry.quantity is not None:
+            __reduce_collection(
+                store, item_id, entry.location_link, entry.quantity, entry.timestamp
+            )
+            if prod_event.quantity is None:
+                __increase_collection(
+                    store, item_id, prod_event.item_id, entry.quantity, entry.timestamp
+                )
+        elif prod_event.quantity is not None:
+            __transfer_individual(store, item_id, None, entry.timestamp)
+        elif item_id != prod_event.item_id:
+            __transfer_individual(store, item_id, prod_event.item_id, entry.timestamp)
+        return False
+
+    if isinstance(entry, TransferEvent):
+        if entry.quantity is not None and entry.from_location_link is not None:
+            __increase_collection(
+                store, item_id, entry.to_location_link, entry.quantity, entry.timestamp
+            )
+            __reduce_collection(
+                store, item_id, entry.from_location_link, entry.quantity, entry.timestamp
+            )
+            return False
+        to_loc = entry.to_location_link
+    else:
+        if entry.quantity is not None:
+            __increase_collection(
+                store, item_id, entry.location_link, entry.quantity, entry.timestamp
+            )
+            return False
+        to_loc = entry.location_link
+
+    prevState, _, _ = __transfer_individual(store, item_id, to_loc, entry.timestamp)
+    if prevState is None or prevState.location_link == entry.from_location_link:
+        return False
+    entry.from_location_link = prevState.location_link
+    return True
 
 
 ## PRIMITIVES
+# All primitives run inside the transaction opened by process_operations
 
 
-def __transfer_individual(item_id, to_loc, timestamp):
+def __transfer_individual(store: StateStore, item_id, to_loc, timestamp):
     output_messages = []
-    try:
 
-        prevState = State.objects.get(item_id__exact=item_id, end__isnull=True)
+    prevState = store.open_for_item(item_id)
 
+    if prevState is not None:
         if prevState.location_link == to_loc:
             return prevState, prevState, []
 
-        prevState.end = timestamp
-        prevState.save()
+        store.close(prevState, timestamp)
 
         exited_msg = Event(
             f"location_state/exited/{prevState.location_link}",
@@ -209,15 +714,8 @@ def __transfer_individual(item_id, to_loc, timestamp):
         # send update
         output_messages.append(exited_msg)
 
-    except State.DoesNotExist:
-        prevState = None
-
     if to_loc is not None:
-        newState = State.objects.create(
-            item_id=item_id,
-            location_link=to_loc,
-            start=timestamp,
-        )
+        newState = store.create(item_id, to_loc, timestamp)
 
         entered_msg = Event(
             f"location_state/entered/{newState.location_link}",
@@ -234,27 +732,18 @@ def __transfer_individual(item_id, to_loc, timestamp):
     return prevState, newState, output_messages
 
 
-# Runs in an attomic transaction
-def __reduce_collection(item_id, from_loc, quantity, timestamp):
-    try:
-        prevFromState = State.objects.get(
-            location_link__exact=from_loc, item_id__exact=item_id, end__isnull=True
-        )
-        prevFromState.end = timestamp
+def __reduce_collection(store: StateStore, item_id, from_loc, quantity, timestamp):
+    prevFromState = store.open_at(item_id, from_loc)
+    if prevFromState is not None:
         prevFromQuantity = prevFromState.quantity
-        prevFromState.save()
-    except State.DoesNotExist:
+        store.close(prevFromState, timestamp)
+    else:
         prevFromQuantity = 0
 
     newFromQuantity = decrement_quantity(prevFromQuantity, quantity)
 
     if newFromQuantity:
-        State.objects.create(
-            item_id=item_id,
-            location_link=from_loc,
-            start=timestamp,
-            quantity=newFromQuantity,
-        )
+        store.create(item_id, from_loc, timestamp, newFromQuantity)
 
     return Event(
         f"location_state/update/{from_loc}",
@@ -267,23 +756,18 @@ def __reduce_collection(item_id, from_loc, quantity, timestamp):
     )
 
 
-def __increase_collection(item_id, to_loc, quantity, timestamp):
+def __increase_collection(store: StateStore, item_id, to_loc, quantity, timestamp):
     # can check quantity rather than deliberate exception on single tracked
-    try:
-        prevToState = State.objects.get(
-            location_link__exact=to_loc, item_id__exact=item_id, end__isnull=True
-        )
-        prevToState.end = timestamp
+    prevToState = store.open_at(item_id, to_loc)
+    if prevToState is not None:
         prevToQuantity = prevToState.quantity
-        prevToState.save()
-    except State.DoesNotExist:
+        store.close(prevToState, timestamp)
+    else:
         prevToQuantity = 0
 
     newToQuantity = increment_quantity(prevToQuantity, quantity)
 
-    newToState = State.objects.create(
-        item_id=item_id, location_link=to_loc, start=timestamp, quantity=newToQuantity
-    )
+    newToState = store.create(item_id, to_loc, timestamp, newToQuantity)
 
     return Event(
         f"location_state/update/{newToState.location_link}",
@@ -16,8 +16,8 @@ urlpatterns= [
         path('at/<str:location_link>',views.eventsAtLocLink),
     ]
 
-#/events/                           ?from=timestamp ?to=timestamp
-#/events/for/<item_id>              ?from=timestamp ?to=timestamp
-#/events/to/<loc_id>                ?from=timestamp ?to=timestamp
-#/events/from/<loc_id>              ?from=timestamp ?to=timestamp
-#/events/at/<loc_id>                ?from=timestamp ?to=timestamp
+#/events/                           ?from=timestamp ?to=timestamp ?limit=n ?cursor=next
+#/events/for/<item_id>              ?from=timestamp ?to=timestamp ?limit=n ?cursor=next
+#/events/to/<loc_id>                ?from=timestamp ?to=timestamp ?limit=n ?cursor=next
+#/events/from/<loc_id>              ?from=timestamp ?to=timestamp ?limit=n ?cursor=next
+#/events/at/<loc_id>                ?from=timestamp ?to=timestamp ?limit=n ?cursor=next
@@ -0,0 +1,80 @@
+"""
+Point-in-time lookups of State - the rows whose [start, end] interval contains an
+instant, with an open end reaching to the present.
+
+An index on start or end alone still leaves every row on one side of the instant to be
+checked, so the ?t= views use an interval index created by migration 0015 instead:
+Postgres has a GiST index on tstzrange(start, end, '[]'), and SQLite an R*Tree table of
+whole second intervals kept in step with State by triggers. Both index a row whose end
+is before its start as [start, start] - the exact bounds on end leave it out. Other
+databases, or a SQLite without the R*Tree table or its triggers, fall back to filtering
+on start and end.
+"""
+
+from django.db import connection
+from django.db.models import BooleanField, Q
+from django.db.models.expressions import RawSQL
+import datetime
+
+from .models import State
+
+SQLITE_INTERVAL_TABLE = "state_state_interval"
+SQLITE_INTERVAL_TRIGGERS = (
+    "state_interval_insert",
+    "state_interval_update",
+    "state_interval_delete",
+)
+
+_sqlite_interval_table = {}  # database name -> whether the R*Tree table exists
+
+
+def at_instant(queryset, at: datetime.datetime):
+    """Filters a State queryset to the rows that were open at `at`"""
+    quote = connection.ops.quote_name
+    table = quote(State._meta.db_table)
+
+    if connection.vendor == "postgresql":
+        # the same expression as the index, so that the planner can use it - and the
+        # bound on end alone, so that a partitioned State skips the months before at
+        start = f"{table}.{quote('start')}"
+        end = f"{table}.{quote('end')}"
+        clamped = f"CASE WHEN {end} < {start} THEN {start} ELSE {end} END"
+        return queryset.filter(
+            RawSQL(
+                f"tstzrange({start}, {clamped}, '[]') @> %s",
+                (at,),
+                output_field=BooleanField(),
+            ),
+            Q(end__isnull=True) | Q(end__gte=at),
+        )
+
+    q = Q(start__lte=at) & (Q(end__isnull=True) | Q(end__gte=at))
+    if connection.vendor == "sqlite" and __has_sqlite_interval_table():
+        # the R*Tree narrows the rows down to whole seconds, q then checks them exactly
+        seconds = "CAST(strftime('%%s', %s) AS INTEGER)"  # as the triggers convert
+        value = connection.ops.adapt_datetimefield_value(at)
+        q &= Q(
+            record_id__in=RawSQL(
+                f"SELECT id FROM {quote(SQLITE_INTERVAL_TABLE)}"
+                f" WHERE lo <= {seconds} AND hi >= {seconds}",
+                (value, value),
+            )
+        )
+    return queryset.filter(q)
+
+
+def __has_sqlite_interval_table():
+    # SQLite drops the triggers whenever a migration remakes the State table, and the
+    # R*Tree would then miss rows - it is only used while all of them exist
+    name = connection.settings_dict["NAME"]
+    if name not in _sqlite_interval_table:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT count(*) FROM sqlite_master WHERE name IN (%s, %s, %s, %s)",
+                [SQLITE_INTERVAL_TABLE, *SQLITE_INTERVAL_TRIGGERS],
+            )
+            found = cursor.fetchone()[0] == 1 + len(SQLITE_INTERVAL_TRIGGERS)
+        if not found:
+            print("WARNING: no SQLite interval index - ?t= queries scan State")
+        _sqlite_interval_table[name] = found
+    return _sqlite_interval_table[name]
@@ -0,0 +1,120 @@
+from django.db import close_old_connections, connections
+import queue
+import threading
+import traceback
+import zlib
+
+
+class LanePool:
+    """
+    Runs tasks concurrently on a fixed number of ordered lanes, each served by its own
+    thread. Every key a task touches hashes onto one lane and tasks that share a key run
+    in the order they were submitted.
+
+    A task whose keys hash onto several lanes is queued on all of them and only runs
+    once each of those lanes has reached it, so it stays ordered with respect to every
+    key it touches. Tasks are queued on all their lanes under one lock, which keeps the
+    relative order of any two tasks the same on every lane and so cannot deadlock.
+    """
+
+    def __init__(self, lanes=4, max_queue=0):
+        self.lanes = lanes
+        self._queues = [queue.Queue(maxsize=max_queue) for _ in range(lanes)]
+        self._submit_lock = threading.Lock()
+        self._threads = None
+        self.processed = [0] * lanes
+        self.max_depth = [0] * lanes
+
+    def lane_for(self, key):
+        # crc32 rather than hash() so that routing is stable between processes and runs
+        return zlib.crc32(key.encode()) % self.lanes
+
+    def submit(self, keys, fn, *args):
+        lanes = sorted({self.lane_for(key) for key in keys}) or [0]
+        task = _LaneTask(fn, args, len(lanes))
+
+        with self._submit_lock:
+            if self._threads is None:
+                self.__start()
+            for lane in lanes:
+                self._queues[lane].put(task)
+                self.max_depth[lane] = max(
+                    self.max_depth[lane], self._queues[lane].qsize()
+                )
+
+    def join(self):
+        """Blocks until every submitted task has run"""
+        for lane_queue in self._queues:
+            lane_queue.join()
+
+    def stop(self):
+        """
+        Runs every submitted task, then ends the lane threads and closes their database
+        connections. Submitting again starts new ones.
+        """
+        with self._submit_lock:
+            threads, self._threads = self._threads, None
+            for lane_queue in self._queues if threads else ():
+                lane_queue.put(None)
+        for thread in threads or ():
+            thread.join()
+
+    def stats(self):
+        return {
+            "lanes": self.lanes,
+            "depth": [lane_queue.qsize() for lane_queue in self._queues],
+            "max_depth": list(self.max_depth),
+            "processed": list(self.processed),
+        }
+
+    def __start(self):
+        self._threads = [
+            threading.Thread(
+                target=self.__run, args=(lane,), name=f"state-lane-{lane}", daemon=True
+            )
+            for lane in range(self.lanes)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def __run(self, lane):
+        lane_queue = self._queues[lane]
+        while True:
+            task = lane_queue.get()
+            if task is None:
+                connections.close_all()
+                lane_queue.task_done()
+                return
+            try:
+                if task.arrive():
+                    close_old_connections()
+                    task.run()
+                    self.processed[lane] += 1
+                else:
+                    task.done.wait()
+            finally:
+                lane_queue.task_done()
+
+
+class _LaneTask:
+    def __init__(self, fn, args, lane_count):
+        self.fn = fn
+        self.args = args
+        self.done = threading.Event()
+        self._waiting_for = lane_count
+        self._lock = threading.Lock()
+
+    def arrive(self):
+        """Returns True for the last lane to reach the task, which then runs it"""
+        with self._lock:
+            self._waiting_for -= 1
+            return self._waiting_for == 0
+
+    def run(self):
+        try:
+            self.fn(*self.args)
+        except Exception:
+            print("ERROR")
+            print(traceback.format_exc())
+        finally:
+            self.done.set()
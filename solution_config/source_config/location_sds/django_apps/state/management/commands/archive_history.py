@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+import dateutil.parser
+import time
+
+from state import event_handler as state_event_handler
+from state.models import ArchiveCheckpoint
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the closed states and the events older than the STATE_ARCHIVE age to the "
+        "archive tables, a batch per transaction. An interrupted run is resumed from its "
+        "checkpoint - with the horizon it started with - by running the command again. "
+        "Run it from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="start a new run up to the current horizon instead of resuming",
+        )
+        parser.add_argument(
+            "--now", help="archive as if it were this instant (ISO 8601)"
+        )
+        parser.add_argument(
+            "--status", action="store_true", help="only show the checkpoints"
+        )
+
+    def handle(self, *args, **options):
+        if not options["status"]:
+            self.archive(options)
+        for checkpoint in ArchiveCheckpoint.objects.order_by("key"):
+            self.stdout.write(
+                f"{checkpoint.key:<10} before {checkpoint.before.isoformat()}: "
+                f"{checkpoint.moved} moved through id {checkpoint.last_id}"
+                f"{'' if checkpoint.finished else ', unfinished'}"
+            )
+
+    def archive(self, options):
+        history_archive = state_event_handler.history_archive
+        if history_archive is None:
+            raise CommandError("STATE_ARCHIVE is not set")
+
+        now = dateutil.parser.isoparse(options["now"]) if options["now"] else None
+        started = time.perf_counter()
+        moved = sum(
+            count for key, count in history_archive.run(now, restart=options["restart"])
+        )
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"{moved} rows moved in {elapsed:.1f} s, {moved / elapsed:.0f} rows/s"
+        )
@@ -0,0 +1,146 @@
+from bisect import bisect_right
+from collections import defaultdict
+from django.core.management.base import BaseCommand, CommandError
+import datetime
+import time
+
+from state import analytics, benchmarks
+from state.models import State
+
+
+def python_statistics(locations, micros, percentiles, edges):
+    """The per-location statistics() of the intervals, in plain Python"""
+    values = defaultdict(list)
+    for location, value in zip(locations, micros):
+        values[location].append(value / 1e6)
+    result = {}
+    for location, group in values.items():
+        group.sort()
+        quantiles = []
+        for percentile in percentiles:
+            position = (len(group) - 1) * percentile / 100
+            low = int(position)
+            high = min(low + 1, len(group) - 1)
+            quantiles.append(group[low] + (group[high] - group[low]) * (position - low))
+        counts = [0] * len(edges)
+        for value in group:
+            counts[bisect_right(edges, value) - 1] += 1
+        result[location] = (len(group), sum(group) / len(group), quantiles, counts)
+    return result
+
+
+class Command(BaseCommand):
+    help = (
+        "Times the dwell-time statistics on synthetic intervals held in arrays against "
+        "the same in plain Python, after checking they agree, then the whole /report/"
+        "dwell and /report/lead_time path - reading State included - on a throwaway "
+        "database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--intervals", type=int, default=10_000_000)
+        parser.add_argument(
+            "--python-intervals",
+            type=int,
+            default=1_000_000,
+            help="intervals for the plain Python comparison",
+        )
+        parser.add_argument("--locations", type=int, default=50)
+        parser.add_argument(
+            "--load",
+            type=int,
+            default=200_000,
+            help="State rows read from the database",
+        )
+        parser.add_argument("--repeat", type=int, default=3, help="best of n runs")
+        parser.add_argument(
+            "--sqlite",
+            action="store_true",
+            help="use a SQLite file even if the default database is Postgres",
+        )
+
+    def best_of(self, repeat, run):
+        elapsed = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = run()
+            elapsed.append(time.perf_counter() - started)
+        return min(elapsed), result
+
+    def handle(self, *args, **options):
+        np = analytics.np
+        if np is None:
+            raise CommandError("NumPy is not installed")
+        repeat = options["repeat"]
+        percentiles, edges = analytics.DEFAULT_PERCENTILES, analytics.DEFAULT_BINS
+        count, subset = options["intervals"], options["python_intervals"]
+        names = [f"loc@{code}" for code in range(options["locations"])]
+
+        rng = np.random.default_rng(0)
+        locations = rng.integers(0, len(names), count, dtype=np.int32)
+        # microseconds, about 20 minutes on average with a long tail
+        micros = (rng.lognormal(7, 1.5, count) * 1e6).astype(np.int64)
+
+        # the same subset both ways first - the statistics must agree
+        elapsed, python = self.best_of(
+            1,
+            lambda: python_statistics(
+                locations[:subset].tolist(),
+                micros[:subset].tolist(),
+                percentiles,
+                edges,
+            ),
+        )
+        self.stdout.write(
+            f"python     {subset:>10} intervals in {elapsed:6.2f} s, "
+            f"{subset / elapsed:12.0f} intervals/s"
+        )
+        check = analytics.statistics(
+            names, locations[:subset], micros[:subset], percentiles, edges
+        )
+        for code, (size, mean, quantiles, counts) in python.items():
+            row = check[names[code]]
+            if (
+                row["count"] != size
+                or row["histogram"]["counts"] != counts
+                or not np.allclose(
+                    [row["mean"], *row["percentiles"].values()], [mean, *quantiles]
+                )
+            ):
+                raise CommandError(f"different statistics for {names[code]}")
+
+        elapsed, _ = self.best_of(
+            repeat,
+            lambda: analytics.statistics(names, locations, micros, percentiles, edges),
+        )
+        self.stdout.write(
+            f"vectorized {count:>10} intervals in {elapsed:6.2f} s, "
+            f"{count / elapsed:12.0f} intervals/s"
+        )
+
+        with benchmarks.scratch_database(sqlite=options["sqlite"]):
+            moves = 50
+            State.objects.bulk_create(
+                benchmarks.state_history(
+                    max(options["load"] // moves, 1), moves, len(names)
+                ),
+                batch_size=2000,
+            )
+            first = State.objects.order_by("start").values_list("start", flat=True)[0]
+            window = (first, first + datetime.timedelta(days=365))
+            rows = State.objects.filter(end__isnull=False).count()
+
+            elapsed, dwell = self.best_of(
+                repeat, lambda: analytics.dwell_times(*window)
+            )
+            self.stdout.write(
+                f"/report/dwell     {rows:>10} states in {elapsed:6.2f} s, "
+                f"{rows / elapsed:12.0f} states/s, {len(dwell)} locations"
+            )
+
+            elapsed, lead = self.best_of(
+                repeat, lambda: analytics.lead_times(*window, names[0])
+            )
+            self.stdout.write(
+                f"/report/lead_time {lead['count']:>10} items  in {elapsed:6.2f} s"
+            )
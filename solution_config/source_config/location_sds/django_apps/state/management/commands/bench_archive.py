@@ -0,0 +1,194 @@
+from contextlib import redirect_stdout
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from django.urls import resolve
+from unittest import mock
+from urllib.parse import quote
+import io
+import random
+import time
+
+from state import benchmarks, views
+from state.archive import HistoryArchive
+from state.models import (
+    ArchivedState,
+    ArchivedTransferEvent,
+    ProductionEvent,
+    ProductionEventInput,
+    State,
+    TransferEvent,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Times the history and event views on a throwaway database of synthetic "
+        "history before and after archiving all but its most recent part, after "
+        "checking they answer the same - for windows within the hot part and for "
+        "ones reaching into the archive, and for ?t= and the CSV reports before the "
+        "horizon"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--items", type=int, default=2000)
+        parser.add_argument("--moves", type=int, default=100, help="states per item")
+        parser.add_argument("--transfers", type=int, default=200000)
+        parser.add_argument("--productions", type=int, default=20000)
+        parser.add_argument("--locations", type=int, default=50)
+        parser.add_argument(
+            "--keep",
+            type=float,
+            default=0.1,
+            help="the fraction of the history, by time, left in the hot tables",
+        )
+        parser.add_argument("--batch-size", type=int, default=2000)
+        parser.add_argument("--queries", type=int, default=20, help="per path")
+        parser.add_argument(
+            "--sqlite",
+            action="store_true",
+            help="use a SQLite file even if the default database is Postgres",
+        )
+
+    def seed(self, options):
+        states = benchmarks.state_history(
+            options["items"], options["moves"], options["locations"]
+        )
+        transfers = benchmarks.transfer_events(
+            options["transfers"], options["items"], options["locations"]
+        )
+        rows = benchmarks.production_rows(
+            options["productions"], 3, options["items"], options["locations"]
+        )
+        # the events a second apart, spread over the time the states cover
+        span = max(state.start for state in states) - benchmarks.T0
+        for events in (transfers, [event for event, inputs in rows]):
+            scale = span / max(len(events), 1)
+            for step, event in enumerate(events):
+                event.timestamp = benchmarks.T0 + scale * step
+        for event, inputs in rows:
+            for input in inputs:
+                input.timestamp = event.timestamp
+
+        State.objects.bulk_create(states, batch_size=2000)
+        TransferEvent.objects.bulk_create(transfers, batch_size=2000)
+        ProductionEvent.objects.bulk_create(
+            [event for event, inputs in rows], batch_size=2000
+        )
+        for event, inputs in rows:
+            for input in inputs:
+                input.production_event = event
+        ProductionEventInput.objects.bulk_create(
+            [input for event, inputs in rows for input in inputs], batch_size=2000
+        )
+
+    def analyze(self):
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def paths(self, options, recent, rng):
+        """
+        (label, path) for each query timed - recent ones, whole histories, then times
+        and windows before recent
+        """
+        since = quote(recent.isoformat())
+        for _ in range(options["queries"]):
+            item = f"product@{rng.randrange(options['items'])}"
+            location = f"loc@{rng.randrange(options['locations'])}"
+            old = benchmarks.T0 + (recent - benchmarks.T0) * rng.random()
+            at = quote(old.isoformat())
+            until = quote((old + (recent - benchmarks.T0) / 100).isoformat())
+            yield "recent history", f"/state/history?from={since}&limit=100"
+            yield "recent history/for", f"/state/history/for/{item}?from={since}"
+            yield "recent history/at", (
+                f"/state/history/at/{location}?from={since}&limit=100"
+            )
+            yield "recent events", f"/events/?from={since}&limit=100"
+            yield "recent events/for", f"/events/for/{item}?from={since}"
+            yield "recent events/at", f"/events/at/{location}?from={since}&limit=100"
+            yield "all history/for", f"/state/history/for/{item}"
+            yield "all events/for", f"/events/for/{item}"
+            yield "all events/at", f"/events/at/{location}?limit=100"
+            yield "old state", f"/state/?t={at}"
+            yield "old state/for", f"/state/for/{item}?t={at}"
+            yield "old state/at", f"/state/at/{location}?t={at}"
+            yield "old report/state", f"/report/?type=state&end={at}"
+            yield "old report/transfer", (
+                f"/report/?type=transfer&start={at}&end={until}"
+            )
+
+    def run_paths(self, paths):
+        """label -> latencies, and path -> response body"""
+        factory = RequestFactory()
+        latencies, bodies = {}, {}
+        for label, path in paths:
+            match = resolve(path.split("?")[0])
+            request = factory.get(path, HTTP_ACCEPT="application/json")
+            started = time.perf_counter()
+            # the reports' details come from the id service, which isn't timed here
+            with redirect_stdout(io.StringIO()), override_settings(
+                ALLOWED_HOSTS=["testserver"]
+            ), mock.patch.object(views, "get_all_details", self.details):
+                response = match.func(request, *match.args, **match.kwargs)
+                if response.streaming:
+                    content = b"".join(response.streaming_content)
+                else:
+                    content = response.render().content
+            latencies.setdefault(label, []).append(time.perf_counter() - started)
+            if response.status_code != 200:
+                raise CommandError(f"{path} gave {response.status_code}")
+            bodies[path] = content
+        return latencies, bodies
+
+    @staticmethod
+    def details(ids):
+        return {id: {"name": id, "type": str(id).partition("@")[0]} for id in ids}
+
+    def handle(self, *args, **options):
+        with benchmarks.scratch_database(sqlite=options["sqlite"]):
+            self.seed(options)
+            self.analyze()
+            last = State.objects.order_by("-start").values_list("start", flat=True)[0]
+            horizon = last - (last - benchmarks.T0) * options["keep"]
+            self.stdout.write(
+                f"{State.objects.count()} states, {TransferEvent.objects.count()} "
+                f"transfers, {ProductionEvent.objects.count()} productions on "
+                f"{connection.vendor}"
+            )
+
+            paths = list(self.paths(options, horizon, random.Random(0)))
+            self.run_paths(paths[: len(paths) // options["queries"]])  # warm up
+            before, expected = self.run_paths(paths)
+
+            archive = HistoryArchive(age=0, batch_size=options["batch_size"])
+            started = time.perf_counter()
+            moved = sum(count for key, count in archive.run(horizon))
+            elapsed = time.perf_counter() - started
+            self.analyze()
+            self.stdout.write(
+                f"archived {moved} rows in {elapsed:.1f} s, {moved / elapsed:.0f} "
+                f"rows/s - {State.objects.count()} states and "
+                f"{TransferEvent.objects.count()} transfers left, "
+                f"{ArchivedState.objects.count()} and "
+                f"{ArchivedTransferEvent.objects.count()} archived"
+            )
+
+            self.run_paths(paths[: len(paths) // options["queries"]])
+            after, bodies = self.run_paths(paths)
+            for path, body in expected.items():
+                if bodies[path] != body:
+                    raise CommandError(f"{path} differs after archiving")
+
+            self.stdout.write(
+                f"{'':<20} {'p50 before / after':>20} {'p99 before / after':>20}"
+            )
+            for label, samples in before.items():
+                self.stdout.write(
+                    f"{label:<20} "
+                    + " ".join(
+                        f"{benchmarks.percentile(samples, fraction) * 1000:8.2f} / "
+                        f"{benchmarks.percentile(after[label], fraction) * 1000:6.2f} ms"
+                        for fraction in (0.5, 0.99)
+                    )
+                )
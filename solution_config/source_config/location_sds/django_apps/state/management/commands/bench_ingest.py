@@ -0,0 +1,146 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+import json
+import os
+import time
+
+from state import benchmarks
+from state import event_handler as state_event_handler
+
+WORKLOADS = ("individual", "collection", "production")
+
+
+class Command(BaseCommand):
+    help = (
+        "Drives synthetic workloads through the registered state event handlers on a "
+        "throwaway database and reports events/s, latency, SQL queries per event and "
+        "database growth. Results are compared with a stored baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workload", choices=WORKLOADS, nargs="+", default=list(WORKLOADS)
+        )
+        parser.add_argument("--messages", type=int, default=2000)
+        parser.add_argument("--items", type=int, default=500, help="N items")
+        parser.add_argument("--locations", type=int, default=20, help="M locations")
+        parser.add_argument(
+            "--inputs", type=int, default=4, help="K inputs per production event"
+        )
+        parser.add_argument(
+            "--sqlite",
+            action="store_true",
+            help="use a SQLite file even if the default database is Postgres",
+        )
+        parser.add_argument("--baseline", default="bench_ingest_baseline.json")
+        parser.add_argument(
+            "--save-baseline",
+            action="store_true",
+            help="store these results as the baseline instead of comparing with it",
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.2,
+            help="allowed fractional regression before the run fails",
+        )
+
+    def messages_for(self, workload, options):
+        if workload == "individual":
+            return benchmarks.individual_transfers(
+                options["messages"], options["items"], options["locations"]
+            )
+        if workload == "collection":
+            return benchmarks.collection_transfers(
+                options["messages"], options["items"], options["locations"]
+            )
+        return benchmarks.production_events(
+            options["messages"], options["inputs"], options["locations"]
+        )
+
+    def run(self, messages):
+        benchmarks.clear_tables()
+        size_before = benchmarks.database_size()
+        counter = benchmarks.QueryCounter()
+        latencies = []
+
+        with benchmarks.quiet_handler(), connection.execute_wrapper(counter):
+            started = time.perf_counter()
+            for msg in messages:
+                handler = benchmarks.handler_for(msg)
+                sent = time.perf_counter()
+                handler(msg)
+                latencies.append(time.perf_counter() - sent)
+            elapsed = time.perf_counter() - started
+
+        size_after = benchmarks.database_size()
+        return {
+            "events_per_s": len(messages) / elapsed,
+            "p50_ms": benchmarks.percentile(latencies, 0.5) * 1000,
+            "p99_ms": benchmarks.percentile(latencies, 0.99) * 1000,
+            "queries_per_event": counter.count / len(messages),
+            "db_bytes_per_event": (
+                (size_after - size_before) / len(messages)
+                if size_before is not None
+                else None
+            ),
+        }
+
+    def handle(self, *args, **options):
+        # measure the handlers themselves, one message at a time
+        saved = (state_event_handler.batcher, state_event_handler.lanes)
+        state_event_handler.batcher = None
+        state_event_handler.lanes = None
+        results = {}
+        try:
+            for workload in options["workload"]:
+                messages = self.messages_for(workload, options)
+                with benchmarks.scratch_database(sqlite=options["sqlite"]):
+                    key = f"{connection.vendor}:{workload}"
+                    results[key] = self.run(messages)
+        finally:
+            state_event_handler.batcher, state_event_handler.lanes = saved
+
+        for key, result in results.items():
+            growth = result["db_bytes_per_event"]
+            self.stdout.write(
+                f"{key:<24} {result['events_per_s']:8.1f} events/s  "
+                f"p50 {result['p50_ms']:6.2f} ms  p99 {result['p99_ms']:6.2f} ms  "
+                f"{result['queries_per_event']:5.1f} queries/event  "
+                + (f"{growth:7.1f} bytes/event" if growth is not None else "")
+            )
+
+        baseline = {}
+        if os.path.exists(options["baseline"]):
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)
+
+        if options["save_baseline"]:
+            baseline.update(results)
+            with open(options["baseline"], "w") as f:
+                json.dump(baseline, f, indent=2, sort_keys=True)
+            self.stdout.write(f"baseline saved to {options['baseline']}")
+            return
+
+        regressions = []
+        tolerance = options["tolerance"]
+        for key, result in results.items():
+            if key not in baseline:
+                continue
+            expected = baseline[key]
+            if result["events_per_s"] < expected["events_per_s"] * (1 - tolerance):
+                regressions.append(
+                    f"{key} events/s {result['events_per_s']:.1f} < {expected['events_per_s']:.1f}"
+                )
+            # p99 over a short run is too noisy to fail on - it is reported only
+            for metric in ("queries_per_event", "db_bytes_per_event"):
+                if result[metric] is None or expected.get(metric) is None:
+                    continue
+                if result[metric] > expected[metric] * (1 + tolerance):
+                    regressions.append(
+                        f"{key} {metric} {result[metric]:.2f} > {expected[metric]:.2f}"
+                    )
+        if regressions:
+            raise CommandError("regressed against baseline: " + "; ".join(regressions))
+        if any(key in baseline for key in results):
+            self.stdout.write(self.style.SUCCESS("no regressions against baseline"))
@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand
+import time
+
+from state import benchmarks
+from state import event_handler as state_event_handler
+from state.lanes import LanePool
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures event handler throughput as the number of ingestion lanes grows, and "
+        "the share of a CPU this process spent on it - lanes overlap the database's "
+        "work, so they can only gain while neither side is short of CPU"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lanes", type=int, nargs="+", default=[1, 2, 4, 8])
+        parser.add_argument("--messages", type=int, default=5000)
+        parser.add_argument("--items", type=int, default=500)
+        parser.add_argument("--locations", type=int, default=20)
+        parser.add_argument(
+            "--inputs",
+            type=int,
+            default=0,
+            help="mix in one production event with this many inputs every 50 messages",
+        )
+
+    def handle(self, *args, **options):
+        messages = benchmarks.individual_transfers(
+            options["messages"], options["items"], options["locations"]
+        )
+        if options["inputs"]:
+            production = benchmarks.production_events(
+                len(messages) // 50, options["inputs"], options["locations"]
+            )
+            for n, msg in enumerate(production):
+                messages.insert(n * 51, msg)
+
+        lanes_before = state_event_handler.lanes
+        batcher_before = state_event_handler.batcher
+        state_event_handler.batcher = None
+        try:
+            with benchmarks.scratch_database():
+                baseline = None
+                for lane_count in options["lanes"]:
+                    benchmarks.clear_tables()
+                    pool = LanePool(lanes=lane_count)
+                    state_event_handler.lanes = pool
+
+                    with benchmarks.quiet_handler():
+                        started = time.perf_counter()
+                        cpu_started = time.process_time()
+                        for msg in messages:
+                            benchmarks.handler_for(msg)(msg)
+                        pool.join()
+                        elapsed = time.perf_counter() - started
+                        cpu = time.process_time() - cpu_started
+                    # the scratch database can't be dropped while they're connected
+                    pool.stop()
+
+                    rate = len(messages) / elapsed
+                    baseline = baseline or rate
+                    self.stdout.write(
+                        f"lanes={lane_count:<3} {rate:9.1f} msg/s  "
+                        f"x{rate / baseline:4.2f}  {cpu / elapsed:4.0%} CPU  "
+                        f"max queue depth {max(pool.stats()['max_depth'])}"
+                    )
+        finally:
+            state_event_handler.lanes = lanes_before
+            state_event_handler.batcher = batcher_before
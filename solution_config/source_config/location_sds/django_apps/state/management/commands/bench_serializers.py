@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand, CommandError
+import time
+
+from state import benchmarks
+from state.models import State, TransferEvent
+from state.serialization import serializer_for
+from state.serializers import StateSerializer, TransferEventSerializer
+from state.streaming import json_array, representations
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the rows/s of the list views' serialization of model instances with "
+        "the .values_list() fast path, on a throwaway database, after checking both give "
+        "the same JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=100000)
+        parser.add_argument("--repeat", type=int, default=3, help="best of n runs")
+        parser.add_argument(
+            "--sqlite",
+            action="store_true",
+            help="use a SQLite file even if the default database is Postgres",
+        )
+
+    def best_of(self, repeat, run):
+        elapsed = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            run()
+            elapsed.append(time.perf_counter() - started)
+        return min(elapsed)
+
+    def handle(self, *args, **options):
+        rows = options["rows"]
+        with benchmarks.scratch_database(sqlite=options["sqlite"]):
+            State.objects.bulk_create(
+                benchmarks.state_history(max(rows // 100, 1), 100, 20), batch_size=2000
+            )
+            TransferEvent.objects.bulk_create(
+                benchmarks.transfer_events(rows, 1000, 20), batch_size=2000
+            )
+
+            for queryset, serializer_class in (
+                (State.objects.order_by("pk"), StateSerializer),
+                (TransferEvent.objects.order_by("pk"), TransferEventSerializer),
+            ):
+                count = queryset.count()
+                paths = {
+                    "instances": lambda: (queryset, serializer_class()),
+                    "values": lambda: serializer_for(queryset, serializer_class),
+                }
+                outputs = {}
+                for name, path in paths.items():
+                    outputs[name] = "".join(json_array(representations(*path())))
+                    serialize = self.best_of(
+                        options["repeat"], lambda: list(representations(*path()))
+                    )
+                    encode = self.best_of(
+                        options["repeat"],
+                        lambda: "".join(json_array(representations(*path()))),
+                    )
+                    self.stdout.write(
+                        f"{queryset.model.__name__:<14} {name:<10} "
+                        f"serialize {count / serialize:9.0f} rows/s  "
+                        f"serialize+JSON {count / encode:9.0f} rows/s"
+                    )
+                if outputs["instances"] != outputs["values"]:
+                    raise CommandError(f"different {queryset.model.__name__} output")
@@ -0,0 +1,91 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+import random
+import time
+
+from state import benchmarks
+from state.intervals import at_instant
+from state.models import State
+from state.snapshots import StateSnapshots
+
+
+def plain(queryset, at):
+    return queryset.filter(Q(start__lte=at) & (Q(end__isnull=True) | Q(end__gte=at)))
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares point-in-time (?t=) queries answered from snapshots with the interval "
+        "index and with a plain start/end filter, on a throwaway database of synthetic "
+        "history, after checking all three return the same states"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--items", type=int, default=2000)
+        parser.add_argument("--moves", type=int, default=100, help="states per item")
+        parser.add_argument("--locations", type=int, default=20)
+        parser.add_argument(
+            "--interval", type=int, default=3600, help="seconds between snapshots"
+        )
+        parser.add_argument("--queries", type=int, default=50)
+        parser.add_argument(
+            "--sqlite",
+            action="store_true",
+            help="use a SQLite file even if the default database is Postgres",
+        )
+
+    def handle(self, *args, **options):
+        with benchmarks.scratch_database(sqlite=options["sqlite"]):
+            State.objects.bulk_create(
+                benchmarks.state_history(
+                    options["items"], options["moves"], options["locations"]
+                ),
+                batch_size=2000,
+            )
+            first = State.objects.order_by("start").values_list("start", flat=True)[0]
+            last = State.objects.order_by("-start").values_list("start", flat=True)[0]
+
+            snapshots = StateSnapshots(
+                interval=options["interval"],
+                retention=(last - first).total_seconds() + options["interval"],
+            )
+            started = time.perf_counter()
+            taken = snapshots.take_due(last, backfill=True)
+            elapsed = time.perf_counter() - started
+            states = sum(snapshot.count for snapshot in taken)
+            size = sum(len(snapshot.record_ids) for snapshot in taken)
+            self.stdout.write(
+                f"{State.objects.count()} states, {len(taken)} snapshots in "
+                f"{elapsed:.1f} s, {size / max(states, 1):.2f} bytes per snapshot state"
+            )
+
+            rng = random.Random(0)
+            instants = [
+                first + (last - first) * rng.random() for _ in range(options["queries"])
+            ]
+            methods = {
+                "snapshot": snapshots.at_instant,
+                "interval": at_instant,
+                "plain": plain,
+            }
+            latencies = {name: [] for name in methods}
+            for at in instants:
+                results = {}
+                for name, method in methods.items():
+                    started = time.perf_counter()
+                    results[name] = sorted(
+                        method(State.objects.all(), at).values_list(
+                            "record_id", flat=True
+                        )
+                    )
+                    latencies[name].append(time.perf_counter() - started)
+                if results["snapshot"] != results["plain"] or (
+                    results["interval"] != results["plain"]
+                ):
+                    raise CommandError(f"different states at {at.isoformat()}")
+
+            for name, samples in latencies.items():
+                self.stdout.write(
+                    f"{name:<9} p50 {benchmarks.percentile(samples, 0.5) * 1000:7.2f} ms"
+                    f"  p99 {benchmarks.percentile(samples, 0.99) * 1000:7.2f} ms"
+                )
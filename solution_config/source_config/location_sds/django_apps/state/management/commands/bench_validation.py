@@ -0,0 +1,98 @@
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.exceptions import ValidationError
+import time
+
+from state import benchmarks
+from state import mqtt_serializers
+from state.mqtt_validators import drf_validated_data, fast_validated_data
+
+# variations of a valid message that must fail, or pass, the same way on both paths
+MUTATIONS = [
+    lambda content: {**content, "timestamp": "yesterday"},
+    lambda content: {**content, "timestamp": "2025-13-01T00:00:00Z"},
+    lambda content: {**content, "timestamp": "2025-01-01T00:00:00"},
+    lambda content: {**content, "item": "x" * 33},
+    lambda content: {**content, "item": "  padded  "},
+    lambda content: {**content, "item": 42},
+    lambda content: {**content, "item": ""},
+    lambda content: {**content, "item": None},
+    lambda content: {**content, "quantity": "7"},
+    lambda content: {**content, "quantity": 7.0},
+    lambda content: {**content, "quantity": "seven"},
+    lambda content: {**content, "inputs": "none"},
+    lambda content: {**content, "inputs": [{"quantity": 1}, "item"]},
+    lambda content: {key: value for key, value in content.items() if key != "item"},
+    lambda content: ["not", "a", "dict"],
+]
+
+
+def outcome(validate, serializer_class, data):
+    try:
+        return validate(serializer_class, data)
+    except ValidationError as e:
+        return ("error", e.detail)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares messages/s of the DRF and the fast path validation of MQTT operation "
+        "messages, after checking both give the same validated data and errors"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=20000)
+        parser.add_argument("--inputs", type=int, default=4)
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def handle(self, *args, **options):
+        count = options["messages"]
+        workloads = {
+            "transfer": (
+                mqtt_serializers.TransferOperation,
+                [
+                    msg.content
+                    for msg in benchmarks.individual_transfers(count // 2, 500, 20)
+                    + benchmarks.collection_transfers(count // 2, 50, 20)
+                ],
+            ),
+            "production": (
+                mqtt_serializers.ProductionOperation,
+                [
+                    msg.content
+                    for msg in benchmarks.production_events(
+                        count, options["inputs"], 20
+                    )
+                ],
+            ),
+        }
+
+        for name, (serializer_class, contents) in workloads.items():
+            checked = contents[:50] + [
+                mutate(content) for content in contents[:5] for mutate in MUTATIONS
+            ]
+            for data in checked:
+                drf = outcome(drf_validated_data, serializer_class, data)
+                fast = outcome(fast_validated_data, serializer_class, data)
+                if drf != fast:
+                    raise CommandError(
+                        f"{name}: {data!r} gave {fast!r} instead of {drf!r}"
+                    )
+
+            rates = {}
+            for label, validate in (
+                ("drf", drf_validated_data),
+                ("fast", fast_validated_data),
+            ):
+                best = None
+                for _ in range(options["repeat"]):
+                    started = time.perf_counter()
+                    for data in contents:
+                        validate(serializer_class, data)
+                    elapsed = time.perf_counter() - started
+                    best = elapsed if best is None else min(best, elapsed)
+                rates[label] = len(contents) / best
+
+            self.stdout.write(
+                f"{name:<11} drf {rates['drf']:10.0f} msg/s  fast {rates['fast']:10.0f} msg/s  "
+                f"x{rates['fast'] / rates['drf']:.1f}"
+            )
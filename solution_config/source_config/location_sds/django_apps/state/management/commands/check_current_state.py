@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from state.store import current_state_differences, refresh_current_state
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares CurrentState with the open State rows it mirrors, and with --repair "
+        "rewrites it from them. Fails if they differ and --repair is not given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--repair",
+            action="store_true",
+            help="rewrite CurrentState from the open State rows if they differ",
+        )
+        parser.add_argument(
+            "--samples", type=int, default=10, help="differing rows shown"
+        )
+
+    def handle(self, *args, **options):
+        differences = current_state_differences()
+        if not differences:
+            self.stdout.write(self.style.SUCCESS("CurrentState matches State"))
+            return
+
+        self.stdout.write(f"{len(differences)} rows differ")
+        for difference in differences[: options["samples"]]:
+            self.stdout.write(f"  {difference}")
+        if not options["repair"]:
+            raise CommandError("CurrentState is out of step - run with --repair")
+
+        with transaction.atomic():
+            refresh_current_state()
+        self.stdout.write(self.style.SUCCESS("CurrentState rewritten from State"))
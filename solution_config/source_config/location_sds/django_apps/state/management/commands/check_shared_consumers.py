@@ -0,0 +1,118 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Count
+import multiprocessing
+import time
+
+from event_handler import Event
+from state import benchmarks
+from state import event_handler as state_event_handler
+from state.models import State, TransferEvent
+
+
+class LocalSharedBroker:
+    """
+    Stand-in for an MQTT broker serving a shared subscription: every published message
+    is delivered to exactly one of the consumers pulling from it.
+    """
+
+    def __init__(self, context):
+        self._queue = context.Queue()
+
+    def publish(self, msg: Event):
+        self._queue.put((msg.topic, msg.content))
+
+    def close(self, consumers):
+        for _ in range(consumers):
+            self._queue.put(None)
+
+    def messages(self):
+        while (entry := self._queue.get()) is not None:
+            yield Event(*entry)
+
+
+def consume(broker):
+    # each consumer handles messages one at a time as a separate deployment would
+    state_event_handler.batcher = None
+    state_event_handler.lanes = None
+    state_event_handler.state_index = None
+    with benchmarks.quiet_handler():
+        for msg in broker.messages():
+            benchmarks.handler_for(msg)(msg)
+    connections.close_all()
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs several consumer processes against a local shared subscription stand-in "
+        "on a throwaway database and checks that no item ends up with duplicate open states"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--consumers", type=int, default=4)
+        parser.add_argument("--messages", type=int, default=2000)
+        parser.add_argument(
+            "--items",
+            type=int,
+            default=10,
+            help="few items make consumers race for the same items",
+        )
+        parser.add_argument("--locations", type=int, default=5)
+
+    def handle(self, *args, **options):
+        individual = benchmarks.individual_transfers(
+            options["messages"], options["items"], options["locations"]
+        )
+        collections = benchmarks.collection_transfers(
+            options["messages"] // 4, max(options["items"] // 4, 1), options["locations"]
+        )
+        messages = individual + collections
+
+        context = multiprocessing.get_context("fork")
+        with benchmarks.scratch_database():
+            broker = LocalSharedBroker(context)
+            for msg in messages:
+                broker.publish(msg)
+            broker.close(options["consumers"])
+
+            # consumers must open their own connections
+            connections.close_all()
+            consumers = [
+                context.Process(target=consume, args=(broker,))
+                for _ in range(options["consumers"])
+            ]
+            started = time.perf_counter()
+            for consumer in consumers:
+                consumer.start()
+            for consumer in consumers:
+                consumer.join()
+            elapsed = time.perf_counter() - started
+
+            duplicate_individual = list(
+                State.objects.filter(end__isnull=True, quantity__isnull=True)
+                .values("item_id")
+                .annotate(count=Count("record_id"))
+                .filter(count__gt=1)
+            )
+            duplicate_collection = list(
+                State.objects.filter(end__isnull=True)
+                .values("item_id", "location_link")
+                .annotate(count=Count("record_id"))
+                .filter(count__gt=1)
+            )
+            logged = TransferEvent.objects.count()
+
+        self.stdout.write(
+            f"{options['consumers']} consumers handled {logged}/{len(messages)} messages "
+            f"in {elapsed:.1f}s"
+        )
+        problems = []
+        if duplicate_individual or duplicate_collection:
+            problems.append(
+                f"duplicate open states: {duplicate_individual + duplicate_collection}"
+            )
+        if logged != len(messages):
+            problems.append(f"{len(messages) - logged} messages were lost")
+        if problems:
+            raise CommandError("; ".join(problems))
+        self.stdout.write(self.style.SUCCESS("no duplicate open states"))
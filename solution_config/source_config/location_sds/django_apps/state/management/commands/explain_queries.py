@@ -0,0 +1,186 @@
+from contextlib import redirect_stdout
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from django.urls import resolve
+from urllib.parse import urlencode
+import io
+import re
+
+from state import benchmarks, views
+from state.models import TransferEvent, ProductionEvent, ProductionEventInput
+
+EVENT_TABLES = [
+    model._meta.db_table
+    for model in (TransferEvent, ProductionEvent, ProductionEventInput)
+]
+
+
+class Statements:
+    """Collects the SELECTs on the event tables run on this thread's connection"""
+
+    def __init__(self):
+        self.selects = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if sql.lstrip().upper().startswith("SELECT") and any(
+            table in sql for table in EVENT_TABLES
+        ):
+            self.selects.append((sql, params))
+        return execute(sql, params, many, context)
+
+
+def explain(sql, params):
+    """The plan of a query and what is wrong with it - a full scan or a sort, if any"""
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            lines = [row[3] for row in cursor.fetchall()]
+            full_scan = r"^SCAN (\w+)$"
+            sort = r"^USE TEMP B-TREE FOR (?:RIGHT PART OF )?ORDER BY"
+            index = r"USING (?:COVERING )?INDEX (\w+)"
+        elif connection.vendor == "postgresql":
+            cursor.execute("EXPLAIN " + sql, params)
+            lines = [row[0] for row in cursor.fetchall()]
+            full_scan = r"Seq Scan on (\w+)"
+            sort = r"^\s*(?:->\s*)?(?:Incremental )?Sort\b"
+            index = r"(?:Index (?:Only )?Scan(?: Backward)? using|Bitmap Index Scan on) (\w+)"
+        else:
+            raise CommandError(f"EXPLAIN isn't supported for {connection.vendor}")
+
+    problems = []
+    for line in lines:
+        match = re.search(full_scan, line)
+        if match and match.group(1) in EVENT_TABLES:
+            problems.append(f"full scan of {match.group(1)}")
+        if re.search(sort, line):
+            problems.append("sorts its rows")
+    indexes = sorted({match for line in lines for match in re.findall(index, line)})
+    return lines, indexes, problems
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs each event view - and the report's transfer query - against a throwaway "
+        "database of synthetic events, EXPLAINs the queries they make on the event "
+        "tables and fails if any of them scans a whole table or sorts instead of "
+        "reading an index in order"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--transfers", type=int, default=200000)
+        parser.add_argument("--productions", type=int, default=20000)
+        parser.add_argument("--inputs", type=int, default=3, help="per production")
+        parser.add_argument("--items", type=int, default=5000)
+        parser.add_argument("--locations", type=int, default=200)
+        parser.add_argument(
+            "--sqlite",
+            action="store_true",
+            help="use a SQLite file even if the default database is Postgres",
+        )
+
+    def seed(self, options):
+        TransferEvent.objects.bulk_create(
+            benchmarks.transfer_events(
+                options["transfers"], options["items"], options["locations"]
+            ),
+            batch_size=2000,
+        )
+        rows = benchmarks.production_rows(
+            options["productions"],
+            options["inputs"],
+            options["items"],
+            options["locations"],
+        )
+        ProductionEvent.objects.bulk_create(
+            [event for event, inputs in rows], batch_size=2000
+        )
+        for event, inputs in rows:
+            for input in inputs:
+                input.production_event = event
+        ProductionEventInput.objects.bulk_create(
+            [input for event, inputs in rows for input in inputs], batch_size=2000
+        )
+        with connection.cursor() as cursor:
+            # the planner needs statistics to prefer an index over a scan
+            cursor.execute("ANALYZE")
+
+    def cases(self):
+        """(label, run) for each query to check - run makes the queries"""
+        first = TransferEvent.objects.order_by("timestamp")[0]
+        last = TransferEvent.objects.order_by("-timestamp")[0]
+        # a narrow window - a request for most of the table may rightly scan it
+        start = first.timestamp + (last.timestamp - first.timestamp) / 2
+        end = start + (last.timestamp - first.timestamp) / 100
+        window = urlencode({"from": start.isoformat(), "to": end.isoformat()})
+        paths = [
+            f"/events/?{window}",
+            "/events/?limit=100",
+            f"/events/for/{first.item_id}",
+            f"/events/for/{first.item_id}?limit=10",
+            f"/events/to/{first.to_location_link}?limit=100",
+            f"/events/to/{first.to_location_link}?{window}",
+            f"/events/from/{first.to_location_link}?limit=100",
+            f"/events/from/{first.to_location_link}?{window}",
+            f"/events/at/{first.to_location_link}?limit=100",
+            f"/events/at/{first.to_location_link}?{window}",
+        ]
+        factory = RequestFactory()
+
+        def get(path):
+            match = resolve(path.split("?")[0])
+            request = factory.get(path, HTTP_ACCEPT="application/json")
+            with redirect_stdout(io.StringIO()), override_settings(
+                ALLOWED_HOSTS=["testserver"]
+            ):
+                response = match.func(request, *match.args, **match.kwargs)
+                response.render()
+            if response.status_code != 200:
+                raise CommandError(f"{path} gave {response.status_code}")
+            return response
+
+        for path in paths:
+            label = path.replace(window, "from=...&to=...")
+            yield label, lambda path=path: get(path)
+            if "limit=" in path:
+                # the second page filters on the cursor as well
+                cursor = get(path).headers.get("X-Next-Cursor")
+                if cursor:
+                    page = f"{path}&cursor={cursor}"
+                    yield f"{label}&cursor=...", lambda page=page: get(page)
+
+        yield "report?type=transfer", lambda: list(
+            views.query_all_events(start.isoformat(), end.isoformat()).iterator()
+        )
+
+    def handle(self, *args, **options):
+        with benchmarks.scratch_database(sqlite=options["sqlite"]):
+            self.seed(options)
+            self.stdout.write(
+                f"{TransferEvent.objects.count()} transfers, "
+                f"{ProductionEvent.objects.count()} productions, "
+                f"{ProductionEventInput.objects.count()} inputs on {connection.vendor}"
+            )
+
+            failed = 0
+            for label, run in self.cases():
+                statements = Statements()
+                with connection.execute_wrapper(statements):
+                    run()
+                if not statements.selects:
+                    raise CommandError(f"{label} made no query on the event tables")
+                for sql, params in statements.selects:
+                    lines, indexes, problems = explain(sql, params)
+                    verdict = "FAIL " + ", ".join(problems) if problems else "ok"
+                    self.stdout.write(
+                        f"{verdict:<6} {label:<44} {', '.join(indexes) or '-'}"
+                    )
+                    if problems:
+                        failed += 1
+                        self.stdout.write(
+                            "\n".join(f"         {line}" for line in [sql, *lines])
+                        )
+
+            if failed:
+                raise CommandError(f"{failed} queries don't use an index")
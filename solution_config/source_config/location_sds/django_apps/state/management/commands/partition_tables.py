@@ -0,0 +1,86 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+import dateutil.parser
+import time
+
+from state import event_handler as state_event_handler
+from state import partitions
+from state.models import State, TransferEvent
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates the STATE_PARTITIONS monthly partitions of State and TransferEvent for "
+        "the coming months and moves those past the keep period to the STATE_ARCHIVE "
+        "tables, dropping them. With --convert, "
+        "first turns the unpartitioned tables into partitioned ones, copying their rows "
+        "- stop the MQTT consumers for that. Postgres only. Run it from cron monthly."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--convert",
+            action="store_true",
+            help="partition the tables that aren't, copying their rows",
+        )
+        parser.add_argument(
+            "--now", help="maintain as if it were this instant (ISO 8601)"
+        )
+        parser.add_argument(
+            "--status", action="store_true", help="only show the partitions"
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError(
+                f"partitioning needs Postgres - {connection.vendor} tables are left "
+                "as they are"
+            )
+        if not options["status"]:
+            self.partition(options)
+        for model in (State, TransferEvent):
+            months = partitions.partitions(model)
+            if not partitions.is_partitioned(model):
+                self.stdout.write(f"{model._meta.db_table}: not partitioned")
+            elif months:
+                self.stdout.write(
+                    f"{model._meta.db_table}: {len(months)} monthly partitions, "
+                    f"{min(months.values()):%Y-%m} to {max(months.values()):%Y-%m}"
+                )
+
+    def partition(self, options):
+        table_partitions = state_event_handler.table_partitions
+        if table_partitions is None:
+            raise CommandError("STATE_PARTITIONS is not set")
+
+        now = dateutil.parser.isoparse(options["now"]) if options["now"] else None
+        now = now or timezone.now()
+        for model in (State, TransferEvent):
+            table = model._meta.db_table
+            if not partitions.is_partitioned(model):
+                if not options["convert"]:
+                    raise CommandError(
+                        f"{table} isn't partitioned - run with --convert first"
+                    )
+                started = time.perf_counter()
+                copied = table_partitions.convert(model, now)
+                self.stdout.write(
+                    f"{table}: partitioned, {copied} rows copied in "
+                    f"{time.perf_counter() - started:.1f} s"
+                )
+            created, archived = table_partitions.maintain(
+                model, now, state_event_handler.history_archive
+            )
+            for name in created:
+                self.stdout.write(f"{table}: created {name}")
+            for name, moved in archived.items():
+                self.stdout.write(
+                    f"{table}: moved {moved} rows of {name} to the archive and dropped it"
+                )
+            if table_partitions.keep is not None and (
+                state_event_handler.history_archive is None
+            ):
+                self.stdout.write(
+                    f"{table}: STATE_ARCHIVE is not set - keeping the old partitions"
+                )
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+import time
+
+from state import event_handler
+from state.models import LocationRollup
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes the LOCATION_ROLLUPS rollups from State - after enabling them or "
+        "changing their bucket size. Stop the MQTT consumers first."
+    )
+
+    def handle(self, *args, **options):
+        rollups = event_handler.rollups
+        if rollups is None:
+            raise CommandError("LOCATION_ROLLUPS is not set")
+        started = time.perf_counter()
+        rollups.rebuild()
+        self.stdout.write(
+            f"{LocationRollup.objects.count()} rollups of {rollups.bucket} s in "
+            f"{time.perf_counter() - started:.1f} s"
+        )
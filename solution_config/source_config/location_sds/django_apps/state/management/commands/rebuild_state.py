@@ -0,0 +1,117 @@
+from contextlib import redirect_stdout
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+import os
+import time
+
+from state import rebuild
+from state.models import RebuiltState
+from state.open_state_index import open_state_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Regenerates State from the event log. Events are streamed in timestamp order "
+        "and replayed into the RebuiltState table in batches, with a checkpoint after "
+        "each so that an interrupted rebuild can be resumed. The result is then swapped "
+        "in for State, or with --dry-run compared with it. Stop the MQTT consumers first."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=5000, help="events per transaction"
+        )
+        parser.add_argument(
+            "--chunk-size", type=int, default=2000, help="rows fetched per cursor read"
+        )
+        parser.add_argument("--checkpoint", default="rebuild_state.checkpoint.json")
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="continue from the checkpoint of an interrupted rebuild",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="compare the rebuilt states with State instead of replacing it",
+        )
+        parser.add_argument(
+            "--samples", type=int, default=10, help="differing rows shown by --dry-run"
+        )
+
+    def handle(self, *args, **options):
+        store = rebuild.RebuildStore()
+        dry_run = options["dry_run"]
+        checkpoint_path = options["checkpoint"]
+        through = None
+        events = 0
+
+        if options["resume"]:
+            if not os.path.exists(checkpoint_path):
+                raise CommandError(f"no checkpoint at {checkpoint_path}")
+            checkpoint = rebuild.load_checkpoint(checkpoint_path)
+            through = parse_datetime(checkpoint["through"])
+            events = checkpoint["events"]
+            # states closed by the batch that was interrupted
+            RebuiltState.objects.filter(end__gt=through).delete()
+            store.restore(
+                (item_id, location_link, parse_datetime(start), quantity)
+                for item_id, location_link, start, quantity in checkpoint["open"]
+            )
+            self.stdout.write(f"resuming after {through} ({events} events replayed)")
+        else:
+            RebuiltState.objects.all().delete()
+
+        started = time.perf_counter()
+        replayed = 0
+        moved = 0
+        with open(os.devnull, "w") as devnull:
+            for batch in rebuild.batches(
+                rebuild.events_after(through, options["chunk_size"]),
+                options["batch_size"],
+            ):
+                with redirect_stdout(devnull):  # the handler prints every change
+                    moved += rebuild.apply_batch(
+                        store, batch, update_events=not dry_run
+                    )
+                replayed += len(batch)
+                through = batch[-1].timestamp
+                rebuild.save_checkpoint(
+                    checkpoint_path, through, events + replayed, store
+                )
+
+                elapsed = time.perf_counter() - started
+                self.stdout.write(
+                    f"{events + replayed} events through {through.isoformat()}  "
+                    f"{replayed / elapsed:.0f} events/s"
+                )
+        store.finish()
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(
+            f"replayed {replayed} events in {elapsed:.1f} s "
+            f"({replayed / elapsed if elapsed else 0:.0f} events/s), "
+            f"{RebuiltState.objects.count()} states, "
+            f"{moved} events with a different from location"
+            + (" (not written)" if dry_run else "")
+        )
+
+        if dry_run:
+            only_live, only_rebuilt = rebuild.diff()
+            for label, rows in (
+                ("only in State", only_live),
+                ("only in the rebuild", only_rebuilt),
+            ):
+                self.stdout.write(f"{rows.count()} rows {label}")
+                for row in rows[: options["samples"]]:
+                    self.stdout.write(f"  {row}")
+            RebuiltState.objects.all().delete()
+        else:
+            rebuild.swap_in()
+            open_state_index.invalidate()
+            self.stdout.write(
+                self.style.SUCCESS("State replaced - restart the MQTT consumers")
+            )
+
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
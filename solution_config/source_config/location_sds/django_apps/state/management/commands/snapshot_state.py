@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+import dateutil.parser
+
+from state import event_handler as state_event_handler
+from state.snapshots import StateSnapshots
+
+
+class Command(BaseCommand):
+    help = (
+        "Snapshots the open states at the latest STATE_SNAPSHOTS checkpoint if it is "
+        "missing and deletes the snapshots past the retention period. Run it from cron "
+        "at least once every interval."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--backfill",
+            action="store_true",
+            help="also take every missing snapshot within the retention period",
+        )
+        parser.add_argument(
+            "--at", help="snapshot this instant (ISO 8601) instead of a checkpoint"
+        )
+        parser.add_argument(
+            "--clear", action="store_true", help="delete every snapshot and stop"
+        )
+
+    def handle(self, *args, **options):
+        snapshots = state_event_handler.snapshots
+        if options["clear"]:
+            # also wanted when snapshots have been turned off since
+            (snapshots or StateSnapshots()).invalidate()
+            self.stdout.write("snapshots deleted")
+            return
+        if snapshots is None:
+            raise CommandError("STATE_SNAPSHOTS is not set")
+
+        now = timezone.now()
+        if options["at"]:
+            taken = [snapshots.take(dateutil.parser.isoparse(options["at"]))]
+        else:
+            taken = snapshots.take_due(now, backfill=options["backfill"])
+        for snapshot in taken:
+            self.stdout.write(
+                f"{snapshot.taken_at.isoformat()}: {snapshot.count} states, "
+                f"{len(snapshot.record_ids)} bytes"
+            )
+        pruned = snapshots.prune(now)
+        if pruned:
+            self.stdout.write(f"deleted {pruned} snapshots past the retention period")
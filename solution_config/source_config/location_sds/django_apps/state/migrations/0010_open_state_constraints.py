@@ -0,0 +1,55 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:43
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def close_duplicate_open_states(apps, schema_editor):
+    # keep the most recent open state and close the others when it started
+    State = apps.get_model("state", "State")
+
+    for group_fields, extra_filter in (
+        (["item_id"], {"quantity__isnull": True}),
+        (["item_id", "location_link"], {}),
+    ):
+        open_states = State.objects.filter(end__isnull=True, **extra_filter)
+        duplicates = (
+            open_states.values(*group_fields)
+            .annotate(count=Count("record_id"))
+            .filter(count__gt=1)
+        )
+        for group in duplicates:
+            group.pop("count")
+            latest, *older = open_states.filter(**group).order_by(
+                "-start", "-record_id"
+            )
+            for state in older:
+                state.end = latest.start
+                state.save(update_fields=["end"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("state", "0009_status_and_notes"),
+    ]
+
+    operations = [
+        migrations.RunPython(close_duplicate_open_states, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="state",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("end__isnull", True), ("quantity__isnull", True)),
+                fields=("item_id",),
+                name="open_individual_state",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="state",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("end__isnull", True)),
+                fields=("item_id", "location_link"),
+                name="open_state_per_location",
+            ),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("state", "0010_open_state_constraints"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProcessedMessage",
+            fields=[
+                (
+                    "fingerprint",
+                    models.CharField(max_length=40, primary_key=True, serialize=False),
+                ),
+                ("received", models.DateTimeField(db_index=True)),
+            ],
+            options={
+                "verbose_name_plural": "Processed Messages",
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("state", "0011_processedmessage"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="productionevent",
+            index=models.Index(
+                fields=["item_id", "timestamp"], name="production_item_time_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="productioneventinput",
+            index=models.Index(
+                fields=["item_id", "timestamp"], name="input_item_time_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transferevent",
+            index=models.Index(
+                fields=["item_id", "timestamp"], name="transfer_item_time_idx"
+            ),
+        ),
+    ]
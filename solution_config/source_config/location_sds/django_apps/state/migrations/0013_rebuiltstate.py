@@ -0,0 +1,27 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("state", "0012_event_item_time_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RebuiltState",
+            fields=[
+                ("record_id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("item_id", models.CharField(max_length=32)),
+                ("location_link", models.CharField(max_length=32)),
+                ("start", models.DateTimeField()),
+                ("end", models.DateTimeField(blank=True, null=True)),
+                ("quantity", models.IntegerField(blank=True, null=True)),
+            ],
+            options={
+                "verbose_name_plural": "Rebuilt State Records",
+            },
+        ),
+    ]
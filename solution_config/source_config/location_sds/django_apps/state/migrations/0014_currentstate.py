@@ -0,0 +1,54 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:14
+
+from django.db import migrations, models
+
+
+def fill_current_state(apps, schema_editor):
+    State = apps.get_model("state", "State")
+    CurrentState = apps.get_model("state", "CurrentState")
+
+    CurrentState.objects.bulk_create(
+        (
+            CurrentState(
+                record_id=state.record_id,
+                item_id=state.item_id,
+                location_link=state.location_link,
+                start=state.start,
+                quantity=state.quantity,
+            )
+            for state in State.objects.filter(end__isnull=True).iterator()
+        ),
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("state", "0013_rebuiltstate"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CurrentState",
+            fields=[
+                (
+                    "record_id",
+                    models.BigIntegerField(primary_key=True, serialize=False),
+                ),
+                ("item_id", models.CharField(max_length=32)),
+                ("location_link", models.CharField(max_length=32)),
+                ("start", models.DateTimeField()),
+                ("quantity", models.IntegerField(blank=True, null=True)),
+            ],
+            options={
+                "verbose_name_plural": "Current State Records",
+                "indexes": [
+                    models.Index(fields=["item_id"], name="current_item_idx"),
+                    models.Index(fields=["location_link"], name="current_loc_link_idx"),
+                    models.Index(fields=["-start"], name="current_start_idx"),
+                ],
+            },
+        ),
+        migrations.RunPython(fill_current_state, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,90 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:32
+
+from django.db import migrations
+
+# see state/intervals.py for the queries these serve - a row whose end is before its
+# start is indexed as [start, start], as the range and the R*Tree both reject lo > hi
+POSTGRES_INDEX = (
+    'CREATE INDEX IF NOT EXISTS "state_interval_idx" ON "state_state" USING gist '
+    '(tstzrange("start", CASE WHEN "end" < "start" THEN "start" ELSE "end" END, '
+    '\'[]\'))'
+)
+
+
+def seconds(column):
+    return f"CAST(strftime('%s', {column}) AS INTEGER)"
+
+
+# whole seconds - an open end, and anything past 2038, is the largest 32 bit value
+def interval(row):
+    start = seconds(f'{row}"start"')
+    end = seconds(f'{row}"end"')
+    return f"{start}, MAX({start}, COALESCE(MIN({end} + 1, 2147483647), 2147483647))"
+
+
+SQLITE_STATEMENTS = [
+    'CREATE VIRTUAL TABLE "state_state_interval" USING rtree_i32(id, lo, hi)',
+    'INSERT INTO "state_state_interval" (id, lo, hi) '
+    f'SELECT "record_id", {interval("")} FROM "state_state"',
+    'CREATE TRIGGER "state_interval_insert" AFTER INSERT ON "state_state" BEGIN '
+    'INSERT INTO "state_state_interval" (id, lo, hi) '
+    f'VALUES (new."record_id", {interval("new.")}); END',
+    'CREATE TRIGGER "state_interval_update" AFTER UPDATE OF "start", "end" '
+    'ON "state_state" BEGIN '
+    'DELETE FROM "state_state_interval" WHERE id = old."record_id"; '
+    'INSERT INTO "state_state_interval" (id, lo, hi) '
+    f'VALUES (new."record_id", {interval("new.")}); END',
+    'CREATE TRIGGER "state_interval_delete" AFTER DELETE ON "state_state" BEGIN '
+    'DELETE FROM "state_state_interval" WHERE id = old."record_id"; END',
+]
+SQLITE_REVERSE = [
+    'DROP TRIGGER IF EXISTS "state_interval_insert"',
+    'DROP TRIGGER IF EXISTS "state_interval_update"',
+    'DROP TRIGGER IF EXISTS "state_interval_delete"',
+    'DROP TABLE IF EXISTS "state_state_interval"',
+]
+
+
+def sqlite_has_rtree(cursor):
+    try:
+        cursor.execute(
+            'CREATE VIRTUAL TABLE "temp"."rtree_probe" USING rtree_i32(id, lo, hi)'
+        )
+    except Exception:
+        return False
+    cursor.execute('DROP TABLE "temp"."rtree_probe"')
+    return True
+
+
+def create_interval_index(apps, schema_editor):
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(POSTGRES_INDEX)
+        elif connection.vendor == "sqlite":
+            if not sqlite_has_rtree(cursor):
+                print("SQLite has no R*Tree module - ?t= queries will scan State")
+                return
+            for statement in SQLITE_STATEMENTS:
+                cursor.execute(statement)
+
+
+def drop_interval_index(apps, schema_editor):
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute('DROP INDEX IF EXISTS "state_interval_idx"')
+        elif connection.vendor == "sqlite":
+            for statement in SQLITE_REVERSE:
+                cursor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("state", "0014_currentstate"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_interval_index, drop_interval_index),
+    ]
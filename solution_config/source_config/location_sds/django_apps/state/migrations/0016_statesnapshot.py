@@ -0,0 +1,24 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("state", "0015_state_interval_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StateSnapshot",
+            fields=[
+                ("taken_at", models.DateTimeField(primary_key=True, serialize=False)),
+                ("count", models.IntegerField()),
+                ("record_ids", models.BinaryField()),
+            ],
+            options={
+                "verbose_name_plural": "State Snapshots",
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("state", "0016_statesnapshot"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="state",
+            index=models.Index(
+                fields=["item_id", "-start", "-record_id"], name="item_start_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="state",
+            index=models.Index(
+                fields=["location_link", "-start", "-record_id"],
+                name="loc_link_start_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transferevent",
+            index=models.Index(
+                fields=["-timestamp", "-event_id"], name="transfer_time_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("state", "0017_keyset_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StateVersion",
+            fields=[
+                (
+                    "key",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("version", models.BigIntegerField()),
+            ],
+            options={
+                "verbose_name_plural": "State Versions",
+            },
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("state", "0018_stateversion"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="transferevent",
+            name="transfer_item_time_idx",
+        ),
+        migrations.AddIndex(
+            model_name="productionevent",
+            index=models.Index(
+                fields=["location_link", "timestamp", "event_id"],
+                name="production_loc_time_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="productionevent",
+            index=models.Index(
+                fields=["from_location_link", "timestamp", "event_id"],
+                name="production_from_time_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="productioneventinput",
+            index=models.Index(
+                fields=["location_link", "timestamp", "id"], name="input_loc_time_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transferevent",
+            index=models.Index(
+                fields=["item_id", "timestamp", "event_id"],
+                name="transfer_item_time_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transferevent",
+            index=models.Index(
+                fields=["to_location_link", "timestamp", "event_id"],
+                name="transfer_to_time_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transferevent",
+            index=models.Index(
+                fields=["from_location_link", "timestamp", "event_id"],
+                name="transfer_from_time_idx",
+            ),
+        ),
+    ]
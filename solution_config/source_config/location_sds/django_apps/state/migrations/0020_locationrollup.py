@@ -0,0 +1,41 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("state", "0019_event_location_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LocationRollup",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("location_link", models.CharField(max_length=32)),
+                ("bucket", models.DateTimeField()),
+                ("entered", models.BigIntegerField(default=0)),
+                ("exited", models.BigIntegerField(default=0)),
+            ],
+            options={
+                "verbose_name_plural": "Location Rollups",
+                "indexes": [models.Index(fields=["bucket"], name="rollup_bucket_idx")],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="locationrollup",
+            constraint=models.UniqueConstraint(
+                fields=("location_link", "bucket"), name="rollup_location_bucket_uniq"
+            ),
+        ),
+    ]
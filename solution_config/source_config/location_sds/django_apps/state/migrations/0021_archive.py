@@ -0,0 +1,155 @@
+# Generated by Django 5.0.6 on 2026-10-18 12:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("state", "0020_locationrollup"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ArchiveCheckpoint",
+            fields=[
+                (
+                    "key",
+                    models.CharField(max_length=32, primary_key=True, serialize=False),
+                ),
+                ("before", models.DateTimeField()),
+                ("last_id", models.BigIntegerField(default=0)),
+                ("moved", models.BigIntegerField(default=0)),
+                ("finished", models.BooleanField(default=False)),
+            ],
+            options={
+                "verbose_name_plural": "Archive Checkpoints",
+            },
+        ),
+        migrations.CreateModel(
+            name="ArchivedProductionEvent",
+            fields=[
+                ("event_id", models.BigIntegerField(primary_key=True, serialize=False)),
+                ("item_id", models.CharField(max_length=32)),
+                (
+                    "from_location_link",
+                    models.CharField(blank=True, max_length=32, null=True),
+                ),
+                ("location_link", models.CharField(max_length=32)),
+                ("quantity", models.IntegerField(blank=True, null=True)),
+                ("timestamp", models.DateTimeField()),
+            ],
+            options={
+                "verbose_name_plural": "Archived Production Event Records",
+                "indexes": [
+                    models.Index(
+                        fields=["item_id", "timestamp"],
+                        name="archived_production_item_idx",
+                    ),
+                    models.Index(
+                        fields=["location_link", "timestamp", "event_id"],
+                        name="archived_production_loc_idx",
+                    ),
+                    models.Index(
+                        fields=["from_location_link", "timestamp", "event_id"],
+                        name="archived_production_from_idx",
+                    ),
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="ArchivedState",
+            fields=[
+                (
+                    "record_id",
+                    models.BigIntegerField(primary_key=True, serialize=False),
+                ),
+                ("item_id", models.CharField(max_length=32)),
+                ("location_link", models.CharField(max_length=32)),
+                ("start", models.DateTimeField()),
+                ("end", models.DateTimeField()),
+                ("quantity", models.IntegerField(blank=True, null=True)),
+            ],
+            options={
+                "verbose_name_plural": "Archived State Records",
+                "indexes": [
+                    models.Index(
+                        fields=["-start", "-record_id"], name="archived_start_idx"
+                    ),
+                    models.Index(
+                        fields=["item_id", "-start", "-record_id"],
+                        name="archived_item_start_idx",
+                    ),
+                    models.Index(
+                        fields=["location_link", "-start", "-record_id"],
+                        name="archived_loc_start_idx",
+                    ),
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="ArchivedTransferEvent",
+            fields=[
+                ("event_id", models.BigIntegerField(primary_key=True, serialize=False)),
+                ("item_id", models.CharField(max_length=32)),
+                (
+                    "from_location_link",
+                    models.CharField(blank=True, max_length=32, null=True),
+                ),
+                ("to_location_link", models.CharField(max_length=32)),
+                ("quantity", models.IntegerField(blank=True, null=True)),
+                ("timestamp", models.DateTimeField()),
+            ],
+            options={
+                "verbose_name_plural": "Archived Transfer Event Records",
+                "indexes": [
+                    models.Index(
+                        fields=["item_id", "timestamp", "event_id"],
+                        name="archived_transfer_item_idx",
+                    ),
+                    models.Index(
+                        fields=["-timestamp", "-event_id"],
+                        name="archived_transfer_time_idx",
+                    ),
+                    models.Index(
+                        fields=["to_location_link", "timestamp", "event_id"],
+                        name="archived_transfer_to_idx",
+                    ),
+                    models.Index(
+                        fields=["from_location_link", "timestamp", "event_id"],
+                        name="archived_transfer_from_idx",
+                    ),
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="ArchivedProductionEventInput",
+            fields=[
+                ("id", models.BigIntegerField(primary_key=True, serialize=False)),
+                ("item_id", models.CharField(max_length=32)),
+                ("location_link", models.CharField(max_length=32)),
+                ("quantity", models.IntegerField(blank=True, null=True)),
+                ("timestamp", models.DateTimeField()),
+                (
+                    "production_event",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="inputs",
+                        to="state.archivedproductionevent",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["item_id", "timestamp"], name="archived_input_item_idx"
+                    ),
+                    models.Index(
+                        fields=["location_link", "timestamp", "id"],
+                        name="archived_input_loc_idx",
+                    ),
+                ],
+            },
+        ),
+    ]
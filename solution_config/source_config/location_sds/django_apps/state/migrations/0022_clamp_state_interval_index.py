@@ -0,0 +1,66 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:05
+
+from django.db import migrations
+
+# 0015 once indexed [start, end] as is, which fails for a row whose end is before its
+# start - databases migrated before it clamped the interval get the clamped index and
+# triggers here. A row like that is indexed as [start, start].
+POSTGRES_STATEMENTS = [
+    'DROP INDEX IF EXISTS "state_interval_idx"',
+    'CREATE INDEX "state_interval_idx" ON "state_state" USING gist '
+    '(tstzrange("start", CASE WHEN "end" < "start" THEN "start" ELSE "end" END, '
+    '\'[]\'))',
+]
+
+
+def seconds(column):
+    return f"CAST(strftime('%s', {column}) AS INTEGER)"
+
+
+def interval(row):
+    start = seconds(f'{row}"start"')
+    end = seconds(f'{row}"end"')
+    return f"{start}, MAX({start}, COALESCE(MIN({end} + 1, 2147483647), 2147483647))"
+
+
+SQLITE_STATEMENTS = [
+    'DROP TRIGGER IF EXISTS "state_interval_insert"',
+    'DROP TRIGGER IF EXISTS "state_interval_update"',
+    'CREATE TRIGGER "state_interval_insert" AFTER INSERT ON "state_state" BEGIN '
+    'INSERT INTO "state_state_interval" (id, lo, hi) '
+    f'VALUES (new."record_id", {interval("new.")}); END',
+    'CREATE TRIGGER "state_interval_update" AFTER UPDATE OF "start", "end" '
+    'ON "state_state" BEGIN '
+    'DELETE FROM "state_state_interval" WHERE id = old."record_id"; '
+    'INSERT INTO "state_state_interval" (id, lo, hi) '
+    f'VALUES (new."record_id", {interval("new.")}); END',
+]
+
+
+def clamp_interval_index(apps, schema_editor):
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            statements = POSTGRES_STATEMENTS
+        elif connection.vendor == "sqlite":
+            cursor.execute(
+                "SELECT count(*) FROM sqlite_master WHERE name = 'state_state_interval'"
+            )
+            # no R*Tree module when 0015 ran
+            statements = SQLITE_STATEMENTS if cursor.fetchone()[0] else []
+        else:
+            statements = []
+        for statement in statements:
+            cursor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("state", "0021_archive"),
+    ]
+
+    operations = [
+        # 0015 creates the clamped index and triggers since, so there is nothing to undo
+        migrations.RunPython(clamp_interval_index, migrations.RunPython.noop),
+    ]
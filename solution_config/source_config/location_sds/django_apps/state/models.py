@@ -13,6 +13,17 @@ class TransferEvent(models.Model):
 
     class Meta:
         verbose_name_plural = 'Transfer Event Records'
+        indexes = [
+            # an item's events since a late one are replayed in timestamp order, and
+            # /events/for/<item_id> pages through them on (timestamp, event_id)
+            models.Index(fields=["item_id", "timestamp", "event_id"], name="transfer_item_time_idx"),
+            # keyset pages of /events/, newest first
+            models.Index(fields=["-timestamp", "-event_id"], name="transfer_time_idx"),
+            # /events/to/, /events/from/ and /events/at/ - read in (timestamp, event_id)
+            # order either way
+            models.Index(fields=["to_location_link", "timestamp", "event_id"], name="transfer_to_time_idx"),
+            models.Index(fields=["from_location_link", "timestamp", "event_id"], name="transfer_from_time_idx"),
+        ]
 
 
 class ProductionEvent(models.Model):
@@ -25,6 +36,12 @@ class ProductionEvent(models.Model):
 
     class Meta:
         verbose_name_plural = "Production Event Records"
+        indexes = [
+            models.Index(fields=["item_id", "timestamp"], name="production_item_time_idx"),
+            # /events/at/ reads production at and from a location in (timestamp, event_id) order
+            models.Index(fields=["location_link", "timestamp", "event_id"], name="production_loc_time_idx"),
+            models.Index(fields=["from_location_link", "timestamp", "event_id"], name="production_from_time_idx"),
+        ]
 
 
 class ProductionEventInput(models.Model):
@@ -36,6 +53,13 @@ class ProductionEventInput(models.Model):
     )
     timestamp = models.DateTimeField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["item_id", "timestamp"], name="input_item_time_idx"),
+            # /events/at/ reads the inputs consumed at a location in (timestamp, id) order
+            models.Index(fields=["location_link", "timestamp", "id"], name="input_loc_time_idx"),
+        ]
+
 
 class State(models.Model):
     record_id = models.BigAutoField(primary_key=True)
@@ -54,8 +78,214 @@ class State(models.Model):
             models.Index(fields=['item_id',],name="item_idx"),
             models.Index(fields=['location_link',"item_id","end"], name="loc_link_idx"),
             models.Index(fields=['-start','-end'], name="timestamp_idx"),
+            # keyset pages of an item's or a location's history, newest first
+            models.Index(fields=['item_id','-start','-record_id'], name="item_start_idx"),
+            models.Index(fields=['location_link','-start','-record_id'], name="loc_link_start_idx"),
+        ]
+        constraints = [
+            # stop concurrent consumers opening a second state for the same item
+            models.UniqueConstraint(
+                fields=["item_id"],
+                condition=models.Q(end__isnull=True, quantity__isnull=True),
+                name="open_individual_state",
+            ),
+            models.UniqueConstraint(
+                fields=["item_id", "location_link"],
+                condition=models.Q(end__isnull=True),
+                name="open_state_per_location",
+            ),
+        ]
+
+class CurrentState(models.Model):
+    # the open (end IS NULL) State rows, one per item and location, read by /state/
+    # without ?t= so that it never touches the history - kept in step with State
+    # inside the transaction that changes it
+    record_id = models.BigIntegerField(primary_key=True)
+    item_id = models.CharField(max_length=32)
+    location_link = models.CharField(max_length=32)
+    start = models.DateTimeField()
+    quantity = models.IntegerField(blank=True, null=True)
+
+    end = None  # so that it serializes like an open State
+
+    def __str__(self):
+        return self.item_id
+
+    class Meta:
+        verbose_name_plural = 'Current State Records'
+        indexes = [
+            models.Index(fields=['item_id'], name="current_item_idx"),
+            models.Index(fields=['location_link'], name="current_loc_link_idx"),
+            models.Index(fields=['-start'], name="current_start_idx"),
+        ]
+
+class RebuiltState(models.Model):
+    # State as rebuilt from the event log by the rebuild_state command, before it is
+    # swapped in - empty otherwise
+    record_id = models.BigAutoField(primary_key=True)
+    item_id = models.CharField(max_length=32)
+    location_link = models.CharField(max_length=32)
+    start = models.DateTimeField()
+    end = models.DateTimeField(blank=True, null=True)
+    quantity = models.IntegerField(blank=True, null=True)
+
+    def __str__(self):
+        return self.item_id
+
+    class Meta:
+        verbose_name_plural = 'Rebuilt State Records'
+
+class StateSnapshot(models.Model):
+    # the State rows open at taken_at, written by the snapshot_state command - ?t= queries
+    # start from the nearest earlier one
+    taken_at = models.DateTimeField(primary_key=True)
+    count = models.IntegerField()
+    record_ids = models.BinaryField()  # sorted, delta encoded and zlib compressed
+
+    def __str__(self):
+        return f"{self.count} states at {self.taken_at}"
+
+    class Meta:
+        verbose_name_plural = 'State Snapshots'
+
+class StateVersion(models.Model):
+    # a version counter - "global", "all", "item:<item_id>" or "location:<location_link>" -
+    # set to the next global version whenever what it counts changes, for ETags
+    key = models.CharField(max_length=64, primary_key=True)
+    version = models.BigIntegerField()
+
+    def __str__(self):
+        return f"{self.key}: {self.version}"
+
+    class Meta:
+        verbose_name_plural = 'State Versions'
+
+class LocationRollup(models.Model):
+    # the quantity that entered and left a location in a base bucket of LOCATION_ROLLUPS
+    # starting at bucket - an individually tracked item counts as 1
+    location_link = models.CharField(max_length=32)
+    bucket = models.DateTimeField()
+    entered = models.BigIntegerField(default=0)
+    exited = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.location_link} {self.bucket}: +{self.entered} -{self.exited}"
+
+    class Meta:
+        verbose_name_plural = 'Location Rollups'
+        constraints = [
+            models.UniqueConstraint(fields=["location_link", "bucket"], name="rollup_location_bucket_uniq"),
+        ]
+        indexes = [
+            # /report/rollup over every location
+            models.Index(fields=["bucket"], name="rollup_bucket_idx"),
         ]
 
+class ArchivedState(models.Model):
+    # closed State rows older than the STATE_ARCHIVE horizon, moved here by the
+    # archive_history command with their record_id (see archive.py)
+    record_id = models.BigIntegerField(primary_key=True)
+    item_id = models.CharField(max_length=32)
+    location_link = models.CharField(max_length=32)
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    quantity = models.IntegerField(blank=True, null=True)
+
+    def __str__(self):
+        return self.item_id
+
+    class Meta:
+        verbose_name_plural = 'Archived State Records'
+        indexes = [
+            # the history views, newest first, and a late event's item brought back
+            models.Index(fields=["-start", "-record_id"], name="archived_start_idx"),
+            models.Index(fields=["item_id", "-start", "-record_id"], name="archived_item_start_idx"),
+            models.Index(fields=["location_link", "-start", "-record_id"], name="archived_loc_start_idx"),
+        ]
+
+class ArchivedTransferEvent(models.Model):
+    # TransferEvent rows older than the STATE_ARCHIVE horizon, with their event_id
+    event_id = models.BigIntegerField(primary_key=True)
+    item_id = models.CharField(max_length=32)
+    from_location_link = models.CharField(max_length=32, blank=True, null=True)
+    to_location_link = models.CharField(max_length=32)
+    quantity = models.IntegerField(blank=True, null=True)
+    timestamp = models.DateTimeField()
+
+    def __str__(self):
+        return self.item_id
+
+    class Meta:
+        verbose_name_plural = 'Archived Transfer Event Records'
+        indexes = [
+            # as TransferEvent's, for the event views
+            models.Index(fields=["item_id", "timestamp", "event_id"], name="archived_transfer_item_idx"),
+            models.Index(fields=["-timestamp", "-event_id"], name="archived_transfer_time_idx"),
+            models.Index(fields=["to_location_link", "timestamp", "event_id"], name="archived_transfer_to_idx"),
+            models.Index(fields=["from_location_link", "timestamp", "event_id"], name="archived_transfer_from_idx"),
+        ]
+
+class ArchivedProductionEvent(models.Model):
+    # ProductionEvent rows older than the STATE_ARCHIVE horizon, with their event_id
+    event_id = models.BigIntegerField(primary_key=True)
+    item_id = models.CharField(max_length=32)
+    from_location_link = models.CharField(max_length=32, blank=True, null=True)
+    location_link = models.CharField(max_length=32)
+    quantity = models.IntegerField(blank=True, null=True)
+    timestamp = models.DateTimeField()
+
+    class Meta:
+        verbose_name_plural = 'Archived Production Event Records'
+        indexes = [
+            models.Index(fields=["item_id", "timestamp"], name="archived_production_item_idx"),
+            models.Index(fields=["location_link", "timestamp", "event_id"], name="archived_production_loc_idx"),
+            models.Index(fields=["from_location_link", "timestamp", "event_id"], name="archived_production_from_idx"),
+        ]
+
+class ArchivedProductionEventInput(models.Model):
+    # the inputs of the archived production events, moved with them
+    id = models.BigIntegerField(primary_key=True)
+    item_id = models.CharField(max_length=32)
+    location_link = models.CharField(max_length=32)
+    quantity = models.IntegerField(blank=True, null=True)
+    production_event = models.ForeignKey(
+        ArchivedProductionEvent, on_delete=models.CASCADE, related_name="inputs"
+    )
+    timestamp = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["item_id", "timestamp"], name="archived_input_item_idx"),
+            models.Index(fields=["location_link", "timestamp", "id"], name="archived_input_loc_idx"),
+        ]
+
+class ArchiveCheckpoint(models.Model):
+    # the progress of the archive_history command on "state", "transfer" or "production"
+    # (with the inputs): its rows from before `before` are being moved, or were if
+    # finished, and those up to last_id already are
+    key = models.CharField(max_length=32, primary_key=True)
+    before = models.DateTimeField()
+    last_id = models.BigIntegerField(default=0)
+    moved = models.BigIntegerField(default=0)
+    finished = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f"{self.key}: before {self.before}"
+
+    class Meta:
+        verbose_name_plural = 'Archive Checkpoints'
+
+class ProcessedMessage(models.Model):
+    # fingerprint of an ingested transfer/production operation, used to drop redeliveries
+    fingerprint = models.CharField(max_length=40, primary_key=True)
+    received = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.fingerprint
+
+    class Meta:
+        verbose_name_plural = 'Processed Messages'
+
 class Setting(models.Model):
     key = models.CharField(max_length=64, primary_key=True)
     value = models.CharField(max_length=256)
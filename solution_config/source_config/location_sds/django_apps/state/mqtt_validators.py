@@ -0,0 +1,190 @@
+"""
+Fast path validation of MQTT messages against the schemas in mqtt_serializers.
+
+A validator is compiled once from a serializer class into plain functions, so the usual
+well formed message is checked without DRF building a serializer and its fields every
+time. Anything a compiled validator is not sure about - a missing or null field, a value
+of an unexpected type, a timestamp that needs more than ISO 8601 parsing - is handed to
+the DRF serializer, so invalid messages fail with exactly the same ValidationError.
+"""
+
+from django.utils.dateparse import parse_datetime
+from rest_framework import serializers
+from rest_framework.fields import empty
+from rest_framework.settings import api_settings, ISO_8601
+
+from . import mqtt_serializers
+
+
+class _Fallback(Exception):
+    """The message needs the DRF serializer, either to validate it or to report errors"""
+
+
+def drf_validated_data(serializer_class, data):
+    serializer = serializer_class(data=data)
+    serializer.is_valid(raise_exception=True)
+    return serializer.validated_data
+
+
+def _unsupported(field, reason):
+    return TypeError(
+        f"cannot compile {field.__class__.__name__} {field.field_name}: {reason}"
+    )
+
+
+def _char(field):
+    if field.allow_blank:
+        raise _unsupported(field, "allow_blank")
+    trim_whitespace = field.trim_whitespace
+    min_length = field.min_length or 0
+    max_length = field.max_length
+
+    def convert(value):
+        if type(value) is not str:  # DRF coerces numbers to strings
+            raise _Fallback
+        if trim_whitespace:
+            value = value.strip()
+        if (
+            not value
+            or len(value) < min_length
+            or (max_length is not None and len(value) > max_length)
+            or "\x00" in value
+        ):
+            raise _Fallback
+        if not value.isascii() and any("\ud800" <= c <= "\udfff" for c in value):
+            raise _Fallback
+        return value
+
+    return convert
+
+
+def _integer(field):
+    if field.max_value is not None or field.min_value is not None:
+        raise _unsupported(field, "min_value/max_value")
+    re_decimal = field.re_decimal
+    max_string_length = field.MAX_STRING_LENGTH
+
+    def convert(value):
+        if type(value) is int:
+            return value
+        if type(value) is not str or len(value) > max_string_length:
+            raise _Fallback
+        try:
+            return int(re_decimal.sub("", value))
+        except ValueError:
+            raise _Fallback
+
+    return convert
+
+
+def _datetime(field):
+    input_formats = getattr(field, "input_formats", api_settings.DATETIME_INPUT_FORMATS)
+    if [input_format.lower() for input_format in input_formats] != [ISO_8601]:
+        raise _unsupported(field, "input formats other than iso-8601")
+
+    def convert(value):
+        if type(value) is not str:
+            raise _Fallback
+        try:
+            parsed = parse_datetime(value)
+            if parsed is None:
+                raise _Fallback
+            return field.enforce_timezone(parsed)
+        except (ValueError, serializers.ValidationError):
+            raise _Fallback
+
+    return convert
+
+
+def _list(field):
+    if getattr(field, "max_length", None) or getattr(field, "min_length", None):
+        raise _unsupported(field, "min_length/max_length")
+    allow_empty = field.allow_empty
+    convert_entry = _converter(field.child)
+
+    def convert(value):
+        if type(value) is not list or not (value or allow_empty):
+            raise _Fallback
+        return [convert_entry(entry) for entry in value]
+
+    return convert
+
+
+def _serializer(serializer):
+    if type(serializer).validate is not serializers.Serializer.validate or any(
+        hasattr(serializer, f"validate_{name}") for name in serializer.fields
+    ):
+        raise _unsupported(serializer, "custom validate methods")
+
+    fields = []
+    for name, field in serializer.fields.items():
+        if field.read_only:
+            continue
+        if field.default is not empty or field.source == "*" or "." in field.source:
+            raise _unsupported(field, "default or nested source")
+        fields.append(
+            (name, field.source, field.required, field.allow_null, _converter(field))
+        )
+
+    def convert(data):
+        if type(data) is not dict:
+            raise _Fallback
+        validated = {}
+        for name, source, required, allow_null, convert_field in fields:
+            value = data.get(name, empty)
+            if value is empty:
+                if required:
+                    raise _Fallback
+            elif value is None:
+                if not allow_null:
+                    raise _Fallback
+                validated[source] = None
+            else:
+                validated[source] = convert_field(value)
+        return validated
+
+    return convert
+
+
+_CONVERTERS = {
+    serializers.CharField: _char,
+    serializers.IntegerField: _integer,
+    serializers.DateTimeField: _datetime,
+    serializers.ListSerializer: _list,
+}
+
+
+def _converter(field):
+    # exact types only - subclasses such as EmailField add validation of their own
+    if type(field) in _CONVERTERS:
+        return _CONVERTERS[type(field)](field)
+    if isinstance(field, serializers.Serializer):
+        return _serializer(field)
+    raise _unsupported(field, "field type")
+
+
+class FastValidator:
+    """Validates data for serializer_class and returns the same validated_data"""
+
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+        self._convert = _serializer(serializer_class())
+
+    def validated_data(self, data):
+        try:
+            return self._convert(data)
+        except _Fallback:
+            return drf_validated_data(self.serializer_class, data)
+
+
+_validators = {
+    serializer_class: FastValidator(serializer_class)
+    for serializer_class in (
+        mqtt_serializers.TransferOperation,
+        mqtt_serializers.ProductionOperation,
+    )
+}
+
+
+def fast_validated_data(serializer_class, data):
+    return _validators[serializer_class].validated_data(data)
@@ -0,0 +1,176 @@
+from .models import State
+from .store import latest_event
+import threading
+
+STATE_FIELDS = ("record_id", "item_id", "location_link", "start", "end", "quantity")
+
+
+class OpenStateIndex:
+    """
+    Process-local index of open (end IS NULL) State rows keyed by item and by
+    (item, location).
+
+    The index is built from the database on first use. StateStore writes its changes
+    through once the transaction that made them commits, so while the index is
+    loaded a lookup for an item it has not been told is stale needs no query at all.
+    The time of each item's latest event is kept along with its open states, for the
+    late event check.
+    Changes made outside the event handler (e.g. the admin) mark the item as stale.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_item = {}  # item_id -> {location_link: (record_id, start, quantity)}
+        self._latest = {}  # item_id -> timestamp of its latest event
+        self._stale = set()
+        self._loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    def rebuild(self):
+        by_item = {}
+        latest = {}
+        qs = (
+            State.objects.filter(end__isnull=True)
+            .annotate(latest_event=latest_event())
+            .values_list(
+                "record_id",
+                "item_id",
+                "location_link",
+                "start",
+                "quantity",
+                "latest_event",
+            )
+        )
+        for record_id, item_id, location_link, start, quantity, at in qs.iterator():
+            by_item.setdefault(item_id, {})[location_link] = (record_id, start, quantity)
+            latest[item_id] = at
+
+        with self._lock:
+            self._by_item = by_item
+            self._latest = latest
+            self._stale = set()
+            self._loaded = True
+
+    def lookup(self, item_id):
+        """
+        Returns {location_link: State} for the open states of item_id, or None if the
+        database has to be asked instead.
+        """
+        if not self._loaded:
+            self.rebuild()
+
+        with self._lock:
+            if item_id in self._stale:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entries = list(self._by_item.get(item_id, {}).items())
+            latest = self._latest.get(item_id)
+
+        states = {}
+        for location_link, (record_id, start, quantity) in entries:
+            state = State.from_db(
+                None,
+                STATE_FIELDS,
+                (record_id, item_id, location_link, start, None, quantity),
+            )
+            # as StateStore annotates the open states it loads
+            state.latest_event = latest
+            states[location_link] = state
+        return states
+
+    def update(self, open_states, latest=None):
+        """
+        Replaces the entries of each item in open_states, a dict of
+        item_id -> {location_link: State}, and the latest event times in latest, a
+        dict of item_id -> timestamp. Items with unsaved states are marked stale.
+        """
+        latest = latest or {}
+        with self._lock:
+            for item_id, states in open_states.items():
+                self._latest.pop(item_id, None)
+                if any(state.pk is None for state in states.values()):
+                    self._by_item.pop(item_id, None)
+                    self._stale.add(item_id)
+                    continue
+
+                entries = {
+                    location_link: (state.pk, state.start, state.quantity)
+                    for location_link, state in states.items()
+                }
+                if entries:
+                    self._by_item[item_id] = entries
+                    if latest.get(item_id) is not None:
+                        self._latest[item_id] = latest[item_id]
+                else:
+                    self._by_item.pop(item_id, None)
+                self._stale.discard(item_id)
+
+    def invalidate(self, item_id=None):
+        with self._lock:
+            if item_id is None:
+                self._by_item = {}
+                self._latest = {}
+                self._stale = set()
+                self._loaded = False
+            else:
+                self._by_item.pop(item_id, None)
+                self._latest.pop(item_id, None)
+                self._stale.add(item_id)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "loaded": self._loaded,
+                "items": len(self._by_item),
+                "open_states": sum(len(entry) for entry in self._by_item.values()),
+                "stale_items": len(self._stale),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+            }
+
+    def verify(self):
+        """
+        Compares the index against the open states in the database. Stale items are
+        skipped as they will be reloaded on their next lookup. Returns a list of
+        differences - empty if the index is consistent.
+        """
+        with self._lock:
+            if not self._loaded:
+                return []
+            indexed = {
+                (item_id, location_link): entry
+                for item_id, entries in self._by_item.items()
+                for location_link, entry in entries.items()
+            }
+            stale = set(self._stale)
+
+        actual = {
+            (item_id, location_link): (record_id, start, quantity)
+            for record_id, item_id, location_link, start, quantity in State.objects.filter(
+                end__isnull=True
+            )
+            .values_list("record_id", "item_id", "location_link", "start", "quantity")
+            .iterator()
+            if item_id not in stale
+        }
+
+        differences = []
+        for key in indexed.keys() | actual.keys():
+            if key[0] in stale or indexed.get(key) == actual.get(key):
+                continue
+            differences.append(
+                {
+                    "item_id": key[0],
+                    "location_link": key[1],
+                    "index": indexed.get(key),
+                    "database": actual.get(key),
+                }
+            )
+        return differences
+
+
+open_state_index = OpenStateIndex()
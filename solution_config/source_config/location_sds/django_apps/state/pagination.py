@@ -0,0 +1,130 @@
+"""
+Keyset pagination for the history and event list views.
+
+Rows are returned newest first, ordered on a time field with the primary key as the
+tie-break. ?limit=N returns at most N rows along with an opaque cursor for the rest, sent
+in the X-Next-Cursor header and as a Link: <...>; rel="next" URL, so the response body is
+the same list for the JSON, Browsable API and CSV renderers. Passing it back as ?cursor=
+filters on the last row's key rather than counting rows, so every page costs the same.
+Without ?limit= or ?cursor= the whole result is returned, as before.
+
+paginate_merged() does the same over several querysets of the same columns - the hot and
+archived rows of a table (see archive.py) - merging their rows in order.
+"""
+
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.utils.urls import replace_query_param
+import base64
+import dateutil.parser
+import heapq
+import itertools
+import json
+
+from .streaming import iterate
+
+DEFAULT_LIMIT = 1000
+MAX_LIMIT = 10000
+
+STATE_KEY = ("start", "record_id")
+EVENT_KEY = ("timestamp", "event_id")
+
+
+def encode_cursor(timestamp, *key):
+    """A cursor for a row's (timestamp, integers...) key"""
+    data = json.dumps([timestamp.isoformat(), *key], separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, length=2):
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        timestamp, *key = json.loads(data)
+        if len(key) != length - 1:
+            raise ValueError(cursor)
+        return (dateutil.parser.isoparse(timestamp), *map(int, key))
+    except (ValueError, TypeError):
+        raise ValidationError({"cursor": "Invalid cursor."})
+
+
+def page_limit(request):
+    limit = request.GET.get("limit", None)
+    if limit is None:
+        return DEFAULT_LIMIT
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ValidationError({"limit": "A whole number is required."})
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ValidationError({"limit": f"Must be between 1 and {MAX_LIMIT}."})
+    return limit
+
+
+def paginate(request, queryset, key):
+    """
+    Orders queryset newest first on key - (time field, primary key field). If the request
+    asks for a page, returns the page's rows and the cursor of the next page (None on the
+    last page), otherwise the ordered queryset and None. The queryset may be of model
+    instances or of named .values_list() rows with both key fields.
+    """
+    time_field, pk_field = key
+    queryset = queryset.order_by(f"-{time_field}", f"-{pk_field}")
+    if "limit" not in request.GET and "cursor" not in request.GET:
+        return queryset, None
+
+    limit = page_limit(request)
+    cursor = request.GET.get("cursor", None)
+    if cursor:
+        timestamp, pk = decode_cursor(cursor)
+        # the bound on the time field alone lets an index on it start at the cursor
+        queryset = queryset.filter(
+            Q(**{f"{time_field}__lte": timestamp})
+            & (Q(**{f"{time_field}__lt": timestamp}) | Q(**{f"{pk_field}__lt": pk}))
+        )
+
+    rows = list(queryset[: limit + 1])
+    if len(rows) <= limit:
+        return rows, None
+    last = rows[limit - 1]
+    return rows[:limit], encode_cursor(
+        getattr(last, time_field), getattr(last, pk_field)
+    )
+
+
+def paginate_merged(request, querysets, key):
+    """
+    paginate() over querysets of rows with the same columns, merged newest first. Each
+    is read up to a page, and the cursor of the merged page resumes all of them.
+    """
+    time_field, pk_field = key
+    pages = [paginate(request, queryset, key) for queryset in querysets]
+    merged = merge([rows for rows, next_cursor in pages], key)
+    if "limit" not in request.GET and "cursor" not in request.GET:
+        return merged, None
+
+    limit = page_limit(request)
+    rows = list(itertools.islice(merged, limit + 1))
+    more = len(rows) > limit or any(next_cursor for _, next_cursor in pages)
+    if not more:
+        return rows, None
+    last = rows[limit - 1]
+    return rows[:limit], encode_cursor(
+        getattr(last, time_field), getattr(last, pk_field)
+    )
+
+
+def merge(querysets, key):
+    """The rows of querysets, each ordered newest first on key, merged in that order"""
+    time_field, pk_field = key
+    return heapq.merge(
+        *map(iterate, querysets),
+        key=lambda row: (getattr(row, time_field), getattr(row, pk_field)),
+        reverse=True,
+    )
+
+
+def next_page_headers(request, next_cursor):
+    if next_cursor is None:
+        return {}
+    next_url = replace_query_param(request.build_absolute_uri(), "cursor", next_cursor)
+    return {"X-Next-Cursor": next_cursor, "Link": f'<{next_url}>; rel="next"'}
@@ -0,0 +1,281 @@
+"""
+Monthly range partitions of State and TransferEvent on Postgres, for the partition_tables
+command.
+
+TransferEvent is partitioned on timestamp. State is partitioned on end: its open states
+- NULL end - all sit in the default partition, which keeps the open_individual_state
+and open_state_per_location unique indexes exact as indexes of that partition alone (a
+unique index of the whole table would have to include end). A closed state moves to
+the partition of the month it ended in. Queries bounded by from/to then skip the months
+outside them - for State, (end >= from OR end IS NULL) skips those before from.
+
+convert() turns a table into a partitioned one in a single transaction, copying its rows
+and recreating its indexes, with the consumers stopped. State's record_id stays unique
+with end - and on its own in the default partition of the open states - as a primary
+key can't include a nullable column. maintain() creates the partitions of the coming
+months and moves the rows of those older than keep months, and before the STATE_ARCHIVE
+horizon, to the archive tables before dropping them - so reads and late events find
+them there, and a late event into one of those months lands in the default partition.
+SQLite tables are left as they are.
+"""
+
+from django.db import connection, transaction
+import datetime
+import re
+
+from .archive import ARCHIVE_OF, CHECKPOINT_KEYS, extend_horizon, move
+from .models import State, TransferEvent
+from .store import lock_items
+
+# the column each table is partitioned on
+PARTITION_KEYS = {
+    State: "end",
+    TransferEvent: "timestamp",
+}
+
+PARTITION_NAME = re.compile(r"_p(\d{4})_(\d{2})$")
+
+
+def month_start(at):
+    return at.astimezone(datetime.timezone.utc).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+
+
+def add_months(month, months):
+    year, index = divmod(month.year * 12 + month.month - 1 + months, 12)
+    return month.replace(year=year, month=index + 1)
+
+
+def is_partitioned(model):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)",
+            [model._meta.db_table],
+        )
+        return cursor.fetchone() is not None
+
+
+def partitions(model):
+    """The first day of the month of each of model's monthly partitions, by name"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(%s)",
+            [model._meta.db_table],
+        )
+        names = [name for (name,) in cursor.fetchall()]
+    months = {}
+    for name in names:
+        match = PARTITION_NAME.search(name)
+        if match:
+            months[name] = datetime.datetime(
+                int(match[1]), int(match[2]), 1, tzinfo=datetime.timezone.utc
+            )
+    return dict(sorted(months.items(), key=lambda item: item[1]))
+
+
+def create_partition(model, month):
+    """
+    Creates the partition of model for the month starting at month, if missing, moving
+    any of its rows out of the default partition - it can't be attached over them
+    """
+    quote = connection.ops.quote_name
+    table = model._meta.db_table
+    key = quote(PARTITION_KEYS[model])
+    name = f"{table}_p{month:%Y_%m}"
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [name])
+        if cursor.fetchone()[0]:
+            return None
+        cursor.execute(
+            f"CREATE TABLE {quote(name)} (LIKE {quote(table)} INCLUDING DEFAULTS)"
+        )
+        cursor.execute(
+            f"WITH moved AS (DELETE FROM {quote(table + '_default')} "
+            f"WHERE {key} >= %s AND {key} < %s RETURNING *) "
+            f"INSERT INTO {quote(name)} SELECT * FROM moved",
+            [month, add_months(month, 1)],
+        )
+        cursor.execute(
+            f"ALTER TABLE {quote(table)} ATTACH PARTITION {quote(name)} "
+            f"FOR VALUES FROM ('{month.isoformat()}') "
+            f"TO ('{add_months(month, 1).isoformat()}')"
+        )
+    return name
+
+
+class TablePartitions:
+    """Keeps ahead months of partitions ahead and archives those over keep months old"""
+
+    def __init__(self, ahead=3, keep=None, batch_size=1000):
+        self.ahead = ahead
+        self.keep = keep
+        self.batch_size = batch_size
+
+    def convert(self, model, now):
+        """
+        Replaces model's table with a partitioned one holding the same rows, with
+        partitions from the month of its oldest row on. Returns the rows copied.
+        """
+        quote = connection.ops.quote_name
+        table = model._meta.db_table
+        old_table = f"{table}_unpartitioned"
+        key = PARTITION_KEYS[model]
+        pk = model._meta.pk.column
+        columns = ", ".join(
+            quote(field.column) for field in model._meta.concrete_fields
+        )
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"LOCK TABLE {quote(table)} IN ACCESS EXCLUSIVE MODE")
+            cursor.execute(
+                "SELECT pg_get_indexdef(i.indexrelid), i.indisunique FROM pg_index i "
+                "WHERE i.indrelid = to_regclass(%s) AND NOT i.indisprimary",
+                [table],
+            )
+            indexes = cursor.fetchall()
+            cursor.execute(f"SELECT min({quote(key)}) FROM {quote(table)}")
+            (oldest,) = cursor.fetchone()
+
+            cursor.execute(f"ALTER TABLE {quote(table)} RENAME TO {quote(old_table)}")
+            cursor.execute(
+                f"CREATE TABLE {quote(table)} (LIKE {quote(old_table)} INCLUDING "
+                f"DEFAULTS INCLUDING IDENTITY) PARTITION BY RANGE ({quote(key)})"
+            )
+            # an identity column gets a sequence of its own, but the default of a serial
+            # one - from before Django 4.1 - still reads the old table's sequence, which
+            # would be dropped with it
+            cursor.execute(
+                "SELECT attidentity = '', pg_get_serial_sequence(%s, %s) "
+                "FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attname = %s",
+                [quote(old_table), pk, old_table, pk],
+            )
+            serial, sequence = cursor.fetchone()
+            if serial and sequence:
+                cursor.execute(
+                    f"ALTER SEQUENCE {sequence} OWNED BY {quote(table)}.{quote(pk)}"
+                )
+            # the open states, and any row outside the monthly partitions
+            cursor.execute(
+                f"CREATE TABLE {quote(table + '_default')} PARTITION OF {quote(table)} "
+                "DEFAULT"
+            )
+            month = month_start(oldest or now)
+            while month <= add_months(month_start(now), self.ahead):
+                create_partition(model, month)
+                month = add_months(month, 1)
+
+            cursor.execute(
+                f"INSERT INTO {quote(table)} ({columns}) "
+                f"SELECT {columns} FROM {quote(old_table)}"
+            )
+            copied = cursor.rowcount
+            cursor.execute(f"DROP TABLE {quote(old_table)}")
+            cursor.execute(
+                f"SELECT setval(pg_get_serial_sequence(%s, %s), "
+                f"COALESCE(max({quote(pk)}), 0) + 1, false) FROM {quote(table)}",
+                [quote(table), pk],
+            )
+
+            # the indexes after the rows, built once per partition
+            if model._meta.get_field(key).null:
+                # a primary key can't include a nullable partition key, a unique
+                # constraint can - the rows with a NULL key, all in the default
+                # partition, are kept unique by an index of that partition alone
+                cursor.execute(
+                    f"ALTER TABLE {quote(table)} ADD CONSTRAINT "
+                    f"{quote(table + '_' + pk + '_uniq')} "
+                    f"UNIQUE ({quote(pk)}, {quote(key)})"
+                )
+                cursor.execute(
+                    f"CREATE UNIQUE INDEX {quote(table + '_default_' + pk + '_uniq')} "
+                    f"ON {quote(table + '_default')} ({quote(pk)})"
+                )
+            else:
+                cursor.execute(
+                    f"ALTER TABLE {quote(table)} ADD PRIMARY KEY "
+                    f"({quote(pk)}, {quote(key)})"
+                )
+            for definition, unique in indexes:
+                if unique:
+                    # only the open states - all in the default partition - are unique
+                    definition = re.sub(
+                        r" ON (ONLY )?\S+ USING ",
+                        f" ON {quote(table + '_default')} USING ",
+                        definition,
+                        count=1,
+                    )
+                cursor.execute(definition)
+            cursor.execute(f"ANALYZE {quote(table)}")
+        return copied
+
+    def maintain(self, model, now, archive=None):
+        """
+        Creates model's missing partitions through ahead months from now and moves
+        those that ended over keep months before now - and before the horizon of the
+        HistoryArchive archive, without which they are kept - to the archive. Returns
+        the names created and {name: rows archived} of those dropped.
+        """
+        existing = partitions(model)
+        this_month = month_start(now)
+        created = []
+        # from the newest partition, filling any months missed since
+        month = max(existing.values(), default=this_month)
+        while month <= add_months(this_month, self.ahead):
+            name = create_partition(model, month)
+            if name:
+                created.append(name)
+            month = add_months(month, 1)
+
+        archived = {}
+        if self.keep is not None and archive is not None:
+            # never past the archive's horizon - StateStore relies on that to skip
+            # asking the archive about recent late events
+            cutoff = min(add_months(this_month, -self.keep), archive.horizon(now))
+            for name, month in existing.items():
+                if add_months(month, 1) <= cutoff:
+                    archived[name] = self.archive_partition(model, name, month)
+        return created, archived
+
+    def archive_partition(self, model, name, month):
+        """Moves the rows of model's partition name to the archive and drops it"""
+        quote = connection.ops.quote_name
+        key = PARTITION_KEYS[model]
+        pk = model._meta.pk.column
+        target = ARCHIVE_OF[model]
+        rows = model.objects.filter(
+            **{f"{key}__gte": month, f"{key}__lt": add_months(month, 1)}
+        )
+        # reads merge the archive from then on, before any row is moved there
+        extend_horizon(CHECKPOINT_KEYS[model], add_months(month, 1))
+
+        moved = 0
+        while True:
+            with transaction.atomic():
+                batch = list(
+                    rows.order_by("pk").values_list("pk", "item_id")[: self.batch_size]
+                )
+                if not batch:
+                    break
+                # as the handler's writers, so a late event can't restore them meanwhile
+                lock_items({item_id for _, item_id in batch})
+                (count,) = move((rows.filter(pk__in=[pk for pk, _ in batch]), target))
+                moved += count
+
+        columns = ", ".join(
+            quote(field.column) for field in model._meta.concrete_fields
+        )
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"ALTER TABLE {quote(model._meta.db_table)} "
+                f"DETACH PARTITION {quote(name)}"
+            )
+            # whatever a late event put back meanwhile
+            cursor.execute(
+                f"INSERT INTO {quote(target._meta.db_table)} ({columns}) "
+                f"SELECT {columns} FROM {quote(name)} ORDER BY {quote(pk)}"
+            )
+            moved += cursor.rowcount
+            cursor.execute(f"DROP TABLE {quote(name)}")
+        return moved
@@ -0,0 +1,84 @@
+from collections import OrderedDict
+from django.db import transaction
+import threading
+import traceback
+
+from event_handler import Event
+
+
+class EventPublisher:
+    """
+    Publishes location_state events only once the transaction that produced them has
+    committed, coalescing each location's events over `window` seconds.
+
+    Within a window only the latest event of each kind (entered/exited/update) per item
+    is sent for a location. With batch_topic the location's events are instead sent
+    together as a single location_state/batch/<location> message that carries every
+    change in order.
+    """
+
+    def __init__(self, send_fn, window=0.5, batch_topic=False):
+        self.send_fn = send_fn
+        self.window = window
+        self.batch_topic = batch_topic
+        self._pending = {}  # location_link -> [Event]
+        self._lock = threading.Lock()
+
+    def publish(self, events):
+        """Call inside the transaction - events are dropped if it rolls back"""
+        if events:
+            transaction.on_commit(lambda: self._add(events))
+
+    def _add(self, events):
+        immediate = []
+        with self._lock:
+            for event in events:
+                location_link = event.content.get("location_link")
+                if not event.topic.startswith("location_state/") or location_link is None:
+                    immediate.append(event)
+                elif location_link in self._pending:
+                    self._pending[location_link].append(event)
+                else:
+                    self._pending[location_link] = [event]
+                    timer = threading.Timer(self.window, self._flush, [location_link])
+                    timer.daemon = True
+                    timer.start()
+        if immediate:
+            self.__send(immediate)
+
+    def _flush(self, location_link):
+        with self._lock:
+            events = self._pending.pop(location_link, [])
+        if not events:
+            return
+
+        if self.batch_topic:
+            self.__send(
+                [
+                    Event(
+                        f"location_state/batch/{location_link}",
+                        {
+                            "location_link": location_link,
+                            "changes": [
+                                {"event": event.topic.split("/")[1], **event.content}
+                                for event in events
+                            ],
+                        },
+                    )
+                ]
+            )
+            return
+
+        latest = OrderedDict()
+        for event in events:
+            key = (event.topic, event.content.get("item_id"))
+            latest.pop(key, None)  # keep the latest in the position it was sent
+            latest[key] = event
+        self.__send(list(latest.values()))
+
+    def __send(self, events):
+        try:
+            self.send_fn(events)
+        except Exception:
+            print("ERROR")
+            print(traceback.format_exc())
@@ -0,0 +1,230 @@
+"""
+Rebuilds the State projection from the event log by replaying TransferEvent and
+ProductionEvent (with its inputs) in timestamp order through the event handler's
+operations. Used by the rebuild_state command. Archived events are replayed with the
+rest, and the whole rebuilt history replaces State and ArchivedState.
+"""
+
+from django.db import connection, transaction
+import heapq
+import json
+import os
+
+from . import event_handler
+from .archive import ARCHIVE_OF
+from .models import (
+    ArchiveCheckpoint,
+    ArchivedProductionEvent,
+    ArchivedProductionEventInput,
+    ArchivedState,
+    ArchivedTransferEvent,
+    State,
+    RebuiltState,
+    StateSnapshot,
+    TransferEvent,
+    ProductionEvent,
+    ProductionEventInput,
+)
+from .store import BULK_BATCH_SIZE, StateStore, refresh_current_state
+from . import versions
+
+STATE_COLUMNS = ("item_id", "location_link", "start", "end", "quantity")
+
+
+class RebuildStore(StateStore):
+    """
+    A deferred StateStore writing to RebuiltState that keeps every open state in memory
+    for the whole rebuild. States are only written once closed, so the rebuild never
+    reads or updates the table - finish() writes the states still open at the end.
+    """
+
+    model = RebuiltState
+
+    def __init__(self):
+        super().__init__(deferred=True)
+        self._emptied = set()
+
+    def _states_for(self, item_id):
+        return self._open.setdefault(item_id, {})
+
+    def close(self, state, timestamp):
+        super().close(state, timestamp)
+        if not self._open[state.item_id]:
+            self._emptied.add(state.item_id)
+
+    def flush(self):
+        closed = [state for state in self._to_create if state.end is not None]
+        self._to_create = [state for state in self._to_create if state.end is None]
+        RebuiltState.objects.bulk_create(closed, batch_size=BULK_BATCH_SIZE)
+
+        # forget items with nothing open rather than keep every item ever seen
+        for item_id in self._emptied:
+            if not self._open.get(item_id):
+                self._open.pop(item_id, None)
+        self._emptied = set()
+        self._touched = set()
+
+    def finish(self):
+        RebuiltState.objects.bulk_create(self._to_create, batch_size=BULK_BATCH_SIZE)
+        self._to_create = []
+
+    def open_states(self):
+        return list(self._to_create)
+
+    def restore(self, rows):
+        """Reopens the states saved in a checkpoint"""
+        for item_id, location_link, start, quantity in rows:
+            state = RebuiltState(
+                item_id=item_id,
+                location_link=location_link,
+                start=start,
+                quantity=quantity,
+            )
+            self._states_for(item_id)[location_link] = state
+            self._to_create.append(state)
+
+
+def events_after(after=None, chunk_size=2000):
+    """
+    Streams every TransferEvent and ProductionEvent after `after`, archived or not,
+    ordered by timestamp. The tables are read with .iterator() - server-side cursors on
+    Postgres - and merged, with transfers first among events at the same time.
+    """
+    streams = []
+    for rank, hot in enumerate((TransferEvent, ProductionEvent)):
+        for model in (hot, ARCHIVE_OF[hot]):
+            events = model.objects.order_by("timestamp", "event_id")
+            if after is not None:
+                events = events.filter(timestamp__gt=after)
+            streams.append(ranked(events.iterator(chunk_size=chunk_size), rank))
+
+    for _, _, _, event in heapq.merge(*streams):
+        yield event
+
+
+def ranked(events, rank):
+    for event in events:
+        yield event.timestamp, rank, event.pk, event
+
+
+def batches(events, size):
+    """Groups events into batches of about size, never splitting a timestamp"""
+    batch = []
+    for event in events:
+        if len(batch) >= size and event.timestamp != batch[-1].timestamp:
+            yield batch
+            batch = []
+        batch.append(event)
+    if batch:
+        yield batch
+
+
+def apply_batch(store: RebuildStore, events, update_events=True):
+    """
+    Replays a batch of events in one transaction. The from location the handler fills
+    in is written back to events where the replay disagrees, unless update_events is
+    False. Returns the number of such events.
+    """
+    inputs = {}
+    for model, input_model in (
+        (ProductionEvent, ProductionEventInput),
+        (ArchivedProductionEvent, ArchivedProductionEventInput),
+    ):
+        prod_event_ids = [event.pk for event in events if isinstance(event, model)]
+        for offset in range(0, len(prod_event_ids), BULK_BATCH_SIZE):
+            for input in input_model.objects.filter(
+                production_event_id__in=prod_event_ids[
+                    offset : offset + BULK_BATCH_SIZE
+                ]
+            ).order_by("pk"):
+                inputs.setdefault(input.production_event_id, []).append(input)
+
+    moved = []
+    with transaction.atomic():
+        for event in events:
+            from_location_link = event.from_location_link
+            if isinstance(event, (TransferEvent, ArchivedTransferEvent)):
+                event_handler.apply_transfer_op(store, event)
+            else:
+                event_handler.apply_prod_op(store, event, inputs.get(event.pk, []))
+            if event.from_location_link != from_location_link:
+                moved.append(event)
+
+        store.flush()
+        if update_events:
+            for model in (
+                TransferEvent,
+                ProductionEvent,
+                ArchivedTransferEvent,
+                ArchivedProductionEvent,
+            ):
+                model.objects.bulk_update(
+                    [event for event in moved if isinstance(event, model)],
+                    ["from_location_link"],
+                    batch_size=BULK_BATCH_SIZE,
+                )
+    return len(moved)
+
+
+def save_checkpoint(path, through, events, store: RebuildStore):
+    checkpoint = {
+        "through": through.isoformat(),
+        "events": events,
+        "open": [
+            [
+                state.item_id,
+                state.location_link,
+                state.start.isoformat(),
+                state.quantity,
+            ]
+            for state in store.open_states()
+        ],
+    }
+    # written aside and renamed so that a crash never leaves half a checkpoint
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_checkpoint(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def diff():
+    """
+    Rows only in State or ArchivedState and rows only in RebuiltState, compared on every
+    column but the primary key, as querysets
+    """
+    live = State.objects.values_list(*STATE_COLUMNS).union(
+        ArchivedState.objects.values_list(*STATE_COLUMNS), all=True
+    )
+    rebuilt = RebuiltState.objects.values_list(*STATE_COLUMNS)
+    return live.difference(rebuilt), rebuilt.difference(live)
+
+
+def swap_in():
+    """Replaces State - and ArchivedState - with the rebuilt states in one transaction"""
+    quote = connection.ops.quote_name
+    state_table = quote(State._meta.db_table)
+    archived_table = quote(ArchivedState._meta.db_table)
+    rebuilt_table = quote(RebuiltState._meta.db_table)
+    columns = ", ".join(quote(column) for column in STATE_COLUMNS)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(f"LOCK TABLE {state_table} IN EXCLUSIVE MODE")
+        # raw statements - a queryset delete would load every row to send signals
+        cursor.execute(f"DELETE FROM {state_table}")
+        # the archive_history command moves the old states out again
+        cursor.execute(f"DELETE FROM {archived_table}")
+        ArchiveCheckpoint.objects.filter(key="state").delete()
+        cursor.execute(
+            f"INSERT INTO {state_table} ({columns}) SELECT {columns} FROM {rebuilt_table}"
+        )
+        cursor.execute(f"DELETE FROM {rebuilt_table}")
+        refresh_current_state()
+        StateSnapshot.objects.all().delete()
+        if event_handler.rollups is not None:
+            event_handler.rollups.rebuild()
+        versions.bump_all()
@@ -4,4 +4,7 @@ from . import views
 
 urlpatterns = [
     path("", views.report),
+    path("rollup", views.rollup),
+    path("dwell", views.dwellTimes),
+    path("lead_time", views.leadTimes),
 ]
@@ -0,0 +1,127 @@
+"""
+A bounded cache of rendered responses for the hot state views.
+
+A response is cached under its ETag (see versions.py), URL and Accept header, so it is
+only ever served while the versions it was made from are current - in any process and
+whatever holds it. On top of that, once a change commits the entries of the items and
+locations it touched are evicted, along with those of views over everything (which also
+read the settings), so that stale responses don't take up room until they age out.
+
+Entries are kept in a process-local LRU bounded by count and by bytes, or in a Django
+cache (a CACHES alias) shared by the processes on the host. A shared backend drops
+entries by its own timeout and culling rather than by eviction on change.
+"""
+
+from collections import OrderedDict
+from django.core.cache import caches
+import hashlib
+import threading
+
+from . import versions
+
+
+def scope(kwargs):
+    """The version key of a view's URL kwargs - whose changes make its response stale"""
+    if "item_id" in kwargs:
+        return versions.item_key(kwargs["item_id"])
+    if "location_link" in kwargs:
+        return versions.location_key(kwargs["location_link"])
+    return versions.GLOBAL
+
+
+class ResponseCache:
+    """Rendered responses keyed by (ETag, URL, Accept header), with hit/miss stats"""
+
+    def __init__(
+        self, max_entries=256, max_bytes=64 * 2**20, backend=None, timeout=300
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.backend = caches[backend] if backend else None
+        self.timeout = timeout
+        self._entries = OrderedDict()  # key -> (scope, status, headers, content)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __backend_key(self, key):
+        return "state-response:" + hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def get(self, key):
+        """The (status, headers, content) cached under key, or None"""
+        if self.backend is not None:
+            entry = self.backend.get(self.__backend_key(key))
+        else:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry[1:]
+
+    def set(self, key, scope, status, headers, content):
+        entry = (scope, status, headers, content)
+        if self.backend is not None:
+            self.backend.set(self.__backend_key(key), entry, self.timeout)
+            return
+        if len(content) > self.max_bytes:
+            return
+        with self._lock:
+            self.__discard(key)
+            self._entries[key] = entry
+            self._bytes += len(content)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self.__discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def __discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[3])
+
+    def invalidate(self, item_ids=(), location_links=(), everything=False):
+        """Evicts the entries made stale by a change to items and locations"""
+        scopes = {versions.GLOBAL}
+        scopes.update(versions.item_key(item_id) for item_id in item_ids)
+        scopes.update(versions.location_key(link) for link in location_links)
+        with self._lock:
+            stale = [
+                key
+                for key, entry in self._entries.items()
+                if everything or entry[0] in scopes
+            ]
+            for key in stale:
+                self.__discard(key)
+            self.invalidations += len(stale)
+
+    def on_bumped(self, sender, item_ids, location_links, everything, **kwargs):
+        self.invalidate(item_ids, location_links, everything)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            local = self.backend is None  # a shared backend keeps its own counts
+            return {
+                "backend": "local" if local else "shared",
+                "entries": len(self._entries) if local else None,
+                "bytes": self._bytes if local else None,
+                "max_entries": self.max_entries if local else None,
+                "max_bytes": self.max_bytes if local else None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,238 @@
+"""
+Per-location throughput rollups for /report/rollup.
+
+Every change to State moves quantity into or out of a location: an individually tracked
+item entering or leaving counts as 1, a collection's state being replaced by one with a
+different quantity as the difference. The StateStore notes these changes as the event
+handler makes them, and they are added to LocationRollup rows - entered and exited per
+location and base bucket - in the same transaction.
+
+A late event rewrites the states of an item from its timestamp on, so reprojection first
+retracts what those states had added and the replay adds it again. Anything that
+changes State by other means recounts them: an edit in the admin those of the items it
+changed, a rebuild all of them with rebuild().
+
+Throughput over larger buckets is summed from the base buckets, and the WIP at a
+location is its net quantity since the start of its history.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+from django.db import connection, transaction
+from django.db.models import Sum
+import datetime
+import heapq
+import itertools
+
+from .models import ArchivedState, LocationRollup, State
+
+BULK_BATCH_SIZE = 500
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def moved(quantity):
+    """(entered, exited) for a net quantity moved into a location"""
+    return (quantity, 0) if quantity > 0 else (0, -quantity)
+
+
+def quantity_of(state):
+    return 1 if state.quantity is None else state.quantity
+
+
+def replaces(previous, state):
+    # a collection's state closed and reopened with its new quantity by one change
+    return (
+        previous is not None
+        and previous.item_id == state.item_id
+        and previous.location_link == state.location_link
+        and previous.end == state.start
+        and previous.quantity is not None
+        and state.quantity is not None
+    )
+
+
+def state_moves(states):
+    """
+    (location_link, timestamp, entered, exited) for each change the states made - they
+    must be ordered by item, location, start and record_id, as the StateStore made them
+    """
+    previous = None
+    for state in states:
+        if replaces(previous, state):
+            yield state.location_link, state.start, *moved(
+                state.quantity - previous.quantity
+            )
+        else:
+            if previous is not None and previous.end is not None:
+                yield previous.location_link, previous.end, *moved(
+                    -quantity_of(previous)
+                )
+            yield state.location_link, state.start, *moved(quantity_of(state))
+        previous = state
+    if previous is not None and previous.end is not None:
+        yield previous.location_link, previous.end, *moved(-quantity_of(previous))
+
+
+def ordered(states):
+    return states.order_by("item_id", "location_link", "start", "record_id").only(
+        "item_id", "location_link", "start", "end", "quantity"
+    )
+
+
+class LocationRollups:
+    """Maintains LocationRollup rows over base buckets of bucket seconds"""
+
+    def __init__(self, bucket=3600):
+        self.bucket = bucket
+
+    def bucket_of(self, timestamp, size=None):
+        """
+        The start of the bucket of size seconds - the base size by default - holding
+        timestamp, counted in whole buckets from the Unix epoch
+        """
+        size = size or self.bucket
+        seconds = (timestamp - EPOCH) // datetime.timedelta(seconds=size) * size
+        return EPOCH + datetime.timedelta(seconds=seconds)
+
+    def totals(self, moves):
+        """(location_link, bucket) -> [entered, exited] of the moves of state_moves()"""
+        totals = defaultdict(lambda: [0, 0])
+        for location_link, timestamp, entered, exited in moves:
+            total = totals[location_link, self.bucket_of(timestamp)]
+            total[0] += entered
+            total[1] += exited
+        return totals
+
+    def add(self, moves, sign=1):
+        """Adds the moves of state_moves() to the rollups - or takes them off"""
+        rows = [
+            (location_link, bucket, sign * entered, sign * exited)
+            for (location_link, bucket), (entered, exited) in sorted(
+                self.totals(moves).items()
+            )
+        ]
+        if not rows:
+            return
+        quote = connection.ops.quote_name
+        table = quote(LocationRollup._meta.db_table)
+        location_link, bucket, entered, exited = map(
+            quote, ("location_link", "bucket", "entered", "exited")
+        )
+        # one upsert adds to rows that exist - concurrent writers to a bucket don't race
+        sql = (
+            f"INSERT INTO {table} ({location_link}, {bucket}, {entered}, {exited}) "
+            f"VALUES (%s, %s, %s, %s) ON CONFLICT ({location_link}, {bucket}) "
+            f"DO UPDATE SET {entered} = {table}.{entered} + excluded.{entered}, "
+            f"{exited} = {table}.{exited} + excluded.{exited}"
+        )
+        adapt = connection.ops.adapt_datetimefield_value
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, [(row[0], adapt(row[1]), *row[2:]) for row in rows])
+
+    def retract(self, states, since):
+        """
+        Takes off what states added at or after since, before reprojection deletes the
+        ones that started then and reopens the ones that ended then. states must be all
+        of an item's states that started or ended at or after since.
+        """
+        moves = state_moves(ordered(states).iterator(chunk_size=BULK_BATCH_SIZE))
+        self.add((move for move in moves if move[1] >= since), sign=-1)
+
+    @contextmanager
+    def recounting(self, item_ids):
+        """
+        Takes off everything the states of items added and adds it again once the block
+        has changed them - for edits that bypass the event handler
+        """
+        item_ids = list(set(item_ids))
+        with transaction.atomic():
+            self.add(
+                state_moves(ordered(State.objects.filter(item_id__in=item_ids))), -1
+            )
+            yield
+            self.add(state_moves(ordered(State.objects.filter(item_id__in=item_ids))))
+
+    def rebuild(self):
+        """Recomputes every rollup from State and ArchivedState"""
+        with transaction.atomic():
+            LocationRollup.objects.all().delete()
+            # streamed - only the totals per location and bucket are kept in memory
+            states = heapq.merge(
+                *(
+                    ordered(model.objects.all()).iterator(chunk_size=BULK_BATCH_SIZE)
+                    for model in (State, ArchivedState)
+                ),
+                key=lambda state: (
+                    state.item_id,
+                    state.location_link,
+                    state.start,
+                    state.record_id,
+                ),
+            )
+            totals = self.totals(state_moves(states))
+            LocationRollup.objects.bulk_create(
+                (
+                    LocationRollup(
+                        location_link=location_link,
+                        bucket=bucket,
+                        entered=entered,
+                        exited=exited,
+                    )
+                    for (location_link, bucket), (entered, exited) in sorted(
+                        totals.items()
+                    )
+                    if entered or exited
+                ),
+                batch_size=BULK_BATCH_SIZE,
+            )
+
+    def series(self, location_links=None, start=None, end=None, size=None):
+        """
+        A row per location and bucket of size seconds - a multiple of the base size - in
+        which quantity entered or left it, between start and end. Each has what entered
+        and exited, the net and the WIP - the net of its whole history - at its end.
+        """
+        size = size or self.bucket
+        rollups = LocationRollup.objects.all()
+        if location_links:
+            rollups = rollups.filter(location_link__in=location_links)
+
+        wip = defaultdict(int)
+        if start is not None:
+            start = self.bucket_of(start, size)
+            before = (
+                rollups.filter(bucket__lt=start)
+                .values("location_link")
+                .annotate(entered=Sum("entered"), exited=Sum("exited"))
+            )
+            for row in before:
+                wip[row["location_link"]] = row["entered"] - row["exited"]
+            rollups = rollups.filter(bucket__gte=start)
+        if end is not None:
+            rollups = rollups.filter(bucket__lte=end)
+
+        rows = rollups.order_by("location_link", "bucket").values_list(
+            "location_link", "bucket", "entered", "exited"
+        )
+        series = []
+        for (location_link, bucket), group in itertools.groupby(
+            rows.iterator(chunk_size=BULK_BATCH_SIZE),
+            key=lambda row: (row[0], self.bucket_of(row[1], size)),
+        ):
+            entered = exited = 0
+            for _, _, row_entered, row_exited in group:
+                entered += row_entered
+                exited += row_exited
+            wip[location_link] += entered - exited
+            if entered or exited:
+                series.append(
+                    {
+                        "location_link": location_link,
+                        "bucket": bucket,
+                        "entered": entered,
+                        "exited": exited,
+                        "net": entered - exited,
+                        "wip": wip[location_link],
+                    }
+                )
+        return series
@@ -0,0 +1,136 @@
+"""
+A fast path for the list views' ModelSerializers.
+
+Serializing a model instance builds the instance and then looks up and converts each
+field through DRF's per-field machinery, which is most of the CPU of a large list
+response. For serializers made only of plain fields the rows are read with
+.values_list() instead and turned into dicts directly - only datetimes, and big integers
+when DRF is set to send them as strings, need converting. The output is the same;
+serializers with anything else fall back to the usual path.
+"""
+
+from django.conf import settings
+from django.db.models import QuerySet
+from rest_framework import serializers
+from rest_framework.fields import ISO_8601
+from rest_framework.settings import api_settings
+from functools import lru_cache
+
+# fields whose to_representation leaves values read from the database as they are
+UNCHANGED = (
+    serializers.CharField,
+    serializers.IntegerField,
+    serializers.PrimaryKeyRelatedField,
+)
+# ModelSerializer's field for BigAutoField in newer versions of DRF
+BigIntegerField = getattr(serializers, "BigIntegerField", None)
+
+
+@lru_cache
+def row_fields(serializer_class, model):
+    """
+    The (name, field) of each field of serializer_class, or None if a row of model read
+    with .values_list() can't be serialized the way an instance would be
+    """
+    if (
+        serializer_class.to_representation
+        is not serializers.Serializer.to_representation
+    ):
+        return None
+    columns = {field.name for field in model._meta.concrete_fields}
+    fields = []
+    for field in serializer_class()._readable_fields:
+        if type(field) not in UNCHANGED and type(field) not in (
+            serializers.DateTimeField,
+            BigIntegerField,
+        ):
+            return None
+        if len(field.source_attrs) != 1 or getattr(field, "pk_field", None):
+            return None
+        # besides columns, a class attribute of None may stand in - as CurrentState.end
+        if field.source not in columns and (
+            field.source not in vars(model) or vars(model)[field.source] is not None
+        ):
+            return None
+        fields.append((field.field_name, field))
+    return fields
+
+
+def representation(field):
+    """
+    field.to_representation for a value that isn't None, with its settings looked up
+    once - or None if it returns the value as it is
+    """
+    if type(field) is BigIntegerField:
+        if getattr(field, "coerce_to_string", api_settings.COERCE_BIGINT_TO_STRING):
+            return str
+        return None
+    if type(field) is not serializers.DateTimeField:
+        return None
+
+    output_format = getattr(field, "format", api_settings.DATETIME_FORMAT)
+    timezone = (
+        field.timezone if hasattr(field, "timezone") else field.default_timezone()
+    )
+    if (
+        output_format is None
+        or output_format.lower() != ISO_8601
+        or timezone is None
+        or not settings.USE_TZ
+    ):
+        return field.to_representation
+
+    def to_representation(value):
+        value = value.astimezone(timezone).isoformat()
+        if value.endswith("+00:00"):
+            value = value[:-6] + "Z"
+        return value
+
+    return to_representation
+
+
+class ValuesSerializer:
+    """Serializes .values_list() rows as serializer_class serializes model instances"""
+
+    def __init__(self, fields, model):
+        columns = {field.name for field in model._meta.concrete_fields}
+        self.names = [name for name, field in fields]
+        self.columns = [name for name, field in fields if field.source in columns]
+        self.sources = [
+            field.source for name, field in fields if field.source in columns
+        ]
+        self.converted = []
+        for name, field in fields:
+            to_representation = representation(field)
+            if to_representation is not None and field.source in columns:
+                self.converted.append((name, to_representation))
+
+    def rows(self, queryset, extra=()):
+        # extra fields come last, so to_representation leaves them out
+        return queryset.values_list(*self.sources, *extra, named=True)
+
+    def to_representation(self, row):
+        if len(self.columns) == len(self.names):
+            data = dict(zip(self.names, row))
+        else:
+            # keeps the fields in order, those without a column left as None
+            data = dict.fromkeys(self.names)
+            data.update(zip(self.columns, row))
+        for name, to_representation in self.converted:
+            if data[name] is not None:
+                data[name] = to_representation(data[name])
+        return data
+
+
+def serializer_for(rows, serializer_class, extra=()):
+    """
+    The rows to serialize and a serializer for them - a queryset's rows become
+    .values_list() rows where serializer_class allows it. The extra fields are read
+    too, as attributes of the rows.
+    """
+    if isinstance(rows, QuerySet):
+        fields = row_fields(serializer_class, rows.model)
+        if fields is not None:
+            values = ValuesSerializer(fields, rows.model)
+            return values.rows(rows, extra), values
+    return rows, serializer_class()
@@ -0,0 +1,123 @@
+"""
+The Setting rows, typed, for the views that read them on every request - /state/ and
+/report?type=state filter on completed_location and completed_duration_days.
+
+With SETTINGS_CACHE a process loads them once and keeps them until they change. A change
+to a Setting row - from the settings view, the admin or anywhere else - invalidates the
+cache once it commits and publishes a state_settings/changed message, which every
+process subscribes to without a shared group, so that the others invalidate theirs.
+max_age seconds bounds how long a process that missed the message keeps the old values.
+"""
+
+from django.db import transaction
+import datetime
+import threading
+import time
+import traceback
+
+from event_handler import Event, send_events
+
+from .models import Setting
+
+TOPIC = "state_settings/changed"
+
+# the type of each setting read by the views, and its value when it is missing or bad
+TYPES = {"completed_location": str, "completed_duration_days": int}
+DEFAULTS = {"completed_location": None, "completed_duration_days": 1}
+
+
+class Settings:
+    """The settings at one time, typed"""
+
+    def __init__(self, rows):
+        self.values = dict(DEFAULTS)
+        for key, value in rows:
+            try:
+                self.values[key] = TYPES.get(key, str)(value)
+            except ValueError:
+                print(f"WARNING: ignoring setting {key}={value!r}")
+        self.completed_location = self.values["completed_location"]
+        self.completed_duration_days = self.values["completed_duration_days"]
+        self._cutoff = None  # ((date, is_dst), cutoff)
+
+    def completed_cutoff(self):
+        """
+        The states that entered completed_location before this have been completed for
+        completed_duration_days days, up to the end of today in local time
+        """
+        local = time.localtime()
+        key = (local.tm_year, local.tm_yday, local.tm_isdst)
+        cutoff = self._cutoff
+        if cutoff is None or cutoff[0] != key:
+            offset = -(time.timezone if local.tm_isdst == 0 else time.altzone)
+            tz = datetime.timezone(datetime.timedelta(seconds=offset))
+            end_of_today = datetime.datetime.combine(
+                datetime.datetime.now(tz=tz), datetime.datetime.min.time(), tzinfo=tz
+            ) + datetime.timedelta(days=1)
+            cutoff = (
+                key,
+                end_of_today - datetime.timedelta(days=self.completed_duration_days),
+            )
+            self._cutoff = cutoff
+        return cutoff[1]
+
+
+def load():
+    return Settings(Setting.objects.values_list("key", "value"))
+
+
+class SettingsCache:
+    """The current Settings of the process, reloaded after a change"""
+
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self._settings = None
+        self._loaded_at = 0
+        self._generation = 0  # bumped by every invalidation
+        self._lock = threading.Lock()
+        self._pending = threading.local()  # the aliases of this thread's connections
+        self.loads = 0
+
+    def get(self):
+        settings = self._settings
+        if settings is not None and (
+            self.max_age is None or time.monotonic() - self._loaded_at < self.max_age
+        ):
+            return settings
+        with self._lock:
+            generation = self._generation
+        settings = load()
+        with self._lock:
+            # unless invalidated meanwhile - the rows read may be older than the change
+            if generation == self._generation:
+                self._settings = settings
+                self._loaded_at = time.monotonic()
+            self.loads += 1
+        return settings
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._settings = None
+
+    def changed(self):
+        """
+        Call in the transaction that changes a Setting row - it is announced once
+        however many rows the transaction changes
+        """
+        # every call registers a callback - one whose transaction rolls back never runs -
+        # and the first to run after the commit clears the flag the others find unset
+        alias = transaction.get_connection().alias
+        setattr(self._pending, alias, True)
+        transaction.on_commit(lambda: self.__changed(alias))
+
+    def __changed(self, alias):
+        if not getattr(self._pending, alias, False):
+            return
+        setattr(self._pending, alias, False)
+        self.invalidate()
+        try:
+            send_events([Event(TOPIC, {})])
+        except Exception:
+            print("ERROR: the other processes weren't told the settings changed")
+            print(traceback.format_exc())
@@ -0,0 +1,170 @@
+"""
+Snapshots of the open states at fixed checkpoints, for point-in-time (?t=) queries.
+
+A snapshot holds the record_ids of the State rows open at its checkpoint. The rows open
+at a later instant t are then those of the snapshot that are still open at t, plus those
+that started between the checkpoint and t - so a query only reads the snapshot and the
+states of one interval, however long the history is.
+
+State rows are only ever closed after their start, so a snapshot stays correct while
+changes come in at later timestamps. A change at or before a checkpoint - a late event,
+a correction or a rebuild - deletes the snapshots from there on.
+"""
+
+from array import array
+from django.db import connection, transaction
+from django.db.models import BooleanField, Q
+from django.db.models.expressions import RawSQL
+import datetime
+import itertools
+import json
+import sys
+import zlib
+
+from .intervals import at_instant
+from .models import State, StateSnapshot
+
+
+def encode(record_ids):
+    record_ids = sorted(record_ids)
+    deltas = array("q", (b - a for a, b in zip([0] + record_ids, record_ids)))
+    if sys.byteorder == "big":
+        deltas.byteswap()
+    return zlib.compress(deltas.tobytes())
+
+
+def decode(data):
+    deltas = array("q")
+    deltas.frombytes(zlib.decompress(data))
+    if sys.byteorder == "big":
+        deltas.byteswap()
+    return list(itertools.accumulate(deltas))
+
+
+def record_id_in(record_ids):
+    """A filter on State record_id passing the ids as one parameter where possible"""
+    quote = connection.ops.quote_name
+    column = f"{quote(State._meta.db_table)}.{quote('record_id')}"
+    if connection.vendor == "postgresql":
+        return Q(RawSQL(f"{column} = ANY(%s)", (record_ids,), BooleanField()))
+    if connection.vendor == "sqlite":
+        return Q(
+            RawSQL(
+                f"{column} IN (SELECT value FROM json_each(%s))",
+                (json.dumps(record_ids),),
+                BooleanField(),
+            )
+        )
+    return Q(record_id__in=record_ids)
+
+
+class StateSnapshots:
+    """Takes, prunes and queries the snapshots taken every interval seconds"""
+
+    def __init__(self, interval=3600, retention=7 * 24 * 3600):
+        self.interval = datetime.timedelta(seconds=interval)
+        self.retention = datetime.timedelta(seconds=retention)
+
+    def checkpoint(self, at):
+        """The latest checkpoint at or before at"""
+        epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+        return epoch + (at - epoch) // self.interval * self.interval
+
+    def take(self, taken_at):
+        """Snapshots the states open at taken_at, replacing any earlier snapshot of it"""
+        quote = connection.ops.quote_name
+        with transaction.atomic():
+            # writers of State in flight commit first, so that their changes are read,
+            # and later ones wait for this snapshot and find it to invalidate
+            with connection.cursor() as cursor:
+                if connection.vendor == "postgresql":
+                    cursor.execute(
+                        f"LOCK TABLE {quote(State._meta.db_table)} IN SHARE MODE"
+                    )
+                elif connection.vendor == "sqlite":
+                    # SQLite has one write lock, which the writers take up front
+                    cursor.execute(
+                        f"UPDATE {quote(StateSnapshot._meta.db_table)}"
+                        f" SET {quote('count')} = {quote('count')} WHERE 0"
+                    )
+            record_ids = list(
+                at_instant(State.objects.all(), taken_at).values_list(
+                    "record_id", flat=True
+                )
+            )
+            StateSnapshot.objects.filter(taken_at=taken_at).delete()
+            return StateSnapshot.objects.create(
+                taken_at=taken_at, count=len(record_ids), record_ids=encode(record_ids)
+            )
+
+    def take_due(self, now, backfill=False):
+        """
+        Takes the snapshot of the latest checkpoint if it is missing - or, with backfill,
+        of every missing checkpoint within the retention period. Returns those taken.
+        """
+        latest = self.checkpoint(now)
+        checkpoints = [latest]
+        if backfill:
+            while checkpoints[-1] - self.interval >= now - self.retention:
+                checkpoints.append(checkpoints[-1] - self.interval)
+        existing = set(
+            StateSnapshot.objects.filter(taken_at__in=checkpoints).values_list(
+                "taken_at", flat=True
+            )
+        )
+        return [
+            self.take(checkpoint)
+            for checkpoint in reversed(checkpoints)
+            if checkpoint not in existing
+        ]
+
+    def prune(self, now):
+        """Deletes the snapshots past the retention period, returning how many"""
+        deleted, _ = StateSnapshot.objects.filter(
+            taken_at__lt=now - self.retention
+        ).delete()
+        return deleted
+
+    def invalidate(self, since=None):
+        """Deletes the snapshots a change at since may have made wrong - all if None"""
+        snapshots = StateSnapshot.objects.all()
+        if since is not None:
+            # a change after the latest snapshot - most of them - deletes nothing
+            latest = (
+                snapshots.order_by("-taken_at")
+                .values_list("taken_at", flat=True)
+                .first()
+            )
+            if latest is None or latest < since:
+                return
+            snapshots = snapshots.filter(taken_at__gte=since)
+        snapshots.delete()
+
+    def at_instant(self, queryset, at: datetime.datetime):
+        """
+        Filters a State queryset to the rows that were open at `at`, starting from the
+        nearest earlier snapshot - or from the interval index if there is none.
+        """
+        snapshot = (
+            StateSnapshot.objects.filter(taken_at__lte=at).order_by("-taken_at").first()
+        )
+        if snapshot is None:
+            return at_instant(queryset, at)
+
+        started_since = Q(start__gt=snapshot.taken_at, start__lte=at)
+        return queryset.filter(
+            (record_id_in(decode(snapshot.record_ids)) | started_since)
+            & (Q(end__isnull=True) | Q(end__gte=at))
+        )
+
+    def stats(self):
+        snapshots = StateSnapshot.objects.order_by("taken_at")
+        first = snapshots.values_list("taken_at", flat=True).first()
+        last = snapshots.values_list("taken_at", flat=True).last()
+        return {
+            "interval": self.interval.total_seconds(),
+            "retention": self.retention.total_seconds(),
+            "snapshots": snapshots.count(),
+            "first": first,
+            "last": last,
+        }
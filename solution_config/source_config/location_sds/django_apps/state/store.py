@@ -0,0 +1,422 @@
+from django.db import connection, transaction
+from django.db.models import F, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+from .models import (
+    State,
+    CurrentState,
+    TransferEvent,
+    ProductionEvent,
+    ProductionEventInput,
+)
+from .rollups import moved
+import zlib
+
+BULK_BATCH_SIZE = 500
+EVENT_MODELS = (TransferEvent, ProductionEvent, ProductionEventInput)
+ADVISORY_LOCK_NAMESPACE = 0x5354  # "ST" - first key of the two-key advisory lock
+
+
+def lock_items(item_ids):
+    """
+    Serialises writers of the same items across processes until the current transaction
+    ends. Postgres takes an advisory lock per item in a fixed order. SQLite allows one
+    writer at a time, so its write lock is taken up front - concurrent writers then wait
+    on the busy timeout rather than failing to upgrade a read lock part way through.
+    The open state unique constraints on State reject anything that slips through.
+    """
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute(f'UPDATE "{State._meta.db_table}" SET "end" = "end" WHERE 0')
+        return
+    if connection.vendor != "postgresql" or not item_ids:
+        return
+    keys = sorted({zlib.crc32(item_id.encode()) - 2**31 for item_id in item_ids})
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT pg_advisory_xact_lock(%s, key) FROM unnest(%s::integer[]) AS key",
+            [ADVISORY_LOCK_NAMESPACE, keys],
+        )
+
+
+def latest_event():
+    """
+    The time of the latest event of an open State row's item, to annotate the open
+    states with as they are loaded. The row's own start - the time of the event that
+    opened it - stands in for event tables without any rows for the item.
+    """
+    return Greatest(
+        *(
+            Coalesce(
+                Subquery(
+                    model.objects.filter(item_id=OuterRef("item_id"))
+                    .order_by("-timestamp")
+                    .values("timestamp")[:1]
+                ),
+                F("start"),
+            )
+            for model in EVENT_MODELS
+        )
+    )
+
+
+def refresh_current_state(item_ids=None):
+    """
+    Rewrites the CurrentState rows of items - of every item if None - from their open
+    State rows, after State was changed with queries that bypass the signals and the
+    StateStore.
+    """
+    if item_ids is None:
+        CurrentState.objects.all().delete()
+        open_states = State.objects.filter(end__isnull=True)
+    else:
+        item_ids = list(set(item_ids))
+        CurrentState.objects.filter(item_id__in=item_ids).delete()
+        open_states = State.objects.filter(item_id__in=item_ids, end__isnull=True)
+    CurrentState.objects.bulk_create(
+        (
+            current_state_for(state)
+            for state in open_states.iterator(chunk_size=BULK_BATCH_SIZE)
+        ),
+        batch_size=BULK_BATCH_SIZE,
+    )
+
+
+def current_state_differences():
+    """
+    Compares CurrentState with the open State rows. Returns a list of differences -
+    empty if they match.
+    """
+    fields = ("record_id", "item_id", "location_link", "start", "quantity")
+    current = {
+        row[0]: row for row in CurrentState.objects.values_list(*fields).iterator()
+    }
+    open_states = {
+        row[0]: row
+        for row in State.objects.filter(end__isnull=True)
+        .values_list(*fields)
+        .iterator()
+    }
+    return [
+        {
+            "record_id": record_id,
+            "current_state": current.get(record_id),
+            "state": open_states.get(record_id),
+        }
+        for record_id in sorted(current.keys() | open_states.keys())
+        if current.get(record_id) != open_states.get(record_id)
+    ]
+
+
+def current_state_for(state):
+    return CurrentState(
+        record_id=state.record_id,
+        item_id=state.item_id,
+        location_link=state.location_link,
+        start=state.start,
+        quantity=state.quantity,
+    )
+
+
+class StateStore:
+    """
+    Tracks the open (end IS NULL) State rows touched by the event handler primitives.
+
+    An immediate store writes each change as it is made. A deferred store keeps changes
+    in memory and writes them with bulk queries when flush() is called - flush() must be
+    called inside the transaction the changes were made in.
+
+    If an OpenStateIndex is given, lookups are answered from it where possible and the
+    open states of every touched item are written back to it once the transaction commits.
+    If LocationRollups are given, the quantity each change moves is added to them on
+    flush(). If a HistoryArchive is given, changed_after() asks it about a timestamp
+    from before the archive horizon as well.
+    """
+
+    model = State
+
+    def __init__(self, deferred=False, index=None, rollups=None, archive=None):
+        self.deferred = deferred
+        self.index = index
+        self.rollups = rollups
+        self.archive = archive
+        # for the rollups - (location_link, timestamp, entered, exited) of the changes made,
+        # and the quantity of each collection state closed that a new one may replace
+        self._moves = []
+        self._replaced = {}  # (item_id, location_link, timestamp) -> quantity
+        self._open = {}  # item_id -> {location_link: State}
+        # item_id -> timestamp of its latest stored event (if loaded) / applied event
+        self._stored_latest = {}
+        self._applied_latest = {}
+        self._touched = set()
+        self.touched_locations = set()  # locations whose states changed, for versions
+        self._to_update = []
+        self._to_create = []
+
+    def preload(self, item_ids):
+        """
+        Load the open states of several items with one query per chunk of items, along
+        with the time of each item's latest event for changed_after()
+        """
+        self.__preload_open(item_ids)
+        self.__load_latest_events(
+            [item_id for item_id in set(item_ids) if item_id not in self._stored_latest]
+        )
+
+    def __preload_open(self, item_ids):
+        missing = []
+        for item_id in set(item_ids):
+            if item_id in self._open:
+                continue
+            indexed = self.index.lookup(item_id) if self.index else None
+            if indexed is not None:
+                self._open[item_id] = indexed
+                self.__stored(indexed.values())
+            else:
+                missing.append(item_id)
+
+        self.__load(missing)
+        if self.index:
+            # freshly loaded items are written back on commit even if left untouched
+            self._touched.update(missing)
+
+    def reload(self, item_ids):
+        """
+        Re-reads the open states of items changed with queries of their own, bypassing
+        the index. Must be called after flush() so that no change to them is pending.
+        """
+        item_ids = list(set(item_ids))
+        self.__load(item_ids)
+        self._touched.update(item_ids)
+
+    def __load(self, item_ids):
+        for offset in range(0, len(item_ids), BULK_BATCH_SIZE):
+            chunk = item_ids[offset : offset + BULK_BATCH_SIZE]
+            for item_id in chunk:
+                self._open[item_id] = {}
+            open_states = self.model.objects.filter(
+                item_id__in=chunk, end__isnull=True
+            ).annotate(latest_event=latest_event())
+            for state in open_states:
+                self._open[state.item_id][state.location_link] = state
+            self.__stored(open_states)
+
+    def __stored(self, open_states):
+        # the latest event loaded along with the open states spares __event_after()
+        # a query for every item that has one
+        for state in open_states:
+            if getattr(state, "latest_event", None) is not None:
+                self._stored_latest[state.item_id] = state.latest_event
+
+    def _states_for(self, item_id):
+        if item_id not in self._open:
+            self.__preload_open([item_id])
+        return self._open[item_id]
+
+    def open_for_item(self, item_id):
+        states = self._states_for(item_id)
+        if len(states) > 1:
+            raise State.MultipleObjectsReturned(
+                f"{item_id} has {len(states)} open states"
+            )
+        return next(iter(states.values()), None)
+
+    def open_at(self, item_id, location_link):
+        return self._states_for(item_id).get(location_link)
+
+    def changed_after(self, item_id, timestamp, location_link=None):
+        """
+        Whether the item - or the item at location_link - changed after timestamp.
+
+        A collection's quantity at a location only changes by closing and opening states
+        there, so its open state there is the latest change. An individually tracked item
+        can be scanned again where it already is, which leaves no trace in State, so its
+        latest event decides - it is loaded along with the open states, so only an item
+        without any is looked up. The database is only asked for the latest closed state
+        at a location if the item has had any event since timestamp.
+        """
+        states = self._states_for(item_id)
+        if location_link in states:
+            return states[location_link].start > timestamp
+        if location_link is None and any(
+            state.start > timestamp for state in states.values()
+        ):
+            return True
+
+        if not self.__event_after(item_id, timestamp):
+            return False
+        if location_link is None:
+            return True
+
+        # closed by this store but not written yet
+        if any(
+            state.end > timestamp
+            for state in self._to_update + self._to_create
+            if state.end is not None
+            and state.item_id == item_id
+            and state.location_link == location_link
+        ):
+            return True
+        if self.model.objects.filter(
+            item_id=item_id, location_link=location_link, end__gt=timestamp
+        ).exists():
+            return True
+        return self.archive is not None and self.archive.state_ended_after(
+            item_id, location_link, timestamp
+        )
+
+    def __event_after(self, item_id, timestamp):
+        if self.__hot_event_after(item_id, timestamp):
+            return True
+        return self.archive is not None and self.archive.event_after(item_id, timestamp)
+
+    def __hot_event_after(self, item_id, timestamp):
+        applied = self._applied_latest.get(item_id)
+        if applied is not None and applied > timestamp:
+            return True
+        if item_id in self._stored_latest:
+            stored = self._stored_latest[item_id]
+            return stored is not None and stored > timestamp
+        # an item without open states - one round trip for all three event tables
+        quote = connection.ops.quote_name
+        sql = " UNION ALL ".join(
+            f"SELECT 1 FROM {quote(model._meta.db_table)}"
+            f" WHERE {quote('item_id')} = %s AND {quote('timestamp')} > %s"
+            for model in EVENT_MODELS
+        )
+        value = connection.ops.adapt_datetimefield_value(timestamp)
+        with connection.cursor() as cursor:
+            cursor.execute(f"{sql} LIMIT 1", [item_id, value] * len(EVENT_MODELS))
+            return cursor.fetchone() is not None
+
+    def applied(self, item_ids, timestamp):
+        """Notes an event applied to items, which may not be stored yet"""
+        if self.index:
+            # the index learns of their latest event even if their states are unchanged
+            self._touched.update(item_ids)
+        for item_id in item_ids:
+            latest = self._applied_latest.get(item_id)
+            if latest is None or timestamp > latest:
+                self._applied_latest[item_id] = timestamp
+
+    def __load_latest_events(self, item_ids):
+        for offset in range(0, len(item_ids), BULK_BATCH_SIZE):
+            chunk = item_ids[offset : offset + BULK_BATCH_SIZE]
+            for item_id in chunk:
+                self._stored_latest[item_id] = None
+            latest_per_model = [
+                model.objects.filter(item_id__in=chunk)
+                .values("item_id")
+                .annotate(latest=Max("timestamp"))
+                .values_list("item_id", "latest")
+                for model in EVENT_MODELS
+            ]
+            rows = latest_per_model[0].union(*latest_per_model[1:], all=True)
+            for item_id, latest in rows:
+                stored = self._stored_latest[item_id]
+                if stored is None or latest > stored:
+                    self._stored_latest[item_id] = latest
+
+    def close(self, state, timestamp):
+        state.end = timestamp
+        self._states_for(state.item_id).pop(state.location_link, None)
+        self._touched.add(state.item_id)
+        self.touched_locations.add(state.location_link)
+        if self.rollups is not None:
+            self.__closed(state, timestamp)
+
+        if not self.deferred:
+            state.save(update_fields=["end"])
+        elif state.pk is not None:
+            self._to_update.append(state)
+        # else: created in this window - it is inserted with its end already set
+
+    def create(self, item_id, location_link, start, quantity=None):
+        state = self.model(
+            item_id=item_id, location_link=location_link, start=start, quantity=quantity
+        )
+        self._states_for(item_id)[location_link] = state
+        self._touched.add(item_id)
+        self.touched_locations.add(location_link)
+        if self.rollups is not None:
+            self.__created(state)
+
+        if self.deferred:
+            self._to_create.append(state)
+        else:
+            state.save(force_insert=True)
+        return state
+
+    def flush(self):
+        # closes first so that no item ever has two open rows at the same location
+        if self._to_update:
+            self.model.objects.bulk_update(
+                self._to_update, ["end"], batch_size=BULK_BATCH_SIZE
+            )
+        if self._to_create:
+            self.model.objects.bulk_create(self._to_create, batch_size=BULK_BATCH_SIZE)
+        self.__flush_current_state()
+        self._to_update = []
+        self._to_create = []
+
+        if self.rollups is not None:
+            for (item_id, location_link, timestamp), quantity in self._replaced.items():
+                self._moves.append((location_link, timestamp, *moved(-quantity)))
+            self.rollups.add(self._moves)
+        self._moves = []
+        self._replaced = {}
+
+        if self.index and self._touched:
+            open_states = {
+                item_id: dict(self._open[item_id]) for item_id in self._touched
+            }
+            latest = {item_id: self.__latest(item_id) for item_id in self._touched}
+            transaction.on_commit(lambda: self.index.update(open_states, latest))
+        self._touched = set()
+
+    def __latest(self, item_id):
+        known = [
+            latest
+            for latest in (
+                self._stored_latest.get(item_id),
+                self._applied_latest.get(item_id),
+            )
+            if latest is not None
+        ]
+        return max(known, default=None)
+
+    # the moves of the states as rollups.state_moves() reads them back from State
+    def __closed(self, state, timestamp):
+        if state.quantity is None:
+            self._moves.append((state.location_link, timestamp, *moved(-1)))
+        else:
+            key = (state.item_id, state.location_link, timestamp)
+            self._replaced[key] = state.quantity
+
+    def __created(self, state):
+        if state.quantity is None:
+            self._moves.append((state.location_link, state.start, *moved(1)))
+            return
+        previous = self._replaced.pop(
+            (state.item_id, state.location_link, state.start), 0
+        )
+        self._moves.append(
+            (state.location_link, state.start, *moved(state.quantity - previous))
+        )
+
+    def __flush_current_state(self):
+        # bulk writes skip the signals that keep CurrentState in step with single saves
+        closed = [state.pk for state in self._to_update]
+        for offset in range(0, len(closed), BULK_BATCH_SIZE):
+            CurrentState.objects.filter(
+                record_id__in=closed[offset : offset + BULK_BATCH_SIZE]
+            ).delete()
+
+        opened = [state for state in self._to_create if state.end is None]
+        if any(state.pk is None for state in opened):
+            # the backend does not return the ids of bulk inserted rows
+            refresh_current_state(state.item_id for state in opened)
+        else:
+            CurrentState.objects.bulk_create(
+                [current_state_for(state) for state in opened],
+                batch_size=BULK_BATCH_SIZE,
+            )
@@ -1,3 +1,977 @@
-from django.test import TestCase
+from contextlib import redirect_stdout
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import Count, F, Q
+from django.test import Client, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from unittest import mock, skipUnless
+from urllib.parse import urlencode
+import datetime
+import io
+import os
+import queue
+import tempfile
+import threading
 
-# Create your tests here.
+from event_handler import Event
+from . import analytics, benchmarks, partitions, settings_cache
+from . import event_handler as state_event_handler
+from . import versions, views
+from .management.commands import explain_queries
+from .management.commands.check_shared_consumers import LocalSharedBroker, consume
+from .archive import HistoryArchive
+from .dedupe import MessageDeduplicator
+from .lanes import LanePool
+from .models import (
+    ArchivedState,
+    ArchivedTransferEvent,
+    CurrentState,
+    ProcessedMessage,
+    Setting,
+    State,
+    StateSnapshot,
+    TransferEvent,
+)
+from .open_state_index import open_state_index
+from .response_cache import ResponseCache
+from .snapshots import StateSnapshots
+from .store import ADVISORY_LOCK_NAMESPACE, current_state_differences, lock_items
+
+# the optional parts of the handler, all off unless a test sets one up
+HANDLER_OPTIONS = (
+    "batcher",
+    "lanes",
+    "deduplicator",
+    "publisher",
+    "snapshots",
+    "rollups",
+    "state_index",
+)
+
+
+class HandlerTestCase(TransactionTestCase):
+    """Runs the event handler with every optional part off unless a test sets it"""
+
+    def setUp(self):
+        for name in HANDLER_OPTIONS:
+            patcher = mock.patch.object(state_event_handler, name, None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        open_state_index.invalidate()
+        self.addCleanup(open_state_index.invalidate)
+
+    def handle(self, messages):
+        """Handles messages as the MQTT client would - returns what was published"""
+        with benchmarks.quiet_handler() as published:
+            for msg in messages:
+                output = benchmarks.handler_for(msg)(msg)
+                published.extend(output or [])
+        return published
+
+    def handle_batched(self, messages, size=20):
+        """Handles messages in windows of size as the batcher would"""
+        with benchmarks.quiet_handler() as published:
+            for offset in range(0, len(messages), size):
+                state_event_handler.apply_batch(
+                    [
+                        (parse_fn_for(msg), msg)
+                        for msg in messages[offset : offset + size]
+                    ]
+                )
+        return published
+
+
+def parse_fn_for(msg):
+    if msg.topic.startswith("production_operation"):
+        return state_event_handler.parse_prod_op
+    return state_event_handler.parse_transfer_op
+
+
+def at(seconds):
+    return benchmarks.T0 + datetime.timedelta(seconds=seconds)
+
+
+def transfer(item, to_loc, seconds):
+    return Event(
+        f"transfer_operation/{to_loc}",
+        {"timestamp": at(seconds).isoformat(), "item": item, "to_loc": to_loc},
+    )
+
+
+def delayed(messages, every=7, by=3):
+    """messages with every `every`th one delivered `by` places late"""
+    messages = list(messages)
+    for position in range(0, len(messages) - by, every):
+        messages.insert(position + by, messages.pop(position))
+    return messages
+
+
+def open_states():
+    return sorted(
+        State.objects.filter(end__isnull=True).values_list(
+            "item_id", "location_link", "quantity"
+        )
+    )
+
+
+def state_history():
+    return list(
+        State.objects.order_by(
+            "item_id", "location_link", "start", F("end").asc(nulls_last=True)
+        ).values_list("item_id", "location_link", "start", "end", "quantity")
+    )
+
+
+class SharedConsumerTests(HandlerTestCase):
+    def test_consumers_sharing_a_subscription_open_one_state_per_item(self):
+        if connection.vendor == "sqlite" and connection.is_in_memory_db():
+            # fails a writer that finds it locked at once - a file or server database
+            # makes it wait
+            self.skipTest("needs a test database that concurrent writers wait on")
+        messages = benchmarks.individual_transfers(200, 5, 4) + (
+            benchmarks.collection_transfers(60, 2, 4)
+        )
+        # threads rather than processes, so that they share the test database
+        broker = LocalSharedBroker(queue)
+        for msg in messages:
+            broker.publish(msg)
+        broker.close(4)
+        consumers = [threading.Thread(target=consume, args=(broker,)) for _ in range(4)]
+        for consumer in consumers:
+            consumer.start()
+        for consumer in consumers:
+            consumer.join()
+
+        self.assertEqual(TransferEvent.objects.count(), len(messages))
+        self.assertFalse(
+            State.objects.filter(end__isnull=True, quantity__isnull=True)
+            .values("item_id")
+            .annotate(count=Count("record_id"))
+            .filter(count__gt=1)
+        )
+        self.assertFalse(
+            State.objects.filter(end__isnull=True)
+            .values("item_id", "location_link")
+            .annotate(count=Count("record_id"))
+            .filter(count__gt=1)
+        )
+
+
+class LockItemsTests(TransactionTestCase):
+    def write_from_another_thread(self):
+        errors = []
+
+        def write():
+            try:
+                State.objects.create(
+                    item_id="b", location_link="loc", start="2025-01-01T00:00Z"
+                )
+            except OperationalError as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        thread.join()
+        return errors
+
+    @skipUnless(connection.vendor == "sqlite", "SQLite only")
+    def test_sqlite_takes_the_write_lock(self):
+        with transaction.atomic():
+            lock_items(["a"])
+            self.assertTrue(self.write_from_another_thread())
+        self.assertFalse(self.write_from_another_thread())
+
+    @skipUnless(connection.vendor == "postgresql", "Postgres only")
+    def test_postgres_takes_an_advisory_lock_per_item(self):
+        def held():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' "
+                    "AND classid = %s AND pid = pg_backend_pid()",
+                    [ADVISORY_LOCK_NAMESPACE],
+                )
+                return cursor.fetchone()[0]
+
+        with transaction.atomic():
+            lock_items(["a", "b", "a"])
+            self.assertEqual(held(), 2)
+        self.assertEqual(held(), 0)
+
+
+class DedupeTests(HandlerTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(
+            state_event_handler, "deduplicator", MessageDeduplicator()
+        )
+        self.deduplicator = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_redelivery_is_dropped(self):
+        messages = benchmarks.individual_transfers(20, 3, 3)
+        self.handle(messages)
+        history = state_history()
+
+        self.handle(messages)
+        self.assertEqual(TransferEvent.objects.count(), len(messages))
+        self.assertEqual(state_history(), history)
+
+    def test_redelivery_to_another_process_is_dropped(self):
+        messages = benchmarks.individual_transfers(20, 3, 3)
+        self.handle(messages)
+        history = state_history()
+
+        # a process that has not seen them - only ProcessedMessage knows
+        self.deduplicator.clear()
+        self.handle(messages)
+        self.assertEqual(TransferEvent.objects.count(), len(messages))
+        self.assertEqual(ProcessedMessage.objects.count(), len(messages))
+        self.assertEqual(state_history(), history)
+
+    def test_without_dedupe_a_redelivery_is_applied_again(self):
+        state_event_handler.deduplicator = None
+        messages = benchmarks.individual_transfers(5, 1, 3)
+        self.handle(messages)
+        self.handle(messages[-1:])
+        self.assertEqual(TransferEvent.objects.count(), len(messages) + 1)
+
+
+class LateEventTests(HandlerTestCase):
+    def test_late_events_give_the_history_of_in_order_ones(self):
+        messages = benchmarks.individual_transfers(60, 4, 3) + (
+            benchmarks.collection_transfers(60, 2, 3)
+        )
+        messages.sort(key=lambda msg: msg.content["timestamp"])
+        self.handle(messages)
+        history = state_history()
+        benchmarks.clear_tables()
+
+        published = self.handle(delayed(messages))
+        self.assertEqual(state_history(), history)
+        self.assertTrue(any("/corrected/" in msg.topic for msg in published))
+
+    def test_late_event_before_a_scan_where_the_item_already_was(self):
+        # the second scan at loc@a leaves no trace in State, only in TransferEvent
+        self.handle(
+            [transfer("product@1", "loc@a", 0), transfer("product@1", "loc@a", 20)]
+        )
+        self.handle([transfer("product@1", "loc@b", 10)])
+        self.assertEqual(
+            state_history(),
+            [
+                ("product@1", "loc@a", at(0), at(10), None),
+                ("product@1", "loc@a", at(20), None, None),
+                ("product@1", "loc@b", at(10), at(20), None),
+            ],
+        )
+
+    def test_late_event_with_the_open_state_index(self):
+        state_event_handler.state_index = open_state_index
+        self.handle(
+            [transfer("product@1", "loc@a", 0), transfer("product@1", "loc@a", 20)]
+        )
+        self.handle([transfer("product@1", "loc@b", 10)])
+        self.assertEqual(open_states(), [("product@1", "loc@a", None)])
+        self.assertEqual(
+            State.objects.filter(item_id="product@1", location_link="loc@b").count(), 1
+        )
+
+    def test_in_order_event_reads_no_event_table(self):
+        self.handle([transfer("product@1", "loc@a", 0)])
+        with CaptureQueriesContext(connection) as queries:
+            self.handle([transfer("product@1", "loc@b", 10)])
+        self.assertFalse(
+            [
+                query["sql"]
+                for query in queries
+                if query["sql"].startswith("SELECT 1 FROM")
+            ]
+        )
+
+
+def mixed_workload():
+    messages = (
+        benchmarks.individual_transfers(60, 6, 3)
+        + benchmarks.collection_transfers(40, 2, 3, seed=1)
+        + benchmarks.production_events(10, 3, 3, seed=2)
+    )
+    return sorted(messages, key=lambda msg: msg.content["timestamp"])
+
+
+class OrderingTests(HandlerTestCase):
+    """Batched and laned ingestion end where handling one message at a time does"""
+
+    def one_by_one(self, messages):
+        self.handle(messages)
+        history = state_history()
+        benchmarks.clear_tables()
+        return history
+
+    def test_batched(self):
+        for messages in (mixed_workload(), delayed(mixed_workload(), every=5)):
+            expected = self.one_by_one(messages)
+            for size in (1, 7, 50):
+                with self.subTest(size=size):
+                    self.handle_batched(messages, size)
+                    self.assertEqual(state_history(), expected)
+                    benchmarks.clear_tables()
+
+    def test_lanes(self):
+        if connection.vendor == "sqlite" and connection.is_in_memory_db():
+            self.skipTest("needs a test database that concurrent writers wait on")
+        messages = delayed(mixed_workload())
+        expected = self.one_by_one(messages)
+
+        pool = LanePool(lanes=4)
+        with mock.patch.object(state_event_handler, "lanes", pool):
+            self.handle(messages)
+            pool.stop()
+        self.assertEqual(sum(pool.processed), len(messages))
+        self.assertEqual(state_history(), expected)
+        self.assertEqual(TransferEvent.objects.count(), 100)
+
+
+class RebuildTests(HandlerTestCase):
+    def rebuild(self, **options):
+        checkpoint = os.path.join(tempfile.mkdtemp(), "rebuild.checkpoint.json")
+        call_command(
+            "rebuild_state", checkpoint=checkpoint, stdout=io.StringIO(), **options
+        )
+
+    def test_matches_live_handling(self):
+        # events at the same instant have no order, and a late one among them is put
+        # in a different one live than by the replay - so each gets its own instant
+        messages = [
+            Event(msg.topic, {**msg.content, "timestamp": at(step / 1000).isoformat()})
+            for step, msg in enumerate(mixed_workload())
+        ]
+        messages = delayed(messages)
+        self.handle(messages[:60])
+        self.handle_batched(messages[60:], size=9)
+        history = state_history()
+        self.rebuild(batch_size=17)
+        self.assertEqual(state_history(), history)
+
+    def test_dry_run_leaves_state_alone(self):
+        self.handle(mixed_workload())
+        history = state_history()
+        State.objects.filter(end__isnull=True).first().delete()
+        changed = state_history()
+        stdout = io.StringIO()
+        checkpoint = os.path.join(tempfile.mkdtemp(), "rebuild.checkpoint.json")
+        call_command(
+            "rebuild_state", checkpoint=checkpoint, dry_run=True, stdout=stdout
+        )
+        self.assertIn("1 rows only in the rebuild", stdout.getvalue())
+        self.assertEqual(state_history(), changed)
+        self.rebuild()
+        self.assertEqual(state_history(), history)
+
+
+def get(path, etag=None):
+    headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+    with redirect_stdout(io.StringIO()):
+        return Client().get(path, HTTP_ACCEPT="application/json", **headers)
+
+
+@override_settings(STATE_VERSIONS=True)
+class ETagTests(HandlerTestCase):
+    def test_not_modified_until_a_change(self):
+        self.handle(mixed_workload())
+        for path in ("/state/", "/state/history", "/events/"):
+            with self.subTest(path=path):
+                response = get(path)
+                etag = response.headers["ETag"]
+                self.assertEqual(get(path, etag).status_code, 304)
+
+                self.handle([transfer("product@1", "loc@9", 1)])
+                response = get(path, etag)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_scoped_to_the_item_or_location(self):
+        self.handle(mixed_workload())
+        etags = {
+            path: get(path).headers["ETag"]
+            for path in ("/state/for/product@1", "/state/at/loc@1", "/events/at/loc@1")
+        }
+        self.handle([transfer("product@2", "loc@9", 1)])
+        for path, etag in etags.items():
+            with self.subTest(path=path):
+                self.assertEqual(get(path, etag).status_code, 304)
+
+        self.handle([transfer("product@1", "loc@1", 2)])
+        for path, etag in etags.items():
+            with self.subTest(path=path):
+                self.assertEqual(get(path, etag).status_code, 200)
+
+    def test_an_edit_outside_the_handler(self):
+        self.handle(mixed_workload())
+        etag = get("/state/for/product@1").headers["ETag"]
+        versions.bump_all()  # as the admin does
+        self.assertEqual(get("/state/for/product@1", etag).status_code, 200)
+
+    @override_settings(STATE_VERSIONS=False)
+    def test_off(self):
+        self.handle(mixed_workload())
+        self.assertNotIn("ETag", get("/state/").headers)
+
+
+@override_settings(STATE_VERSIONS=True)
+class ResponseCacheTests(HandlerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = ResponseCache(max_entries=3)
+        patcher = mock.patch.object(state_event_handler, "response_cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        versions.bumped.connect(self.cache.on_bumped)
+        self.addCleanup(versions.bumped.disconnect, self.cache.on_bumped)
+        self.handle(mixed_workload())
+
+    def test_served_until_a_change_evicts_it(self):
+        paths = ("/state/", "/state/for/product@1", "/state/for/product@2")
+        first = {path: get(path).content for path in paths}
+        self.assertEqual({path: get(path).content for path in paths}, first)
+        self.assertEqual((self.cache.hits, self.cache.misses), (3, 3))
+
+        # evicts the item's entries and those over everything
+        self.handle([transfer("product@2", "loc@9", 1)])
+        self.assertEqual(self.cache.stats()["entries"], 1)
+        self.assertEqual(get("/state/for/product@1").content, first[paths[1]])
+        self.assertEqual(self.cache.hits, 4)
+        self.assertIn(b"loc@9", get("/state/for/product@2").content)
+        self.assertIn(b"loc@9", get("/state/").content)
+
+    def test_bounded(self):
+        for n in range(5):
+            get(f"/state/for/product@{n}")
+        self.assertEqual(self.cache.stats()["entries"], 3)
+        self.assertEqual(self.cache.evictions, 2)
+        # the least recently used went first
+        get("/state/for/product@4")
+        get("/state/for/product@0")
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 6))
+
+
+class CurrentStateTests(HandlerTestCase):
+    def assertInStep(self):
+        self.assertEqual(current_state_differences(), [])
+        self.assertEqual(CurrentState.objects.count(), len(open_states()))
+
+    def test_handler(self):
+        self.handle(mixed_workload())
+        self.assertInStep()
+
+    def test_batched_handler(self):
+        self.handle_batched(mixed_workload())
+        self.assertInStep()
+
+    def test_late_events(self):
+        self.handle(delayed(mixed_workload()))
+        self.assertInStep()
+        self.handle_batched(delayed(mixed_workload(), every=5))
+        self.assertInStep()
+
+    def test_single_saves_and_deletes(self):
+        self.handle(mixed_workload())
+        state = State.objects.filter(end__isnull=True).first()
+        state.location_link = "loc@elsewhere"
+        state.save()
+        self.assertInStep()
+        state.end = at(3600)
+        state.save()
+        self.assertInStep()
+        State.objects.filter(end__isnull=True).first().delete()
+        self.assertInStep()
+        State.objects.create(item_id="product@new", location_link="loc@0", start=at(0))
+        self.assertInStep()
+
+    def test_rebuild(self):
+        self.handle(delayed(mixed_workload()))
+        CurrentState.objects.all().delete()
+        checkpoint = os.path.join(tempfile.mkdtemp(), "rebuild.checkpoint.json")
+        call_command("rebuild_state", checkpoint=checkpoint, stdout=io.StringIO())
+        self.assertInStep()
+
+    def test_late_event_into_the_archive(self):
+        self.handle(mixed_workload())
+        for _ in HistoryArchive(age=0).run(now=at(1)):
+            pass
+        archived = ArchivedState.objects.count()
+        self.handle([transfer("product@1", "loc@0", 0.005)])
+        self.assertLess(ArchivedState.objects.count(), archived)
+        self.assertInStep()
+
+    def test_check_and_repair(self):
+        self.handle(mixed_workload())
+        CurrentState.objects.filter(
+            record_id__in=CurrentState.objects.values("record_id")[:2]
+        ).delete()
+        with self.assertRaises(CommandError):
+            call_command("check_current_state", stdout=io.StringIO())
+        call_command("check_current_state", repair=True, stdout=io.StringIO())
+        self.assertInStep()
+        call_command("check_current_state", stdout=io.StringIO())
+
+
+def scanned_at(instant):
+    """The State rows open at instant, from a scan of every row"""
+    return sorted(
+        state.record_id
+        for state in State.objects.all()
+        if state.start <= instant and (state.end is None or state.end >= instant)
+    )
+
+
+def state_at(instant):
+    qs, archived = views.state_at(instant, Q())
+    return sorted(qs.values_list("record_id", flat=True))
+
+
+class PointInTimeTestCase(HandlerTestCase):
+    def assertMatchesScan(self, instants):
+        for instant in instants:
+            with self.subTest(instant=instant):
+                self.assertEqual(state_at(instant), scanned_at(instant))
+
+    def history_instants(self):
+        # each start and end, and the instants either side of them
+        instants = set()
+        for start, end in State.objects.values_list("start", "end"):
+            for instant in (start, end):
+                if instant is not None:
+                    instants.update(
+                        instant + datetime.timedelta(milliseconds=offset)
+                        for offset in (-1, 0, 1)
+                    )
+        return sorted(instants)[::7]
+
+
+class IntervalIndexTests(PointInTimeTestCase):
+    def test_at_instant_matches_a_scan(self):
+        State.objects.bulk_create(benchmarks.state_history(20, 10, 4))
+        self.handle(benchmarks.individual_transfers(100, 10, 4))
+        self.assertMatchesScan(self.history_instants())
+
+    def test_row_whose_end_is_before_its_start(self):
+        State.objects.bulk_create(benchmarks.state_history(5, 4, 2))
+        backwards = State.objects.create(
+            item_id="product@x", location_link="loc@0", start=at(100), end=at(50)
+        )
+        backwards.end = at(20)
+        backwards.save()
+        self.assertMatchesScan([at(20), at(50), at(75), at(100), at(101)])
+        self.assertNotIn(backwards.record_id, state_at(at(100)))
+
+    def test_migrates_rows_whose_end_is_before_their_start(self):
+        executor = MigrationExecutor(connection)
+        latest = executor.loader.graph.leaf_nodes("state")
+        before = [("state", "0014_currentstate")]
+        executor.migrate(before)
+        self.addCleanup(lambda: MigrationExecutor(connection).migrate(latest))
+        old_state = executor.loader.project_state(before).apps.get_model(
+            "state", "State"
+        )
+        old_state.objects.create(
+            item_id="product@x", location_link="loc@0", start=at(100), end=at(50)
+        )
+        old_state.objects.create(
+            item_id="product@y", location_link="loc@0", start=at(0)
+        )
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(latest)
+        State.objects.create(
+            item_id="product@z", location_link="loc@1", start=at(30), end=at(10)
+        )
+        self.assertMatchesScan([at(10), at(30), at(50), at(100)])
+
+
+class SnapshotTests(PointInTimeTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(state_event_handler, "snapshots", StateSnapshots())
+        self.snapshots = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_at_instant_matches_a_scan(self):
+        messages = benchmarks.individual_transfers(100, 10, 4)
+        self.handle(messages[:50])
+        self.snapshots.take(at(0.02))
+        self.snapshots.take(at(0.045))
+        self.handle(messages[50:])
+        self.snapshots.take(at(0.08))
+        self.assertEqual(StateSnapshot.objects.count(), 3)
+        self.assertMatchesScan(self.history_instants())
+
+    def test_late_event_deletes_the_snapshots_after_it(self):
+        messages = benchmarks.individual_transfers(100, 10, 4)
+        self.handle(messages)
+        for seconds in (0.02, 0.05, 0.08):
+            self.snapshots.take(at(seconds))
+
+        self.handle([transfer("product@1", "loc@9", 0.06)])
+        self.assertEqual(
+            list(StateSnapshot.objects.values_list("taken_at", flat=True)),
+            [at(0.02), at(0.05)],
+        )
+        self.assertMatchesScan(self.history_instants() + [at(0.06), at(0.08)])
+
+    def test_in_order_event_deletes_no_snapshot(self):
+        self.handle(benchmarks.individual_transfers(20, 3, 3))
+        self.snapshots.take(at(0.01))
+        with CaptureQueriesContext(connection) as queries:
+            self.handle([transfer("product@1", "loc@9", 1)])
+        self.assertEqual(StateSnapshot.objects.count(), 1)
+        deletes = 'DELETE FROM "state_statesnapshot"'
+        self.assertFalse(
+            [query["sql"] for query in queries if query["sql"].startswith(deletes)]
+        )
+
+
+class ExplainTests(TransactionTestCase):
+    # the indexes each event view has to read, by the start of its label
+    INDEXES = {
+        "/events/?": {"transfer_time_idx"},
+        "/events/for/": {"transfer_item_time_idx"},
+        "/events/to/": {"transfer_to_time_idx"},
+        "/events/from/": {"transfer_from_time_idx"},
+        "/events/at/": {
+            "transfer_to_time_idx",
+            "transfer_from_time_idx",
+            "production_loc_time_idx",
+            "production_from_time_idx",
+            "input_loc_time_idx",
+        },
+        "report?type=transfer": {"transfer_time_idx"},
+    }
+
+    def setUp(self):
+        self.command = explain_queries.Command()
+        self.command.seed(
+            {
+                "transfers": 3000,
+                "productions": 300,
+                "inputs": 3,
+                "items": 100,
+                "locations": 20,
+            }
+        )
+        if connection.vendor == "postgresql":
+            # at this size a scan would do - whether an index serves the query, in
+            # order, is what is checked
+            with connection.cursor() as cursor:
+                cursor.execute("SET enable_seqscan = off")
+                cursor.execute("SET enable_bitmapscan = off")
+            self.addCleanup(self.reset_planner)
+
+    def reset_planner(self):
+        with connection.cursor() as cursor:
+            cursor.execute("RESET enable_seqscan")
+            cursor.execute("RESET enable_bitmapscan")
+
+    def test_event_views_read_their_indexes_in_order(self):
+        if connection.vendor not in ("sqlite", "postgresql"):
+            self.skipTest(f"EXPLAIN isn't checked on {connection.vendor}")
+        checked = set()
+        for label, run in self.command.cases():
+            with self.subTest(label=label):
+                statements = explain_queries.Statements()
+                with connection.execute_wrapper(statements):
+                    run()
+                self.assertTrue(statements.selects)
+                indexes = set()
+                for sql, params in statements.selects:
+                    lines, used, problems = explain_queries.explain(sql, params)
+                    self.assertEqual(problems, [], "\n".join([sql, *lines]))
+                    indexes.update(used)
+                prefix = next(
+                    prefix for prefix in self.INDEXES if label.startswith(prefix)
+                )
+                checked.add(prefix)
+                self.assertLessEqual(self.INDEXES[prefix], indexes)
+        self.assertEqual(checked, set(self.INDEXES))
+
+
+@skipUnless(analytics.np is not None, "needs NumPy")
+class LeadTimeTests(TransactionTestCase):
+    def states(self, item_id, *moves):
+        """(location_link, start) of each state in turn - the last left open"""
+        ends = [start for _, start in moves[1:]] + [None]
+        State.objects.bulk_create(
+            State(
+                item_id=item_id,
+                location_link=location_link,
+                start=at(start),
+                end=at(end) if end is not None else None,
+            )
+            for (location_link, start), end in zip(moves, ends)
+        )
+
+    def test_counts_from_the_first_arrival(self):
+        self.states("product@1", ("loc@0", 0), ("loc@done", 250))
+        # arrived before the window, and back again in it
+        self.states(
+            "product@2",
+            ("loc@0", 0),
+            ("loc@done", 100),
+            ("loc@1", 150),
+            ("loc@done", 300),
+        )
+        self.states("product@3", ("loc@0", 200), ("loc@1", 500))
+
+        lead_times = analytics.lead_times(at(200), at(400), "loc@done")
+        self.assertEqual(lead_times["count"], 1)
+        self.assertEqual(lead_times["mean"], 250)
+
+
+class ArchiveTests(HandlerTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(
+            state_event_handler, "history_archive", HistoryArchive(age=0)
+        )
+        self.archive = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def archive_before(self, seconds):
+        for _ in self.archive.run(now=at(seconds)):
+            pass
+
+    def pages(self, path):
+        """Every row of path, following its cursor a page at a time"""
+        client = Client()
+        rows = []
+        url = f"{path}{'&' if '?' in path else '?'}limit=13"
+        while url:
+            with redirect_stdout(io.StringIO()):
+                response = client.get(url, HTTP_ACCEPT="application/json")
+            self.assertEqual(response.status_code, 200, url)
+            rows.extend(response.json())
+            cursor = response.headers.get("X-Next-Cursor")
+            url = f"{path}{'&' if '?' in path else '?'}limit=13&cursor={cursor}"
+            url = url if cursor else None
+        return rows
+
+    def test_reads_merge_the_archive(self):
+        self.handle(mixed_workload())
+        window = urlencode({"from": at(0.02).isoformat(), "to": at(0.09).isoformat()})
+        paths = [
+            f"/state/?{urlencode({'t': at(0.03).isoformat()})}",
+            "/state/history",
+            f"/state/history?{window}",
+            "/state/history/for/product@1",
+            "/state/history/at/loc@1",
+            "/events/",
+            f"/events/?{window}",
+            "/events/for/product@1",
+            "/events/at/loc@1",
+        ]
+        expected = {path: self.pages(path) for path in paths}
+
+        self.archive_before(0.05)
+        self.assertTrue(ArchivedState.objects.exists())
+        for path in paths:
+            with self.subTest(path=path):
+                self.assertEqual(self.pages(path), expected[path])
+
+    def test_late_event_before_an_archived_scan(self):
+        # the scan at 20 s leaves no trace in State - only in the archived events
+        self.handle(
+            [transfer("product@1", "loc@a", 0), transfer("product@1", "loc@a", 20)]
+        )
+        self.archive_before(30)
+        self.assertFalse(TransferEvent.objects.exists())
+
+        self.handle([transfer("product@1", "loc@b", 10)])
+        self.assertEqual(
+            state_history(),
+            [
+                ("product@1", "loc@a", at(0), at(10), None),
+                ("product@1", "loc@a", at(20), None, None),
+                ("product@1", "loc@b", at(10), at(20), None),
+            ],
+        )
+
+    def test_late_collection_event_before_an_archived_state(self):
+        moves = [
+            Event(
+                f"transfer_operation/{to_loc}/{from_loc}",
+                {
+                    "timestamp": at(seconds).isoformat(),
+                    "item": "prodtype@1",
+                    "quantity": quantity,
+                    "to_loc": to_loc,
+                    "from_loc": from_loc,
+                },
+            )
+            for to_loc, from_loc, quantity, seconds in (
+                ("loc@a", "loc@x", 5, 0),
+                ("loc@b", "loc@a", 2, 20),
+                ("loc@y", "loc@a", 5, 40),
+            )
+        ]
+        self.handle(moves)
+        history = state_history()
+        benchmarks.clear_tables()
+
+        # loc@a is empty from 40 s, and its states and events are archived
+        self.handle(moves[:1] + moves[2:])
+        self.archive_before(50)
+        self.handle(moves[1:2])
+        self.assertEqual(state_history(), history)
+
+
+def days(count):
+    return count * 86400
+
+
+@skipUnless(connection.vendor == "postgresql", "Postgres only")
+class PartitionTests(HandlerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.archive = HistoryArchive(age=days(45))
+        self.table_partitions = partitions.TablePartitions(ahead=1, keep=1)
+        # the tables are partitioned inside a transaction each test rolls back
+        atomic = transaction.atomic()
+        atomic.__enter__()
+        self.addCleanup(atomic.__exit__, None, None, None)
+        self.addCleanup(transaction.set_rollback, True)
+
+    def moves(self):
+        # every ten days from January to April
+        return [
+            transfer(f"product@{n % 3}", f"loc@{n % 4}", days(10 * n))
+            for n in range(12)
+        ]
+
+    def convert(self, now):
+        for model in (State, TransferEvent):
+            self.table_partitions.convert(model, at(now))
+            self.assertTrue(partitions.is_partitioned(model))
+
+    def test_record_id_stays_unique(self):
+        self.handle(self.moves()[:8])
+        self.convert(days(75))
+        self.handle(self.moves()[8:])
+
+        for state in (
+            State.objects.filter(end__isnull=True).first(),
+            State.objects.filter(end__isnull=False).first(),
+        ):
+            with self.subTest(end=state.end):
+                with self.assertRaises(IntegrityError), transaction.atomic():
+                    State.objects.bulk_create(
+                        [
+                            State(
+                                record_id=state.record_id,
+                                item_id="product@new",
+                                location_link="loc@0",
+                                start=state.start,
+                                end=state.end,
+                            )
+                        ]
+                    )
+
+    def test_serial_sequence_survives(self):
+        # as a table created before Django 4.1 has it
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "ALTER TABLE state_state ALTER COLUMN record_id DROP IDENTITY; "
+                "CREATE SEQUENCE state_state_record_id_seq "
+                "OWNED BY state_state.record_id; "
+                "ALTER TABLE state_state ALTER COLUMN record_id "
+                "SET DEFAULT nextval('state_state_record_id_seq')"
+            )
+        self.handle(self.moves()[:8])
+        self.convert(days(75))
+        last = State.objects.order_by("-record_id").first().record_id
+        self.handle(self.moves()[8:])
+        self.assertGreater(State.objects.order_by("-record_id").first().record_id, last)
+
+    def test_old_partitions_move_to_the_archive(self):
+        self.handle(self.moves()[:8])
+        self.convert(days(75))
+        self.handle(self.moves()[8:])
+        history = sorted(state_history())
+        events = TransferEvent.objects.count()
+
+        created, archived = self.table_partitions.maintain(
+            State, at(days(120)), self.archive
+        )
+        self.table_partitions.maintain(TransferEvent, at(days(120)), self.archive)
+        # keep's cutoff is April, the archive's horizon the middle of March
+        self.assertEqual(
+            list(archived), ["state_state_p2025_01", "state_state_p2025_02"]
+        )
+        self.assertEqual(ArchivedState.objects.count(), sum(archived.values()))
+        self.assertFalse(set(archived) & set(partitions.partitions(State)))
+        self.assertEqual(
+            sorted(
+                state_history()
+                + list(
+                    ArchivedState.objects.values_list(
+                        "item_id", "location_link", "start", "end", "quantity"
+                    )
+                )
+            ),
+            history,
+        )
+        self.assertEqual(
+            TransferEvent.objects.count() + ArchivedTransferEvent.objects.count(),
+            events,
+        )
+
+        # a late event before the archived months
+        self.handle([transfer("product@0", "loc@9", days(5))])
+        self.assertIn(
+            ("product@0", "loc@9", at(days(5)), at(days(30)), None),
+            state_history(),
+        )
+
+
+class SettingsCacheTests(TransactionTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(
+            state_event_handler, "settings_cache", settings_cache.SettingsCache()
+        )
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.published = []
+        patcher = mock.patch.object(
+            settings_cache, "send_events", self.published.extend
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def set(self, **values):
+        for key, value in values.items():
+            Setting.objects.update_or_create(key=key, defaults={"value": value})
+
+    def test_announced_once_per_transaction(self):
+        self.assertEqual(self.cache.get().completed_duration_days, 7)
+        with transaction.atomic():
+            self.set(completed_location="loc@9", completed_duration_days="3")
+            self.assertEqual(self.published, [])
+        self.assertEqual(len(self.published), 1)
+        self.assertEqual(self.cache.get().completed_duration_days, 3)
+
+        self.set(completed_duration_days="4")
+        self.assertEqual(len(self.published), 2)
+
+    def test_announced_after_a_rollback(self):
+        self.cache.get()
+        with transaction.atomic():
+            self.set(completed_duration_days="3")
+            transaction.set_rollback(True)
+        self.assertEqual(self.published, [])
+        self.assertEqual(self.cache.get().completed_duration_days, 7)
+
+        with transaction.atomic():
+            self.set(completed_duration_days="5")
+        self.assertEqual(len(self.published), 1)
+        self.assertEqual(self.cache.get().completed_duration_days, 5)
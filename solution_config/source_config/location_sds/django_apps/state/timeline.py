@@ -0,0 +1,125 @@
+"""
+The event timeline of a location for /events/at/<location_link>.
+
+Transfers into and out of the location, production there and the inputs consumed there
+are each read by one query ordered by timestamp, and the queries' cursors are merged as
+they are read. Rows come out oldest first, ties in the order transfer, produced,
+consumed and then by primary key. ?limit=N reads at most N+1 rows of each query, and
+the cursor it returns resumes every query after the page's last row. A window reaching
+back before a table's archive horizon reads its archive as a further stream.
+"""
+
+from django.db.models import Q
+import heapq
+import itertools
+
+from . import archive
+from .models import TransferEvent, ProductionEvent, ProductionEventInput
+from .pagination import decode_cursor, encode_cursor, page_limit
+from .serialization import serializer_for
+from .serializers import (
+    TransferEventSerializer,
+    ProductionEventSerializer,
+    ProductionEventInputSerializer,
+)
+from .streaming import iterate
+
+# (type, rank in ties, model, serializer, location field) - an event with the location
+# in both of its fields is read twice and merged into one
+STREAMS = (
+    ("transfer", 0, TransferEvent, TransferEventSerializer, "to_location_link"),
+    ("transfer", 0, TransferEvent, TransferEventSerializer, "from_location_link"),
+    ("produced", 1, ProductionEvent, ProductionEventSerializer, "location_link"),
+    ("produced", 1, ProductionEvent, ProductionEventSerializer, "from_location_link"),
+    (
+        "consumed",
+        2,
+        ProductionEventInput,
+        ProductionEventInputSerializer,
+        "location_link",
+    ),
+)
+
+# every column of the three types, for a CSV streamed before the rows are known
+CSV_HEADER = sorted(
+    {"type"}.union(
+        TransferEventSerializer.Meta.fields,
+        ProductionEventSerializer.Meta.fields,
+        ProductionEventInputSerializer.Meta.fields,
+    )
+)
+
+
+def after_q(rank, after):
+    """The rows of a stream of the given rank that come after the key after"""
+    timestamp, after_rank, pk = after
+    if rank < after_rank:
+        return Q(timestamp__gt=timestamp)
+    if rank > after_rank:
+        return Q(timestamp__gte=timestamp)
+    return Q(timestamp__gte=timestamp) & (Q(timestamp__gt=timestamp) | Q(pk__gt=pk))
+
+
+def entries(location_link, timeframe_q, after=None, limit=None, start=None):
+    """
+    ((timestamp, rank, pk), type, row, serializer) for each event at the location, in
+    timeline order - at most limit + 1 of them if limit is given. Archived events are
+    read too if the timeline from start reaches before the archive horizon.
+    """
+    horizons = archive.horizons()
+    streams = []
+    for type, rank, model, serializer_class, field in STREAMS:
+        q = Q(**{field: location_link}) & timeframe_q
+        archived = archive.archived(
+            model, q, start, horizons.get(archive.CHECKPOINT_KEYS[model])
+        )
+        for queryset in (model.objects.filter(q), archived):
+            if queryset is None:
+                continue
+            if after is not None:
+                queryset = queryset.filter(after_q(rank, after))
+            rows, serializer = serializer_for(
+                queryset.order_by("timestamp", "pk"), serializer_class, extra=["pk"]
+            )
+            if limit is not None:
+                rows = rows[: limit + 1]
+            streams.append(stream(rows, type, rank, serializer))
+
+    merged = unique(heapq.merge(*streams, key=lambda entry: entry[0]))
+    return merged if limit is None else itertools.islice(merged, limit + 1)
+
+
+def stream(rows, type, rank, serializer):
+    for row in iterate(rows):
+        yield (row.timestamp, rank, row.pk), type, row, serializer
+
+
+def unique(entries):
+    # an event read from both of its location fields comes out twice in a row
+    last = None
+    for entry in entries:
+        if entry[0] != last:
+            yield entry
+        last = entry[0]
+
+
+def page(request, location_link, timeframe_q, start=None):
+    """
+    The entries of the page the request asks for and the cursor of the next page (None
+    on the last page) - or all of them and None if it doesn't ask for a page
+    """
+    if "limit" not in request.GET and "cursor" not in request.GET:
+        return entries(location_link, timeframe_q, start=start), None
+
+    limit = page_limit(request)
+    cursor = request.GET.get("cursor", None)
+    after = decode_cursor(cursor, length=3) if cursor else None
+    rows = list(entries(location_link, timeframe_q, after, limit, start))
+    if len(rows) <= limit:
+        return rows, None
+    return rows[:limit], encode_cursor(*rows[limit - 1][0])
+
+
+def representation(entry):
+    key, type, row, serializer = entry
+    return {**serializer.to_representation(row), "type": type}
@@ -12,14 +12,20 @@ urlpatterns= [
         path('',views.getAll),
         path('for/<str:item_id>',views.forItem),
         path('at/<str:location_link>',views.atLocLink),
+        path('index',views.openStateIndex),
+        path('ingest',views.ingestStats),
+        path('cache',views.responseCacheStats),
         path('history',views.historyAll),
         path('history/for/<str:item_id>',views.historyFor),
         path('history/at/<str:location_link>',views.historyAt),
     ]
 
-#/state/                            ?t=timestamp
-#/state/for/<item_id>               ?t=timestamp
-#/state/at/<location_link>          ?t=timestamp
-#/state/history                     ?from=timestamp ?to=timestamp
-#/state/history/for/<item_id>       ?from=timestamp ?to=timestamp
-#/state/history/at/<loction_link>   ?from=timestamp ?to=timestamp
+#/state/                            ?t=timestamp ?stream=json|ndjson|csv
+#/state/for/<item_id>               ?t=timestamp ?stream=json|ndjson|csv
+#/state/at/<location_link>          ?t=timestamp ?stream=json|ndjson|csv
+#/state/index                       ?verify=1
+#/state/ingest
+#/state/cache
+#/state/history                     ?from=timestamp ?to=timestamp ?limit=n ?cursor=next ?stream=json|ndjson|csv
+#/state/history/for/<item_id>       ?from=timestamp ?to=timestamp ?limit=n ?cursor=next ?stream=json|ndjson|csv
+#/state/history/at/<loction_link>   ?from=timestamp ?to=timestamp ?limit=n ?cursor=next ?stream=json|ndjson|csv
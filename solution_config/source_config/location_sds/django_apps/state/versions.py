@@ -0,0 +1,119 @@
+"""
+Version counters for ETags on the state and event views.
+
+Every change to State or the event tables bumps the global version, and sets the
+versions of the items and locations it touched to the new global version. A view's
+ETag is then made from the version of the item, location or everything it shows -
+answering If-None-Match takes one query on StateVersion and none on State.
+
+A change that can't say what it touched - an admin edit or a rebuild - sets the "all"
+version, which every other version is read as at least. A change to the settings only
+bumps the global version, as only the views over everything read them.
+
+The versions are only kept with STATE_VERSIONS - otherwise there are no ETags. A bump
+is made once the change commits, in a transaction of its own, so the global row is
+locked for the bump alone rather than for the whole of the change and the writers
+aren't serialised on it. A GET in between may still be answered 304 for the old
+version, and a process that dies in between leaves the change unversioned until the
+next bump of the same keys.
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.dispatch import Signal
+import zlib
+
+from .models import StateVersion
+
+GLOBAL = "global"
+ALL = "all"
+BULK_BATCH_SIZE = 500
+
+# sent with item_ids, location_links and everything once a bump commits
+bumped = Signal()
+
+
+def item_key(item_id):
+    return f"item:{item_id}"
+
+
+def location_key(location_link):
+    return f"location:{location_link}"
+
+
+def enabled():
+    return getattr(settings, "STATE_VERSIONS", False)
+
+
+def next_version():
+    # the row stays locked until the bump's transaction ends, so versions follow the
+    # order the bumps commit in
+    if StateVersion.objects.filter(key=GLOBAL).update(version=F("version") + 1):
+        return StateVersion.objects.get(key=GLOBAL).version
+    StateVersion.objects.create(key=GLOBAL, version=1)
+    return 1
+
+
+def bump(item_ids=(), location_links=()):
+    """Notes a change to the states or events of items and locations once it commits"""
+    if not enabled():
+        return
+    item_ids, location_links = set(item_ids), set(location_links)
+    # robust - the change has committed whatever happens to its bump
+    transaction.on_commit(lambda: __bump(item_ids, location_links), robust=True)
+
+
+def __bump(item_ids, location_links):
+    keys = {item_key(item_id) for item_id in item_ids}
+    keys.update(location_key(link) for link in location_links if link)
+    with transaction.atomic():
+        version = next_version()
+        StateVersion.objects.bulk_create(
+            [StateVersion(key=key, version=version) for key in sorted(keys)],
+            update_conflicts=True,
+            unique_fields=["key"],
+            update_fields=["version"],
+            batch_size=BULK_BATCH_SIZE,
+        )
+    bumped.send(
+        sender=None,
+        item_ids=item_ids,
+        location_links=location_links,
+        everything=False,
+    )
+
+
+def bump_all():
+    """Notes a change that may have touched any item or location once it commits"""
+    if not enabled():
+        return
+    transaction.on_commit(__bump_all, robust=True)
+
+
+def __bump_all():
+    with transaction.atomic():
+        version = next_version()
+        StateVersion.objects.update_or_create(key=ALL, defaults={"version": version})
+    bumped.send(sender=None, item_ids=(), location_links=(), everything=True)
+
+
+def current(key=GLOBAL):
+    versions = dict(
+        StateVersion.objects.filter(key__in=[key, ALL]).values_list("key", "version")
+    )
+    return max(versions.get(key, 0), versions.get(ALL, 0))
+
+
+def etag(request, key=GLOBAL, extra=()):
+    """
+    An ETag for a GET of the state or events behind key - it changes with their version
+    and with the URL, the Accept header and anything else the response depends on.
+    None without STATE_VERSIONS.
+    """
+    if not enabled():
+        return None
+    variant = "|".join(
+        [request.get_full_path(), request.META.get("HTTP_ACCEPT", ""), *map(str, extra)]
+    )
+    return f"{current(key)}-{zlib.crc32(variant.encode()):08x}"
@@ -1,5 +1,7 @@
+from django.db import transaction
 from django.db.models import Q
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.views.decorators.http import etag
 from django.conf import settings as django_settings
 from rest_framework import viewsets, status
 from rest_framework.decorators import (
@@ -8,20 +10,21 @@ from rest_framework.decorators import (
     permission_classes,
     renderer_classes,
 )
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticatedOrReadOnly, AllowAny
 from rest_framework.renderers import JSONRenderer, BrowsableAPIRenderer
 from rest_framework.response import Response
 from rest_framework_csv.renderers import CSVRenderer
 import datetime
 import dateutil.parser
-from functools import lru_cache
+from functools import lru_cache, wraps
 import csv
+import itertools
 
 from .models import (
     State,
+    CurrentState,
     TransferEvent,
-    ProductionEvent,
-    ProductionEventInput,
     Setting,
     Status,
     ItemStatus,
@@ -30,16 +33,36 @@ from .models import (
 from .serializers import (
     StateSerializer,
     TransferEventSerializer,
-    ProductionEventInputSerializer,
-    ProductionEventSerializer,
     StatusSerializer,
     NoteSerializer,
 )
 import logging
-import time
 import requests
 
 import event_handler
+from . import event_handler as state_event_handler
+from .intervals import at_instant
+from .open_state_index import open_state_index
+from .pagination import (
+    paginate,
+    paginate_merged,
+    merge,
+    next_page_headers,
+    STATE_KEY,
+    EVENT_KEY,
+)
+from .serialization import serializer_for
+from . import analytics, archive, settings_cache, timeline, versions
+from .response_cache import scope
+from .streaming import (
+    ROWS_PER_WRITE,
+    Echo,
+    chunked,
+    representations,
+    stream_data,
+    stream_format,
+    stream_response,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -56,26 +79,108 @@ def search_by_name_query(query):
         return []
 
 
+def list_response(request, rows, serializer_class, key=None, archived=None):
+    """
+    Serializes rows, a page at a time if key is given (see pagination.py) and streaming
+    them if the request asks for it (see streaming.py). The archived rows, if any, are
+    merged in on key (see archive.py).
+    """
+    rows, serializer = serializer_for(rows, serializer_class)
+    next_cursor = None
+    if archived is not None:
+        archived, _ = serializer_for(archived, serializer_class)
+        rows, next_cursor = paginate_merged(request, [rows, archived], key)
+    elif key is not None:
+        rows, next_cursor = paginate(request, rows, key)
+    headers = next_page_headers(request, next_cursor)
+    fmt = stream_format(request)
+    if fmt is not None:
+        return stream_response(rows, serializer, fmt, headers)
+    return Response(list(representations(rows, serializer)), headers=headers)
+
+
+# ETags from the version counters (see versions.py) - the etag decorator answers a
+# matching If-None-Match with 304 before the view runs
+def global_etag(request):
+    return versions.etag(request)
+
+
+def item_etag(request, item_id):
+    return versions.etag(request, versions.item_key(item_id))
+
+
+def location_etag(request, location_link):
+    return versions.etag(request, versions.location_key(location_link))
+
+
+def state_etag(request):
+    if request.GET.get("q", None):
+        return None  # the search is answered by the id service
+    # the completed location filter moves on at midnight
+    return versions.etag(request, extra=[datetime.date.today()])
+
+
+def cached_response(etag_func):
+    """
+    Serves GETs of a view from the response cache, if one is set up, while their ETag
+    is unchanged. Goes under the etag decorator, which has already answered 304s.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            cache = state_event_handler.response_cache
+            if cache is None or request.method != "GET":
+                return view(request, *args, **kwargs)
+            tag = etag_func(request, *args, **kwargs)
+            if tag is None:
+                return view(request, *args, **kwargs)
+
+            key = (tag, request.get_full_path(), request.META.get("HTTP_ACCEPT", ""))
+            entry = cache.get(key)
+            if entry is not None:
+                status, headers, content = entry
+                return HttpResponse(content, status=status, headers=headers)
+
+            response = view(request, *args, **kwargs)
+            # the browsable API's pages carry the user and a CSRF token
+            browsable = isinstance(
+                getattr(response, "accepted_renderer", None), BrowsableAPIRenderer
+            )
+            if response.status_code == 200 and not response.streaming and not browsable:
+                response.render()
+                headers = [(k, v) for k, v in response.items() if k != "ETag"]
+                cache.set(key, scope(kwargs), 200, headers, response.content)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+@etag(state_etag)
+@cached_response(state_etag)
 @api_view(("GET",))
 @renderer_classes((JSONRenderer, BrowsableAPIRenderer, CSVRenderer))
 def getAll(request):
     at = request.GET.get("t", None)
     query = request.GET.get("q", None)
 
-    qs = query_all_state(at, query)
+    qs, archived = query_all_state(at, query)
 
-    serializer = StateSerializer(qs, many=True)
-    # logger.info(f"results: {serializer.data}")
-    return Response(serializer.data)
+    # a time before the archive horizon merges in the archived rows (see archive.py)
+    key = STATE_KEY if at else None
+    return list_response(request, qs, StateSerializer, key, archived=archived)
 
 
 def query_all_state(at, search_query):
-    q = Q(end__isnull=True) & ~Q(quantity=0)
-
+    """
+    The rows of /state/, and for a time before the archive horizon the archived rows
+    that were open then (otherwise None), both newest first
+    """
+    q = ~Q(quantity=0)
     if at:
-        print(f"get all at {at}")
-        at_dt = dateutil.parser.isoparse(at)  # parse "at" to datetime
-        q = (q | Q(end__gte=at_dt)) & Q(start__lte=at_dt)
+        q = ~Q(end__isnull=True, quantity=0)
 
     if search_query:
         # fetch valid ids matching query
@@ -83,67 +188,115 @@ def query_all_state(at, search_query):
         # logger.info(f"search query '{query}' returned ids: {valid_ids}")
         q = q & Q(item_id__in=valid_ids)
 
-    settings_dict = {
-        s.key: s.value
-        for s in Setting.objects.filter(
-            key__in=["completed_location", "completed_duration_days"]
-        )
-    }
-    completed_location = settings_dict.get("completed_location", None)
+    current = current_settings()
+    completed_location = current.completed_location
     filter_completed = completed_location is not None
     if filter_completed:
-        __dt = -1 * (
-            time.timezone if (time.localtime().tm_isdst == 0) else time.altzone
-        )
-        tz = datetime.timezone(datetime.timedelta(seconds=__dt))
-
-        end_of_today = datetime.datetime.combine(
-            datetime.datetime.now(tz=tz), datetime.datetime.min.time(), tzinfo=tz
-        ) + datetime.timedelta(days=1)
-
-        filter_days = int(settings_dict.get("completed_duration_days", 1))
-        filter_completed_timestamp = end_of_today - datetime.timedelta(days=filter_days)
+        filter_completed_timestamp = current.completed_cutoff()
 
         q = q & (Q(quantity__isnull=False) | ~(
             Q(start__lte=filter_completed_timestamp)
             & Q(location_link__exact=completed_location)
         ))
 
-    return State.objects.filter(q).order_by("-start")
+    if at:
+        print(f"get all at {at}")
+        at_dt = dateutil.parser.isoparse(at)  # parse "at" to datetime
+        qs, archived = state_at(at_dt, q)
+        return qs.order_by("-start", "-record_id"), archived
+
+    # the open states are read from CurrentState, without the history
+    return CurrentState.objects.filter(q).order_by("-start"), None
+
 
+def current_settings():
+    """The typed settings - cached in the process with SETTINGS_CACHE"""
+    cache = state_event_handler.settings_cache
+    return cache.get() if cache is not None else settings_cache.load()
 
+
+def state_at(at_dt, q):
+    """
+    The State rows matching q that were open at at_dt, and the archived ones - None
+    unless at_dt is before the archive horizon, as only rows closed before it are moved
+    """
+    qs = State.objects.filter(q)
+    snapshots = state_event_handler.snapshots
+    if snapshots is not None:
+        qs = snapshots.at_instant(qs, at_dt)
+    else:
+        qs = at_instant(qs, at_dt)
+    archived = archive.archived(State, q & Q(start__lte=at_dt, end__gte=at_dt), at_dt)
+    return qs, archived
+
+
+@etag(item_etag)
+@cached_response(item_etag)
 @api_view(("GET",))
 @renderer_classes((JSONRenderer, BrowsableAPIRenderer, CSVRenderer))
 def forItem(request, item_id):
     at = request.GET.get("t", None)
-    q = Q(end__isnull=True)
+    q = Q(item_id__exact=item_id)
+    qs = CurrentState.objects.filter(q).order_by("-start")
+    key = archived = None
 
     if at:
         print(f"get all at {at}")
         at_dt = dateutil.parser.isoparse(at)  # parse "at" to datetime
-        q = (q | Q(end__gte=at_dt)) & Q(start__lte=at_dt)
-    q = q & Q(item_id__exact=item_id)
-    qs = State.objects.filter(q).order_by("-start")
-    serializer = StateSerializer(qs, many=True)
-    return Response(serializer.data)
+        qs, archived = state_at(at_dt, q)
+        key = STATE_KEY
+    return list_response(request, qs, StateSerializer, key, archived=archived)
 
 
+@etag(location_etag)
+@cached_response(location_etag)
 @api_view(("GET",))
 @renderer_classes((JSONRenderer, BrowsableAPIRenderer, CSVRenderer))
 def atLocLink(request, location_link):
     at = request.GET.get("t", None)
-    q = Q(end__isnull=True)
+    q = Q(location_link__exact=location_link)
+    qs = CurrentState.objects.filter(q).order_by("-start")
+    key = archived = None
 
     if at:
         print(f"get all at {at}")
         at_dt = dateutil.parser.isoparse(at)  # parse "at" to datetime
-        q = (q | Q(end__gte=at_dt)) & Q(start__lte=at_dt)
-    q = q & Q(location_link__exact=location_link)
-    qs = State.objects.filter(q).order_by("-start")
-    serializer = StateSerializer(qs, many=True)
-    return Response(serializer.data)
+        qs, archived = state_at(at_dt, q)
+        key = STATE_KEY
+    return list_response(request, qs, StateSerializer, key, archived=archived)
+
+
+@api_view(("GET",))
+@renderer_classes((JSONRenderer, BrowsableAPIRenderer))
+def openStateIndex(request):
+    stats = open_state_index.stats()
+    if request.GET.get("verify", False):
+        stats["differences"] = open_state_index.verify()
+    return Response(stats)
 
 
+@api_view(("GET",))
+@renderer_classes((JSONRenderer, BrowsableAPIRenderer))
+def responseCacheStats(request):
+    response_cache = state_event_handler.response_cache
+    return Response(response_cache.stats() if response_cache is not None else None)
+
+
+@api_view(("GET",))
+@renderer_classes((JSONRenderer, BrowsableAPIRenderer))
+def ingestStats(request):
+    lanes = state_event_handler.lanes
+    deduplicator = state_event_handler.deduplicator
+    return Response(
+        {
+            "batched": state_event_handler.batcher is not None,
+            "lanes": lanes.stats() if lanes is not None else None,
+            "dedupe": deduplicator.stats() if deduplicator is not None else None,
+        }
+    )
+
+
+@etag(global_etag)
 @api_view(("GET",))
 @renderer_classes((JSONRenderer, BrowsableAPIRenderer, CSVRenderer))
 def historyAll(request):
@@ -152,6 +305,7 @@ def historyAll(request):
     print(f"history {t_start}>{t_end}")
 
     q = Q()
+    start_dt = None
 
     if t_start:
         start_dt = dateutil.parser.isoparse(t_start)
@@ -161,11 +315,16 @@ def historyAll(request):
         end_dt = dateutil.parser.isoparse(t_end)
         q = q & Q(start__lte=end_dt)
 
-    qs = State.objects.filter(q).order_by("-start")
-    serializer = StateSerializer(qs, many=True)
-    return Response(serializer.data)
+    return list_response(
+        request,
+        State.objects.filter(q),
+        StateSerializer,
+        STATE_KEY,
+        archived=archive.archived(State, q, start_dt),
+    )
 
 
+@etag(item_etag)
 @api_view(("GET",))
 @renderer_classes((JSONRenderer, BrowsableAPIRenderer, CSVRenderer))
 def historyFor(request, item_id):
@@ -174,6 +333,7 @@ def historyFor(request, item_id):
     print(f"history {t_start}>{t_end}")
 
     q = Q()
+    start_dt = None
 
     if t_start:
         start_dt = dateutil.parser.isoparse(t_start)
@@ -184,11 +344,16 @@ def historyFor(request, item_id):
         q = q & Q(start__lte=end_dt)
 
     q = q & Q(item_id__exact=item_id)
-    qs = State.objects.filter(q).order_by("-start")
-    serializer = StateSerializer(qs, many=True)
-    return Response(serializer.data)
+    return list_response(
+        request,
+        State.objects.filter(q),
+        StateSerializer,
+        STATE_KEY,
+        archived=archive.archived(State, q, start_dt),
+    )
 
 
+@etag(location_etag)
 @api_view(("GET",))
 @renderer_classes((JSONRenderer, BrowsableAPIRenderer, CSVRenderer))
 def historyAt(request, location_link):
@@ -197,6 +362,7 @@ def historyAt(request, location_link):
     print(f"history {t_start}>{t_end}")
 
     q = Q()
+    start_dt = None
 
     if t_start:
         start_dt = dateutil.parser.isoparse(t_start)
@@ -207,11 +373,16 @@ def historyAt(request, location_link):
         q = q & Q(start__lte=end_dt)
 
     q = q & Q(location_link__exact=location_link)
-    qs = State.objects.filter(q).order_by("-start")
-    serializer = StateSerializer(qs, many=True)
-    return Response(serializer.data)
+    return list_response(
+        request,
+        State.objects.filter(q),
+        StateSerializer,
+        STATE_KEY,
+        archived=archive.archived(State, q, start_dt),
+    )
 
 
+@etag(global_etag)
 @api_view(("GET",))
 @renderer_classes((JSONRenderer, BrowsableAPIRenderer, CSVRenderer))
 def getAllEvents(request):
@@ -219,15 +390,25 @@ def getAllEvents(request):
     t_end = request.GET.get("to", None)
     print(f"all events {t_start}>{t_end}")
 
-    qs = query_all_events(t_start, t_end)
-
-    serializer = TransferEventSerializer(qs, many=True)
-    return Response(serializer.data)
+    q, start_dt = all_events_q(t_start, t_end)
+    return list_response(
+        request,
+        TransferEvent.objects.filter(q),
+        TransferEventSerializer,
+        EVENT_KEY,
+        archived=archive.archived(TransferEvent, q, start_dt),
+    )
 
 
 def query_all_events(t_start, t_end):
+    q, start_dt = all_events_q(t_start, t_end)
+    return TransferEvent.objects.filter(q).order_by("-timestamp", "-event_id")
+
+
+def all_events_q(t_start, t_end):
     q = Q()
 
+    start_dt = None
     if t_start:
         start_dt = dateutil.parser.isoparse(t_start)
         q = q & Q(timestamp__gte=start_dt)
@@ -236,9 +417,10 @@ def query_all_events(t_start, t_end):
         end_dt = dateutil.parser.isoparse(t_end)
         q = q & Q(timestamp__lte=end_dt)
 
-    return TransferEvent.objects.filter(q).order_by("-timestamp")
+    return q, start_dt
 
 
+@etag(item_etag)
 @api_view(("GET",))
 @renderer_classes((JSONRenderer, BrowsableAPIRenderer, CSVRenderer))
 def eventsForItem(request, item_id):
@@ -248,6 +430,7 @@ def eventsForItem(request, item_id):
 
     q = Q(item_id__exact=item_id)
 
+    start_dt = None
     if t_start:
         start_dt = dateutil.parser.isoparse(t_start)
         q = q & Q(timestamp__gte=start_dt)
@@ -256,11 +439,16 @@ def eventsForItem(request, item_id):
         end_dt = dateutil.parser.isoparse(t_end)
         q = q & Q(timestamp__lte=end_dt)
 
-    qs = TransferEvent.objects.filter(q).order_by("-timestamp")
-    serializer = TransferEventSerializer(qs, many=True)
-    return Response(serializer.data)
+    return list_response(
+        request,
+        TransferEvent.objects.filter(q),
+        TransferEventSerializer,
+        EVENT_KEY,
+        archived=archive.archived(TransferEvent, q, start_dt),
+    )
 
 
+@etag(location_etag)
 @api_view(("GET",))
 @renderer_classes((JSONRenderer, BrowsableAPIRenderer, CSVRenderer))
 def eventsToLocLink(request, location_link):
@@ -270,6 +458,7 @@ def eventsToLocLink(request, location_link):
 
     q = Q(to_location_link__exact=location_link)
 
+    start_dt = None
     if t_start:
         start_dt = dateutil.parser.isoparse(t_start)
         q = q & Q(timestamp__gte=start_dt)
@@ -278,11 +467,16 @@ def eventsToLocLink(request, location_link):
         end_dt = dateutil.parser.isoparse(t_end)
         q = q & Q(timestamp__lte=end_dt)
 
-    qs = TransferEvent.objects.filter(q).order_by("-timestamp")
-    serializer = TransferEventSerializer(qs, many=True)
-    return Response(serializer.data)
+    return list_response(
+        request,
+        TransferEvent.objects.filter(q),
+        TransferEventSerializer,
+        EVENT_KEY,
+        archived=archive.archived(TransferEvent, q, start_dt),
+    )
 
 
+@etag(location_etag)
 @api_view(("GET",))
 @renderer_classes((JSONRenderer, BrowsableAPIRenderer, CSVRenderer))
 def eventsFromLocLink(request, location_link):
@@ -292,6 +486,7 @@ def eventsFromLocLink(request, location_link):
 
     q = Q(from_location_link__exact=location_link)
 
+    start_dt = None
     if t_start:
         start_dt = dateutil.parser.isoparse(t_start)
         q = q & Q(timestamp__gte=start_dt)
@@ -300,11 +495,16 @@ def eventsFromLocLink(request, location_link):
         end_dt = dateutil.parser.isoparse(t_end)
         q = q & Q(timestamp__lte=end_dt)
 
-    qs = TransferEvent.objects.filter(q).order_by("-timestamp")
-    serializer = TransferEventSerializer(qs, many=True)
-    return Response(serializer.data)
+    return list_response(
+        request,
+        TransferEvent.objects.filter(q),
+        TransferEventSerializer,
+        EVENT_KEY,
+        archived=archive.archived(TransferEvent, q, start_dt),
+    )
 
 
+@etag(location_etag)
 @api_view(("GET",))
 @renderer_classes((JSONRenderer, BrowsableAPIRenderer, CSVRenderer))
 def eventsAtLocLink(request, location_link):
@@ -312,10 +512,8 @@ def eventsAtLocLink(request, location_link):
     t_end = request.GET.get("to", None)
     print(f"all events {t_start}>{t_end}")
 
-    transfer_q = Q(from_location_link__exact=location_link) | Q(
-        to_location_link__exact=location_link
-    )
     timeframe_q = Q()
+    start_dt = None
 
     if t_start:
         start_dt = dateutil.parser.isoparse(t_start)
@@ -325,34 +523,13 @@ def eventsAtLocLink(request, location_link):
         end_dt = dateutil.parser.isoparse(t_end)
         timeframe_q = timeframe_q & Q(timestamp__lte=end_dt)
 
-    qs = TransferEvent.objects.filter(transfer_q & timeframe_q)
-    transfer_serializer = TransferEventSerializer(qs, many=True)
-
-    qs_prod = ProductionEvent.objects.filter(
-        (
-            Q(location_link__exact=location_link)
-            | Q(from_location_link__exact=location_link)
-        )
-        & timeframe_q
-    )
-    produced_serializer = ProductionEventSerializer(qs_prod, many=True)
-
-    qs_cons = ProductionEventInput.objects.filter(
-        Q(location_link__exact=location_link) & timeframe_q
-    )
-    consumed_serializer = ProductionEventInputSerializer(qs_cons, many=True)
-
-    all = [{**transfer, "type": "transfer"} for transfer in transfer_serializer.data]
-    all.extend(
-        [{**produced, "type": "produced"} for produced in produced_serializer.data]
-    )
-    all.extend(
-        [{**consumed, "type": "consumed"} for consumed in consumed_serializer.data]
-    )
-
-    all.sort(key=lambda entry: entry["timestamp"])
-
-    return Response(all)
+    rows, next_cursor = timeline.page(request, location_link, timeframe_q, start_dt)
+    headers = next_page_headers(request, next_cursor)
+    data = map(timeline.representation, rows)
+    fmt = stream_format(request)
+    if fmt is not None:
+        return stream_data(data, fmt, headers, header=timeline.CSV_HEADER)
+    return Response(list(data), headers=headers)
 
 
 @api_view(("GET", "POST"))
@@ -366,10 +543,14 @@ def settings(request, key):
         settings_dict = {s.key: s.value for s in qs}
         return Response(settings_dict)
     elif request.method == "POST":
-        for key, value in request.data.items():
-            setting_obj, created = Setting.objects.update_or_create(
-                key=key, defaults={"value": value}
-            )
+        # all or none of them, announced once
+        with transaction.atomic():
+            for key, value in request.data.items():
+                setting_obj, created = Setting.objects.update_or_create(
+                    key=key, defaults={"value": value}
+                )
+            # settings filter what /state/ shows - a global version bump
+            versions.bump()
         qs = Setting.objects.all()
         settings_dict = {s.key: s.value for s in qs}
         return Response(settings_dict)
@@ -477,109 +658,132 @@ def handle_note(request, note_id):
         return Response()
 
 
-@api_view(("GET",))
-@renderer_classes((JSONRenderer, BrowsableAPIRenderer))
-def report(request):
-    type = request.GET.get("type")
-    start = request.GET.get("start")
-    end = request.GET.get("end")
-
-    response = HttpResponse(
-        content_type="text/csv",
-        headers={"Content-Disposition": 'attachment; filename="somefilename.csv"'},
+def report_batches(data):
+    # the id service is asked for the details of a batch of rows at a time
+    data = iter(data)
+    while batch := list(itertools.islice(data, ROWS_PER_WRITE)):
+        yield batch
+
+
+def state_report(qs, archived=None):
+    csvwriter = csv.writer(Echo())
+    yield csvwriter.writerow(
+        [
+            "Item ID",
+            "Item Type",
+            "Item Name",
+            "Parent ID",
+            "Parent Type",
+            "Parent Name",
+            "Quantity",
+        ]
     )
-    csvwriter = csv.writer(response)
 
-    match (type):
-        case "state":
-            qs = query_all_state(end, None)
-            serializer = StateSerializer(qs, many=True)
-            details_needed = set()
-            for entry in serializer.data:
-                details_needed.add(entry["item_id"])
-                details_needed.add(entry["location_link"])
-            details_dict = get_all_details(list(details_needed))
-
-            csvwriter.writerow(
+    rows, serializer = serializer_for(qs, StateSerializer)
+    if archived is not None:
+        archived, _ = serializer_for(archived, StateSerializer)
+        rows = merge([rows, archived.order_by("-start", "-record_id")], STATE_KEY)
+    rows = representations(rows, serializer)
+    for batch in report_batches(rows):
+        details_needed = set()
+        for entry in batch:
+            details_needed.add(entry["item_id"])
+            details_needed.add(entry["location_link"])
+        details_dict = get_all_details(list(details_needed))
+
+        for entry in batch:
+            item_id = entry["item_id"]
+            item_details = details_dict[item_id]
+
+            parent_id = entry["location_link"]
+            parent_details = details_dict[parent_id]
+            yield csvwriter.writerow(
                 [
-                    "Item ID",
-                    "Item Type",
-                    "Item Name",
-                    "Parent ID",
-                    "Parent Type",
-                    "Parent Name",
-                    "Quantity",
+                    item_id,
+                    item_details["type"],
+                    item_details["name"],
+                    parent_id,
+                    parent_details["type"],
+                    parent_details["name"],
+                    entry["quantity"],
                 ]
             )
 
-            for entry in serializer.data:
-                item_id = entry["item_id"]
-                item_details = details_dict[item_id]
-
-                parent_id = entry["location_link"]
-                parent_details = details_dict[parent_id]
-                csvwriter.writerow(
-                    [
-                        item_id,
-                        item_details["type"],
-                        item_details["name"],
-                        parent_id,
-                        parent_details["type"],
-                        parent_details["name"],
-                        entry["quantity"],
-                    ]
-                )
-        case "transfer":
-            qs = query_all_events(start, end)
-            serializer = TransferEventSerializer(qs, many=True)
 
-            details_needed = set()
-            for entry in serializer.data:
-                details_needed.add(entry["item_id"])
-                details_needed.add(entry["from_location_link"])
-                details_needed.add(entry["to_location_link"])
-            details_dict = get_all_details(list(details_needed))
+def transfer_report(qs, archived=None):
+    csvwriter = csv.writer(Echo())
+    yield csvwriter.writerow(
+        [
+            "Item ID",
+            "Item Type",
+            "Item Name",
+            "From ID",
+            "From Type",
+            "From Name",
+            "To ID",
+            "To Type",
+            "To Name",
+            "Timestamp"
+            "Quantity",
+        ]
+    )
 
-            csvwriter.writerow(
+    rows, serializer = serializer_for(qs, TransferEventSerializer)
+    if archived is not None:
+        archived, _ = serializer_for(archived, TransferEventSerializer)
+        rows = merge([rows, archived.order_by("-timestamp", "-event_id")], EVENT_KEY)
+    rows = representations(rows, serializer)
+    for batch in report_batches(rows):
+        details_needed = set()
+        for entry in batch:
+            details_needed.add(entry["item_id"])
+            details_needed.add(entry["from_location_link"])
+            details_needed.add(entry["to_location_link"])
+        details_dict = get_all_details(list(details_needed))
+
+        for entry in batch:
+            item_id = entry["item_id"]
+            item_details = details_dict[item_id]
+
+            from_id = entry["from_location_link"]
+            from_details = details_dict[from_id]
+
+            to_id = entry["to_location_link"]
+            to_details = details_dict[to_id]
+            yield csvwriter.writerow(
                 [
-                    "Item ID",
-                    "Item Type",
-                    "Item Name",
-                    "From ID",
-                    "From Type",
-                    "From Name",
-                    "To ID",
-                    "To Type",
-                    "To Name",
-                    "Timestamp"
-                    "Quantity",
+                    item_id,
+                    item_details["type"],
+                    item_details["name"],
+                    from_id,
+                    from_details["type"] if from_id else "",
+                    from_details["name"] if from_id else "",
+                    to_id,
+                    to_details["type"],
+                    to_details["name"],
+                    entry["timestamp"],
+                    entry["quantity"],
                 ]
             )
 
-            for entry in serializer.data:
-                item_id = entry["item_id"]
-                item_details = details_dict[item_id]
-
-                from_id = entry["from_location_link"]
-                from_details = details_dict[from_id]
-
-                to_id = entry["to_location_link"]
-                to_details = details_dict[to_id]
-                csvwriter.writerow(
-                    [
-                        item_id,
-                        item_details["type"],
-                        item_details["name"],
-                        from_id,
-                        from_details["type"] if from_id else "",
-                        from_details["name"] if from_id else "",
-                        to_id,
-                        to_details["type"],
-                        to_details["name"],
-                        entry["timestamp"],
-                        entry["quantity"],
-                    ]
-                )
+
+@api_view(("GET",))
+@renderer_classes((JSONRenderer, BrowsableAPIRenderer))
+def report(request):
+    type = request.GET.get("type")
+    start = request.GET.get("start")
+    end = request.GET.get("end")
+
+    rows = []
+    match (type):
+        case "state":
+            rows = state_report(*query_all_state(end, None))
+        case "transfer":
+            q, start_dt = all_events_q(start, end)
+            rows = transfer_report(
+                query_all_events(start, end),
+                archive.archived(TransferEvent, q, start_dt),
+            )
         case "production":
             # q = Q()
 
@@ -595,7 +799,130 @@ def report(request):
             # serializer = ProductionEventSerializer
             # TODO: work out how best to present production events in csv format
             pass
-    return response
+
+    # rows are written as they are read, details looked up a batch at a time
+    return StreamingHttpResponse(
+        chunked(rows),
+        content_type="text/csv",
+        headers={"Content-Disposition": 'attachment; filename="somefilename.csv"'},
+    )
+
+
+@etag(global_etag)
+@api_view(("GET",))
+@renderer_classes((JSONRenderer, BrowsableAPIRenderer, CSVRenderer))
+def rollup(request):
+    """
+    Entered, exited, net and WIP quantity per location and bucket, from the rollups kept
+    by the event handler - ?bucket=seconds (a multiple of theirs) ?from=timestamp
+    ?to=timestamp ?location=loc_id (repeatable). Only buckets with changes are listed.
+    """
+    rollups = state_event_handler.rollups
+    if rollups is None:
+        return Response(
+            {"detail": "No rollups are kept - see LOCATION_ROLLUPS."},
+            status=status.HTTP_404_NOT_FOUND,
+        )
+
+    size = request.GET.get("bucket", None)
+    try:
+        size = int(size) if size is not None else rollups.bucket
+    except ValueError:
+        raise ValidationError({"bucket": "A whole number of seconds is required."})
+    if size <= 0 or size % rollups.bucket:
+        raise ValidationError(
+            {"bucket": f"Must be a multiple of {rollups.bucket} seconds."}
+        )
+
+    t_start = request.GET.get("from", None)
+    t_end = request.GET.get("to", None)
+    start_dt = dateutil.parser.isoparse(t_start) if t_start else None
+    end_dt = dateutil.parser.isoparse(t_end) if t_end else None
+
+    return Response(
+        rollups.series(request.GET.getlist("location"), start_dt, end_dt, size)
+    )
+
+
+def analytics_params(request):
+    """The window, percentiles and histogram bins asked for by an analytics report"""
+    t_start = request.GET.get("from", None)
+    t_end = request.GET.get("to", None)
+    if t_end:
+        end_dt = dateutil.parser.isoparse(t_end)
+    else:
+        end_dt = datetime.datetime.now(datetime.timezone.utc)
+    if t_start:
+        start_dt = dateutil.parser.isoparse(t_start)
+    else:
+        start_dt = end_dt - analytics.DEFAULT_WINDOW
+
+    percentiles = number_list(request, "percentiles", analytics.DEFAULT_PERCENTILES)
+    if not all(0 <= percentile <= 100 for percentile in percentiles):
+        raise ValidationError({"percentiles": "Must be between 0 and 100."})
+    bins = number_list(request, "bins", analytics.DEFAULT_BINS)
+    if list(bins) != sorted(set(bins)):
+        raise ValidationError({"bins": "Must be in increasing order."})
+    return start_dt, end_dt, percentiles, bins
+
+
+def number_list(request, name, default):
+    value = request.GET.get(name, None)
+    if value is None:
+        return default
+    try:
+        numbers = [float(part) for part in value.split(",")]
+    except ValueError:
+        raise ValidationError({name: "A comma separated list of numbers is required."})
+    return tuple(int(number) if number.is_integer() else number for number in numbers)
+
+
+def numpy_missing():
+    return Response(
+        {"detail": "The analytics reports need NumPy, which is not installed."},
+        status=status.HTTP_501_NOT_IMPLEMENTED,
+    )
+
+
+@etag(global_etag)
+@api_view(("GET",))
+@renderer_classes((JSONRenderer, BrowsableAPIRenderer))
+def dwellTimes(request):
+    """
+    Per location, the count, mean, percentiles and histogram of how many seconds items
+    stayed there - ?from=timestamp ?to=timestamp (the last week by default)
+    ?location=loc_id (repeatable) ?percentiles=50,90,99 ?bins=0,60,300,...
+    """
+    if analytics.np is None:
+        return numpy_missing()
+    start_dt, end_dt, percentiles, bins = analytics_params(request)
+    return Response(
+        analytics.dwell_times(
+            start_dt, end_dt, request.GET.getlist("location"), percentiles, bins
+        )
+    )
+
+
+@etag(global_etag)
+@api_view(("GET",))
+@renderer_classes((JSONRenderer, BrowsableAPIRenderer))
+def leadTimes(request):
+    """
+    The count, mean, percentiles and histogram of the seconds from items' first state
+    to their arrival at the completed location - ?completed=loc_id (the
+    completed_location setting by default) and the parameters of dwellTimes
+    """
+    if analytics.np is None:
+        return numpy_missing()
+    start_dt, end_dt, percentiles, bins = analytics_params(request)
+    completed_location = request.GET.get("completed", None)
+    if completed_location is None:
+        completed_location = current_settings().completed_location
+    if not completed_location:
+        raise ValidationError({"completed": "No completed_location is set."})
+    return Response(
+        analytics.lead_times(start_dt, end_dt, completed_location, percentiles, bins)
+    )
 
 
 @lru_cache
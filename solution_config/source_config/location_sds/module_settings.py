@@ -1,3 +1,5 @@
+import socket
+
 INCLUDED_APPS = ["state"]
 
 URL_ROUTING = [
@@ -8,14 +10,29 @@ URL_ROUTING = [
     ("report/", "state.report_urls"),
 ]
 
+# Set a shared subscription group to run several consumers side by side - the broker then
+# delivers each message to only one consumer in the group. None uses plain subscriptions.
+SHARED_SUBSCRIPTION_GROUP = None  # e.g. "locations_db"
+
+__topic_prefix = (
+    f"$share/{SHARED_SUBSCRIPTION_GROUP}/" if SHARED_SUBSCRIPTION_GROUP else ""
+)
+
 MQTT = {
     "broker": "mqtt.docker.local",
     "port": 1883,
-    "id": "locations_db",
+    # consumers sharing a subscription need their own client ids
+    "id": (
+        f"locations_db-{socket.gethostname()}"
+        if SHARED_SUBSCRIPTION_GROUP
+        else "locations_db"
+    ),
     "subscriptions": [
-        {"topic": "transfer_operation/+/+", "qos": 1},
-        {"topic": "transfer_operation/+", "qos": 1},
-        {"topic": "production_operation/+", "qos": 1},
+        {"topic": __topic_prefix + "transfer_operation/+/+", "qos": 1},
+        {"topic": __topic_prefix + "transfer_operation/+", "qos": 1},
+        {"topic": __topic_prefix + "production_operation/+", "qos": 1},
+        # every consumer - never shared - hears that the settings changed
+        {"topic": "state_settings/+", "qos": 1},
     ],
     "publish_qos": 1,
     "base_topic_template": "",
@@ -27,3 +44,77 @@ ADMIN_TITLE = "Location Tracking Admin Portal"
 ADMIN_INDEX = "Welcome to Location Tracking Administration Portal"
 
 ID_SERVICE_URL = "identity-sds.docker.local"
+
+# Micro-batched ingestion - transfer/production operations are collected into windows of
+# up to max_size messages or max_wait seconds and each window is applied in one transaction.
+# None handles every message in its own transaction.
+INGEST_BATCH = None  # e.g. {"max_size": 200, "max_wait": 0.05}
+
+# Keep a process-local index of open State rows so the event handler can skip its lookup
+# queries. Only enable when this process is the sole writer of State (see /state/index).
+OPEN_STATE_INDEX = False
+
+# Process messages concurrently on ordered lanes - messages are routed by the items they
+# touch so each item's events keep their order. max_queue bounds each lane (0 = unbounded).
+# None processes messages one at a time on the MQTT thread.
+INGEST_LANES = None  # e.g. {"lanes": 4, "max_queue": 1000}
+
+# Drop QoS 1 redeliveries of transfer/production operations seen within the last window
+# seconds. max_entries bounds the in-memory LRU in front of the ProcessedMessage table.
+# Each accepted operation then costs a ProcessedMessage lookup and insert, and expired
+# rows are pruned every minute. None applies a redelivered operation again.
+INGEST_DEDUPE = None  # e.g. {"window": 86400, "max_entries": 50000}
+
+# Coalesce outbound location_state events per location over window seconds after commit.
+# batch_topic sends each location's changes as one location_state/batch/<loc> message.
+# None publishes every event as soon as its transaction commits.
+PUBLISH_COALESCE = None  # e.g. {"window": 0.5, "batch_topic": True}
+
+# Validate transfer/production operation messages with validators compiled from the
+# mqtt_serializers schemas instead of instantiating a DRF serializer per message.
+# Messages the fast path is unsure about still go through DRF, so errors are unchanged.
+FAST_MESSAGE_VALIDATION = False
+
+# Snapshot the open states every interval seconds so that ?t= queries start from the
+# nearest earlier snapshot rather than the whole history. Snapshots are written by the
+# snapshot_state command - run it from cron at least every interval - and kept for
+# retention seconds. None answers ?t= from State alone and takes no snapshots - clear
+# the old ones with snapshot_state --clear before enabling them again.
+STATE_SNAPSHOTS = None  # e.g. {"interval": 3600, "retention": 7 * 24 * 3600}
+
+# Keep version counters of the items and locations each change touches, bumped after it
+# commits, for the ETags of the state and event views - If-None-Match then gets a 304
+# without reading State. False sends no ETags and writes nothing per change.
+STATE_VERSIONS = False
+
+# Cache rendered /state/, /state/for/<item> and /state/at/<loc> responses under their
+# ETag, evicting them as soon as a change to their item or location commits (stats at
+# /state/cache). backend names a CACHES alias to share the entries between the processes
+# on a host instead of keeping max_entries / max_bytes of them in this process. Needs
+# STATE_VERSIONS. None renders every response.
+RESPONSE_CACHE = None  # e.g. {"max_entries": 256, "max_bytes": 64 * 2**20}
+
+# Keep per-location throughput rollups - the quantity that entered and left each location
+# in buckets of bucket seconds - up to date as events are handled, for /report/rollup.
+# Run rebuild_rollups after enabling them or changing the bucket. None keeps no rollups.
+LOCATION_ROLLUPS = None  # e.g. {"bucket": 3600}
+
+# Move closed states and events older than age seconds from State and the event tables
+# to archive tables with the archive_history command - run it from cron - batch_size rows
+# per transaction. The history and event views read the archive as well when asked for
+# anything from before the horizon. None archives nothing.
+STATE_ARCHIVE = None  # e.g. {"age": 180 * 86400, "batch_size": 1000}
+
+# Postgres only: partition State (on end) and TransferEvent (on timestamp) by month, so
+# queries bounded by from/to skip the months outside them. Run partition_tables --convert
+# once, with the consumers stopped, then partition_tables from cron to create the
+# partitions of the next ahead months and move those over keep months old, and past the
+# STATE_ARCHIVE horizon, to the archive tables (None, or no STATE_ARCHIVE, keeps them
+# all). None, or SQLite, leaves the tables unpartitioned.
+STATE_PARTITIONS = None  # e.g. {"ahead": 3, "keep": 24}
+
+# Cache the settings read by /state/ and /report?type=state in each process instead of
+# querying them on every request. A change to them is announced over MQTT on
+# state_settings/changed, and max_age seconds bounds how long a process that missed it
+# keeps the old values (None - until the next change). None reads them every time.
+SETTINGS_CACHE = None  # e.g. {"max_age": 300}